@@ -1,71 +1,228 @@
+import time
+
 import numpy as np
+from sklearn.neighbors import BallTree, KDTree
+from KITCAT import histogram as lhistogram
+from KITCAT import metrics as lmetrics
+from KITCAT.catalog import angular_query, is_chord, theta2chord, to_unit
 from KITCAT.helper import JobHelper
+from KITCAT.dualtree import DualTree
+
+# pair counting backends
+BACKENDS = ('balltree', 'dualtree', 'healpix')
+
+# f(theta) backends, 'fft' requires randoms on a regular (dec, ra) grid
+FTHETA_BACKENDS = BACKENDS + ('fft',)
+
+def _bin_index(x, x_min, x_max, nbins):
+    """ compute uniform bin indices arithmetically, reproducing the bin
+    assignment of np.histogram(x, bins=nbins, range=(x_min, x_max)).
+
+    Returns:
+    --------
+    index: array of int
+        bin index of each kept value
+    keep: array of bool
+        True if the value falls inside the binning range """
+
+    x_min = x_min + 0.0
+    x_max = x_max + 0.0
+    edges = np.linspace(x_min, x_max, nbins + 1)
+    keep = (x >= x_min) & (x <= x_max)
+    x = x[keep]
+
+    # same arithmetic and edge corrections as numpy
+    index = ((x - x_min) / (x_max - x_min) * nbins).astype(np.intp)
+    index[index == nbins] -= 1
+    index[x < edges[index]] -= 1
+    index[(x >= edges[index + 1]) & (index != nbins - 1)] += 1
+    return index, keep
+
+def _full_index(x, x_min, x_max, nbins):
+    """ same as _bin_index, but return an index for every value, with -1 for
+    values outside of the binning range """
+    index = np.full(x.shape, -1, dtype=np.intp)
+    bin_index, keep = _bin_index(x, x_min, x_max, nbins)
+    index[keep] = bin_index
+    return index
+
+def _theta_index(dist, theta_max, theta_nbins, tree):
+    """ same as _bin_index of the angular separations returned by a
+    neighbour query of tree. A chord tree returns chord lengths, which are
+    compared with the chord lengths of the theta bin edges, so separations
+    are never converted back into angles. """
+    if hasattr(tree, 'query_flat') or not is_chord(tree):
+        return _bin_index(dist, 0., theta_max, theta_nbins)
+    edges = theta2chord(np.linspace(0., theta_max, theta_nbins + 1))
+    keep = dist <= edges[-1]
+    index = np.searchsorted(edges, dist[keep], side='right') - 1
+    return np.minimum(index, theta_nbins - 1), keep
+
+def _add_rows(hist, rows, values):
+    """ add each row of values into hist[rows] sequentially.
+    Repeated rows are accumulated in order, as a per-point loop would. """
+    lhistogram.add_at(hist, rows, values)
+
+def get_zztheta_scale(same, backend, weighted=True):
+    """ return the value of one unweighted count of get_zztheta. The
+    dualtree backend counts the ordered pairs of an auto-correlation, each
+    of them is half a pair. """
+    if same and weighted and backend == 'dualtree':
+        return 0.5
+    return 1.
+
+def _query_chunks(tree, catalog, start, end, r, chunk_size, checkpoint,
+                  cartesian=False):
+    """ query neighbours within r for catalog[start:end] in chunks. The
+    (dec, ra) of catalog are queried within the angle r, or if cartesian,
+    its (x, y, z) within the distance r.
+
+    Yields:
+    -------
+    offset: int
+        index of the first point of the chunk
+    owner: array of int
+        position of the query point within the chunk for each neighbour
+    index: array of int
+        index of each neighbour in the tree
+    dist: array of float
+        distance to each neighbour, in the units of the tree (see
+        _theta_index) """
+
+    n = end - start - 1
+    record = lmetrics.current()
+    for offset in range(start, end, chunk_size):
+        stop = min(offset + chunk_size, end)
+
+        # print out checkpoint, or rate-limited progress if metrics are
+        # recorded
+        if record is not None:
+            record.progress(offset - start, end - start)
+        else:
+            first = -(-(offset - start) // checkpoint) * checkpoint
+            for i in range(first, stop - start, checkpoint):
+                print('- index: %d/%d' % (i, n))
+
+        query_start = time.perf_counter()
+        if hasattr(tree, 'query_flat'):
+            # cell lists return flattened neighbours directly
+            owner, index, dist = tree.query_flat(catalog[offset:stop, :2], r)
+            counts = np.bincount(owner, minlength=stop - offset)
+        else:
+            if cartesian:
+                index, dist = tree.query_radius(catalog[offset:stop, :3],
+                                                r=r, return_distance=True)
+            else:
+                index, dist = angular_query(tree, catalog[offset:stop], r,
+                                            return_distance=True)
+            counts = np.fromiter((len(i) for i in index), dtype=np.intp,
+                                 count=stop - offset)
+            owner = np.repeat(np.arange(stop - offset), counts)
+            index, dist = np.concatenate(index), np.concatenate(dist)
+        if record is None:
+            yield offset, owner, index, dist
+            continue
+
+        # the consumer fills the histograms until the next chunk is asked
+        record.add_query(counts, time.perf_counter() - query_start)
+        hist_start = time.perf_counter()
+        yield offset, owner, index, dist
+        record.add('histogram_time', time.perf_counter() - hist_start)
+    if record is not None:
+        record.progress(end - start, end - start)
 
 def get_dd(
-    catalog, tree,
+    pair_catalog, tree_catalog, tree=None,
     s_max       = 200.,
-    s_nbins     = 50.,
+    s_nbins     = 50,
     job_helper  = None,
     same        = False,
-    checkpoint  = 10000
+    checkpoint  = 10000,
+    chunk_size  = 1000
     ):
-    """ calculate weighted and unweighted DD(s) of catalog and tree
+    """ calculate the exact weighted and unweighted DD(s) and DD(sigma, pi)
+    of catalogs in comoving Cartesian coordinates. sigma and pi are the
+    separations across and along the bisector of the two lines of sight, as
+    in projection.Projection.
 
     Parameters:
     -----------
-    catalog:
-    tree: kd-tree
+    pair_catalog, tree_catalog: array of shape (n, 4)
+        x, y, z and weight, see catalog.to_cartesian
+    tree: kd-tree (default=None)
+        Euclidean tree of tree_catalog[:, :3]. If None, it is built.
     s_max: float
     s_nbins: int
+        s, sigma and pi are binned uniformly in [0, s_max]
     job_helper:
     same: bool
-        set True if the tree is built from catalog .
-        if True, will not apply double counting correction.
+        set True if the tree is built from catalog. Each unordered pair is
+        then counted once and self-pairs are excluded.
+    chunk_size: int
+        number of points per batched neighbour query
 
     Returns:
     --------
-    dd: array of shape (2, s_nbins) """
+    dd: array of shape (2, s_nbins)
+    dd_sigma_pi: array of shape (2, s_nbins, s_nbins)
+        indexed by (sigma, pi) """
 
     dd = np.zeros((2, s_nbins))
+    dd_sigma_pi = np.zeros((2, s_nbins, s_nbins))
 
     # if job_helper is None, assume one job
     if job_helper is None:
         job_helper = JobHelper(1)
         job_helper.set_current_job(0, verbose=False)
-    start, end = job_helper.get_index_range(catalog.shape[0])
-    n = end - start - 1
+    start, end = job_helper.get_index_range(pair_catalog.shape[0])
+    if same:
+        _check_same(pair_catalog, tree_catalog)
+    if tree is None:
+        tree = KDTree(tree_catalog[:, :3])
 
     print('')
     print('calculate DD(s) from index %d to %d' % (start, end - 1))
 
-    for i, pt in enumerate(catalog[start:end]):
-
-        # print out checkpoint
-        if i % checkpoint is 0:
-            print('- index: %d/%d' % (i, n))
-
-        # start query
-        index, s = tree.query_radius(pt[:3].reshape(1, -1),
-                                     r=s_max,
-                                     return_distance=True)
-        index = index[0]
-        s = s[0]
-
-        # fill weighted distribution
-        # w =  w1 * w2
-        w = catalog[:, 3][index]*pt[3]
-        hist, _ = np.histogram(s, bins=s_nbins, range=(0., s_max), weights=w)
-        dd[0] += hist
-
-        # fill unweighted distribution
-        hist, _ = np.histogram(s, bins=num_bins_s, range=(0., s_max))
-        dd[1] += hist
-
-    # double counting correction
-    if same:
-        dd = dd / 2.
-
-    return dd
+    pair_x = pair_catalog[:, :3]
+    tree_x = tree_catalog[:, :3]
+    pair_u = pair_x / np.linalg.norm(pair_x, axis=1)[:, None]
+    tree_u = tree_x / np.linalg.norm(tree_x, axis=1)[:, None]
+    pair_w = pair_catalog[:, 3]
+    tree_w = tree_catalog[:, 3]
+
+    # sigma and pi up to s_max need s up to sqrt(2) s_max
+    for offset, owner, index, s in _query_chunks(
+            tree, pair_catalog, start, end, np.sqrt(2.) * s_max, chunk_size,
+            checkpoint, cartesian=True):
+        if same:
+            owner, index, s = _upper_pairs(offset, owner, index, s)
+        i = offset + owner
+        w = pair_w[i] * tree_w[index]
+
+        # fill DD(s)
+        i_s, keep = _bin_index(s, 0., s_max, s_nbins)
+        dd[0] += np.bincount(i_s, weights=w[keep], minlength=s_nbins)
+        dd[1] += np.bincount(i_s, minlength=s_nbins)
+
+        # components of the separation along and across the bisector
+        los = pair_u[i] + tree_u[index]
+        los /= np.linalg.norm(los, axis=1)[:, None]
+        diff = tree_x[index] - pair_x[i]
+        pi = np.abs(np.einsum('ij,ij->i', diff, los))
+        sigma = np.linalg.norm(np.cross(diff, los), axis=1)
+
+        # fill DD(sigma, pi)
+        i_sigma = _full_index(sigma, 0., s_max, s_nbins)
+        i_pi = _full_index(pi, 0., s_max, s_nbins)
+        keep = (i_sigma >= 0) & (i_pi >= 0)
+        flat = i_sigma[keep] * s_nbins + i_pi[keep]
+        dd_sigma_pi[0] += np.bincount(flat, weights=w[keep],
+                                      minlength=s_nbins**2).reshape(
+                                          s_nbins, s_nbins)
+        dd_sigma_pi[1] += np.bincount(flat, minlength=s_nbins**2).reshape(
+            s_nbins, s_nbins)
+
+    return dd, dd_sigma_pi
 
 def get_ftheta(
     pair_catalog, tree_catalog, tree,
@@ -73,7 +230,9 @@ def get_ftheta(
     theta_nbins = 100,
     job_helper  = None,
     same        = False,
-    checkpoint  = 10000
+    checkpoint  = 10000,
+    chunk_size  = 1000,
+    backend     = 'balltree'
     ):
     """ calculate f(theta) of catalog and tree.
 
@@ -85,8 +244,16 @@ def get_ftheta(
     theta_nbins: int
     job_helper:
     same: bool
-        set True if the tree is built from catalog .
-        if True, will not apply double counting correction.
+        set True if the tree is built from catalog. Each unordered pair of
+        cells is then counted once, and a cell of weight w adds its
+        w*(w-1)/2 pairs at zero separation.
+    chunk_size: int
+        number of points per batched neighbour query
+    backend: str
+        'balltree' to query the tree point by point in batches,
+        'dualtree' to walk a tree of the pair catalog against the tree,
+        'healpix' to search neighbours in the surrounding HEALPix pixels,
+        'fft' to correlate the rows of the random grids along ra
 
     Returns:
     --------
@@ -99,31 +266,31 @@ def get_ftheta(
         job_helper = JobHelper(1)
         job_helper.set_current_job(0, verbose=False)
     start, end = job_helper.get_index_range(pair_catalog.shape[0])
-    n = end - start - 1
+    if same:
+        _check_same(pair_catalog, tree_catalog)
 
     print('')
     print('calculate f(theta) from index %d to %d' % (start, end - 1))
 
-    for i, pt in enumerate(pair_catalog[start:end]):
-        if i % checkpoint is 0:
-            print('- index: %d/%d' % (i, n))
-        index, theta = tree.query_radius(pt[:2].reshape(1, -1),
-                                         r=theta_max,
-                                         return_distance=True)
-        index = index[0]
-        theta = theta[0]
-
-        # w = w1 * w2
-        w = pt[2] * tree_catalog[:, 2][index]
-        hist, _ = np.histogram(theta,
-                               bins     = theta_nbins,
-                               range    = (0., theta_max),
-                               weights  = w)
-        ftheta += hist
+    if backend == 'dualtree':
+        _ftheta_dualtree(ftheta, pair_catalog[start:end], tree_catalog, tree,
+                         theta_max, theta_nbins)
+    elif backend == 'fft':
+        _ftheta_fft(ftheta, pair_catalog[start:end], tree_catalog,
+                    theta_max, theta_nbins)
+    else:
+        if backend == 'healpix':
+            tree = _cell_list(tree_catalog, theta_max)
+        _ftheta_query(ftheta, pair_catalog, tree_catalog, tree, start, end,
+                         theta_max, theta_nbins, chunk_size, checkpoint, same)
 
     if same:
-        # Correction for double counting
-        ftheta = ftheta / 2.
+        w = pair_catalog[start:end, 2].astype(np.float64)
+        if backend in ('dualtree', 'fft'):
+            # ordered pairs: remove the self-pairs and count each pair once
+            ftheta[0] -= np.sum(w**2)
+            ftheta /= 2.
+        ftheta[0] += 0.5 * np.sum(w * (w - 1.))
 
     return ftheta
 
@@ -135,14 +302,21 @@ def get_ztheta(
     theta_max   = 0.18,
     theta_nbins = 100,
     job_helper  = None,
-    checkpoint  = 10000
+    checkpoint  = 10000,
+    chunk_size  = 1000,
+    backend     = 'balltree',
+    weighted_dtype   = 'float64',
+    unweighted_dtype = 'float64'
     ):
-    """ calculate f(theta) of catalog and tree.
+    """ calculate g(theta, z) of catalog and tree, the pairs binned in the
+    angular separation and the redshift of the pair catalog point.
 
     Parameters:
     -----------
-    pair_catalog:
-    tree_catalog:
+    pair_catalog: array of shape (n, 4)
+        (dec, ra, z, w)
+    tree_catalog: array of shape (m, 3)
+        (dec, ra, w)
     tree: kd-tree
     z_min: float
     z_max: float
@@ -150,52 +324,43 @@ def get_ztheta(
     theta_max: float
     theta_nbins: int
     job_helper:
+    chunk_size: int
+        number of points per batched neighbour query
+    backend: str
+        'balltree' to query the tree point by point in batches,
+        'dualtree' to walk a tree of the pair catalog against the tree,
+        'healpix' to search neighbours in the surrounding HEALPix pixels
+    weighted_dtype, unweighted_dtype: str (default='float64')
+        dtypes of the weighted and unweighted halves, see histogram.zeros
 
     Returns:
     --------
-    ztheta: array of shape (theta_nbins,) """
+    ztheta: array of shape (2, theta_nbins, z_nbins) or histogram.Histogram
+        weighted and unweighted pairs. Pair points outside of the z range
+        are dropped. """
 
-    ztheta = np.zeros((2, theta_nbins, z_nbins))
+    ztheta = lhistogram.zeros((2, theta_nbins, z_nbins), weighted_dtype,
+                              unweighted_dtype)
 
     # if job_helper is None, assume one job
     if job_helper is None:
         job_helper = JobHelper(1)
         job_helper.set_current_job(0, verbose=False)
     start, end = job_helper.get_index_range(pair_catalog.shape[0])
-    n = end - start - 1
-
-    # set up binning parameters
-    nbins = (theta_nbins, z_nbins)
-    bins_range = ((0., theta_max), (z_min, z_max))
 
     print("calculate ztheta from index %d to %d" % (start, end - 1))
 
-    for i, pt in enumerate(pair_catalog[start:end]):
-        if i % checkpoint is 0:
-            print('- index: %d/%d' % (i, n))
-
-        index, theta = tree.query_radius(pt[:2].reshape(1, -1),
-                                         r=theta_max,
-                                         return_distance=True)
-        index = index[0]
-        theta = theta[0]
-        iz = int(z_nbins * (pt[2]-z_min)/(z_max - z_min))
-
-        # fill unweighted histogram
-        w = tree_catalog[:, 2][index]
-        hist, _ = np.histogram(theta,
-                               bins     = theta_nbins,
-                               range    = (0., theta_max),
-                               weights  = w)
-        ztheta[1][:, iz] += hist
+    # z bin of each pair point, truncated the same way as int()
+    iz = (z_nbins * (pair_catalog[:, 2]-z_min)/(z_max - z_min)).astype(int)
 
-        # fill weighted histogram
-        w *= pt[3]
-        hist, _ = np.histogram(theta,
-                               bins     = theta_nbins,
-                               range    = (0., theta_max),
-                               weights  = w)
-        ztheta[0][:, iz] += hist
+    if backend == 'dualtree':
+        _ztheta_dualtree(ztheta, pair_catalog[start:end], tree_catalog, tree,
+                         iz[start:end], theta_max, theta_nbins)
+    else:
+        if backend == 'healpix':
+            tree = _cell_list(tree_catalog, theta_max)
+        _ztheta_query(ztheta, pair_catalog, tree_catalog, tree, start, end,
+                         iz, theta_max, theta_nbins, chunk_size, checkpoint)
 
     return ztheta
 
@@ -209,14 +374,23 @@ def get_zztheta(
     theta_nbins = 100,
     job_helper  = None,
     same        = False,
-    checkpoint  = 10000
+    checkpoint  = 10000,
+    chunk_size  = 1000,
+    backend     = 'balltree',
+    z_band      = None,
+    weighted    = True,
+    weighted_dtype   = 'float64',
+    unweighted_dtype = 'float64'
     ):
-    """ calculate f(theta) of catalog and tree.
+    """ calculate the pairs of catalog and tree binned in the angular
+    separation and the redshifts of both points.
 
     Parameters:
     -----------
-    galaxy_catalog:
-    random_catalog:
+    pair_catalog: array of shape (n, 4)
+        (dec, ra, z, w)
+    tree_catalog: array of shape (m, 4)
+        (dec, ra, z, w)
     tree: kd-tree
     z_min: float
     z_max: float
@@ -225,55 +399,454 @@ def get_zztheta(
     theta_nbins: int
     job_helper:
     same: bool
-        set True if the tree is built from catalog .
-        if True, will not apply double counting correction.
+        set True if the tree is built from catalog. Each unordered pair is
+        then counted once and self-pairs are excluded.
+    chunk_size: int
+        number of points per batched neighbour query (not used by
+        'dualtree' or if not weighted)
+    backend: str
+        'balltree' to query the tree point by point in batches,
+        'dualtree' to walk a tree of the pair catalog against the tree,
+        'healpix' to search neighbours in the surrounding HEALPix pixels
+    z_band: int (default=None)
+        number of z bins kept on each side of the diagonal. Pairs further
+        apart in z are dropped. If None, keep all z bins.
+    weighted: bool (default=True)
+        if False, only count the unweighted pairs, with cumulative dual-tree
+        counts of each pair of z bins instead of neighbour lists. backend is
+        then ignored and the weighted half is NaN.
+    weighted_dtype, unweighted_dtype: str (default='float64')
+        dtypes of the weighted and unweighted halves, see histogram.zeros.
+        Integer unweighted halves of the dualtree backend hold the ordered
+        pairs, with a scale of 0.5 (see get_zztheta_scale).
 
     Returns:
     --------
-    zztheta: array of shape (2, theta_nbins, z_nbins, z_nbins) """
+    zztheta: array of shape (2, theta_nbins, z_nbins, 2*z_band+1) or
+             histogram.Histogram
+        weighted and unweighted pairs. zztheta[:, :, l, d] holds the pairs
+        with tree z bin l and pair z bin l + d - z_band """
 
-    zztheta = np.zeros((2, theta_nbins, z_nbins, z_nbins))
+    if z_band is None:
+        z_band = z_nbins - 1
+    zztheta = lhistogram.zeros((2, theta_nbins, z_nbins, 2*z_band + 1),
+                               weighted_dtype, unweighted_dtype,
+                               get_zztheta_scale(same, backend, weighted))
 
     # if job_helper is None, assume one job
     if job_helper is None:
         job_helper = JobHelper(1)
         job_helper.set_current_job(0, verbose=False)
     start, end = job_helper.get_index_range(pair_catalog.shape[0])
-    n = end - start - 1
-
-    nbins = (theta_nbins, z_nbins)
-    bins_range = ((0., theta_max), (z_min, z_max))
+    if same:
+        _check_same(pair_catalog, tree_catalog)
 
     print('')
     print('calculate zztheta from index %d to %d' % (start, end - 1))
 
-    for i, pt in enumerate(pair_catalog[start:end]):
-        if i % checkpoint is 0:
-            print('- index: %d/%d' % (i, n))
-        index, theta = tree.query_radius(pt[:2].reshape(1, -1),
-                                         r=theta_max,
-                                         return_distance=True)
-        index = index[0]
-        theta = theta[0]
-        iz = int(z_nbins * (pt[2]-z_min)/(z_max - z_min))
-        z = tree_catalog[:, 2][index]
+    if not weighted:
+        _zztheta_cumulative(zztheta, pair_catalog, tree_catalog, tree, start,
+                            end, z_min, z_max, theta_max, same)
+    elif backend == 'dualtree':
+        iz_pair = (z_nbins * (pair_catalog[start:end, 2]-z_min)
+                   / (z_max - z_min)).astype(int)
+        iz_tree = _full_index(tree_catalog[:, 2], z_min, z_max, z_nbins)
+        _zztheta_dualtree(zztheta, pair_catalog[start:end], tree_catalog, tree,
+                          iz_pair, iz_tree, theta_max, theta_nbins)
+        if same:
+            # ordered pairs: remove the self-pairs and count each pair once.
+            # A Histogram keeps the ordered pairs in its unweighted half.
+            w = pair_catalog[start:end, 3]
+            flat, valid = _band_flat(np.zeros(end - start, dtype=int),
+                                     iz_tree[start:end], iz_pair, z_nbins,
+                                     z_band)
+            halves = lhistogram.halves(zztheta)
+            lhistogram.add_at(halves[0].reshape(-1), flat, -w[valid]**2)
+            lhistogram.add_at(halves[1].reshape(-1), flat, -1.)
+            halves[0] /= 2.
+            if not isinstance(zztheta, lhistogram.Histogram):
+                halves[1] /= 2.
+    else:
+        if backend == 'healpix':
+            tree = _cell_list(tree_catalog, theta_max)
+        _zztheta_query(zztheta, pair_catalog, tree_catalog, tree, start, end,
+                       z_min, z_max, theta_max, chunk_size, checkpoint, same)
+
+    return zztheta
+
+def _check_same(pair_catalog, tree_catalog):
+    """ raise ValueError if the pair and tree catalogs of an auto-correlation
+    do not have the same rows """
+    if pair_catalog.shape[0] != tree_catalog.shape[0]:
+        raise ValueError('same requires the pair and tree catalogs to be the '
+                         'same catalog')
+
+def _upper_pairs(offset, owner, index, dist):
+    """ keep the neighbours with a higher index than their query point, so
+    that each unordered pair of a catalog with itself is visited once """
+    upper = index > offset + owner
+    return owner[upper], index[upper], dist[upper]
+
+def _ftheta_query(ftheta, pair_catalog, tree_catalog, tree, start, end,
+                     theta_max, theta_nbins, chunk_size, checkpoint,
+                     same=False):
+    """ fill f(theta) with batched neighbour queries """
+    pair_w = pair_catalog[:, 2]
+    tree_w = tree_catalog[:, 2]
+    for offset, owner, index, theta in _query_chunks(
+            tree, pair_catalog, start, end, theta_max, chunk_size, checkpoint):
+        n_chunk = min(offset + chunk_size, end) - offset
+        if same:
+            owner, index, theta = _upper_pairs(offset, owner, index, theta)
+        itheta, keep = _theta_index(theta, theta_max, theta_nbins, tree)
+        owner = owner[keep]
+        index = index[keep]
 
-        # fill weighted histogram
         # w = w1 * w2
-        w = pt[3] * tree_catalog[:, 3][index]
-        hist, _, _  = np.histogram2d(theta, z,
-                                     bins     = nbins,
-                                     range    = bins_range,
-                                     weights  = w)
-        zztheta[0][:, :, iz] += hist
+        w = pair_w[offset + owner] * tree_w[index]
+        hist = np.bincount(owner * theta_nbins + itheta,
+                           weights   = w,
+                           minlength = n_chunk * theta_nbins)
+        _add_rows(ftheta[None, :], np.zeros(n_chunk, dtype=int),
+                  hist.reshape(n_chunk, theta_nbins))
+
+def _ra_grid(*catalogs):
+    """ return the column of each point of catalogs on a regular ra grid,
+    and the grid spacing. Raise ValueError if the points are not on a
+    regular grid. """
+    ra = np.unique(np.concatenate([catalog[:, 1] for catalog in catalogs]))
+    dra = np.diff(ra).min() if len(ra) > 1 else 1.
+    columns = [np.rint((catalog[:, 1] - ra[0]) / dra).astype(np.intp)
+               for catalog in catalogs]
+    for catalog, column in zip(catalogs, columns):
+        if not np.allclose(ra[0] + column * dra, catalog[:, 1],
+                           rtol=0., atol=1e-6 * dra):
+            raise ValueError('fft backend requires randoms on a regular ra '
+                             'grid')
+    return columns, dra
+
+def _ftheta_fft(ftheta, pair_catalog, tree_catalog, theta_max, theta_nbins):
+    """ fill f(theta) of gridded randoms. The separation of two cells only
+    depends on their decs and ra offset, so the pairs of each two dec rows
+    are summed per ra offset with an FFT cross-correlation along ra. """
+    if len(pair_catalog) == 0 or len(tree_catalog) == 0:
+        return
+    try:
+        from scipy.fft import irfft, next_fast_len, rfft
+    except ImportError:
+        # scipy < 1.4
+        from numpy.fft import irfft, rfft
+        from scipy.fftpack import next_fast_len
+    (pair_column, tree_column), dra = _ra_grid(pair_catalog, tree_catalog)
+    n_ra = max(pair_column.max(), tree_column.max()) + 1
+
+    # weights on the (dec row, ra column) grids
+    grids = []
+    for catalog, column in ((pair_catalog, pair_column),
+                            (tree_catalog, tree_column)):
+        dec, row = np.unique(catalog[:, 0], return_inverse=True)
+        grid = np.zeros((len(dec), n_ra))
+        np.add.at(grid, (row.ravel(), column), catalog[:, 2])
+        grids.append((dec, grid))
+    (pair_dec, pair_grid), (tree_dec, tree_grid) = grids
+
+    # products of integer weights, e.g. counts, are rounded back to exact
+    exact = all(np.all(grid == np.rint(grid)) for grid in (pair_grid,
+                                                            tree_grid))
+
+    # zero padding to 2*n_ra-1 makes the correlation linear, not circular
+    size = next_fast_len(2 * n_ra - 1)
+    lag = np.arange(size)
+    lag = np.where(lag < n_ra, lag, lag - size)
+    pair_fft = np.conj(rfft(pair_grid, size, axis=1))
+    tree_fft = rfft(tree_grid, size, axis=1)
+    sin_ra = np.sin(0.5 * lag * dra)**2
+    cos_tree = np.cos(tree_dec)
+
+    record = lmetrics.current()
+    for i, dec in enumerate(pair_dec):
+        if record is not None:
+            record.progress(i, len(pair_dec))
+        near = np.abs(tree_dec - dec) <= theta_max
+        if not near.any():
+            continue
+
+        # counts[j, m] = sum_k pair_grid[i, k] * tree_grid[j, k + m]
+        counts = irfft(pair_fft[i] * tree_fft[near], size, axis=1)
+        if exact:
+            counts = np.rint(counts)
+
+        # haversine separation, as in the neighbour queries
+        sin_dec = np.sin(0.5 * (dec - tree_dec[near]))**2
+        theta = 2. * np.arcsin(np.sqrt(
+            sin_dec[:, None] + np.cos(dec) * cos_tree[near][:, None] *
+            sin_ra[None, :]))
+        itheta, keep = _bin_index(theta.ravel(), 0., theta_max, theta_nbins)
+        ftheta += np.bincount(itheta, weights=counts.ravel()[keep],
+                              minlength=theta_nbins)
+    if record is not None:
+        record.progress(len(pair_dec), len(pair_dec))
+
+def _ztheta_query(ztheta, pair_catalog, tree_catalog, tree, start, end, iz,
+                     theta_max, theta_nbins, chunk_size, checkpoint):
+    """ fill ztheta with batched neighbour queries """
+    z_nbins = ztheta.shape[2]
+    halves = lhistogram.halves(ztheta)
+    pair_w = pair_catalog[:, 3]
+    tree_w = tree_catalog[:, 2]
+    for offset, owner, index, theta in _query_chunks(
+            tree, pair_catalog, start, end, theta_max, chunk_size, checkpoint):
+        n_chunk = min(offset + chunk_size, end) - offset
+        itheta, keep = _theta_index(theta, theta_max, theta_nbins, tree)
+        owner = owner[keep]
+        index = index[keep]
+        flat = owner * theta_nbins + itheta
+
+        # pair points outside of the z range are dropped
+        chunk_iz = iz[offset:offset + n_chunk]
+        valid = (chunk_iz >= 0) & (chunk_iz < z_nbins)
+        chunk_iz = chunk_iz[valid]
 
         # fill unweighted histogram
-        hist, _, _  = np.histogram2d(theta, z,
-                                     bins     = nbins,
-                                     range    = bins_range)
-        zztheta[1][:, :, iz] += hist
+        w = tree_w[index]
+        hist = np.bincount(flat, weights=w, minlength=n_chunk * theta_nbins)
+        _add_rows(halves[1].T, chunk_iz,
+                  hist.reshape(n_chunk, theta_nbins)[valid])
 
-    # double counting correction
+        # fill weighted histogram
+        w *= pair_w[offset + owner]
+        hist = np.bincount(flat, weights=w, minlength=n_chunk * theta_nbins)
+        _add_rows(halves[0].T, chunk_iz,
+                  hist.reshape(n_chunk, theta_nbins)[valid])
+
+def _zztheta_query(zztheta, pair_catalog, tree_catalog, tree, start, end,
+                   z_min, z_max, theta_max, chunk_size, checkpoint, same=False):
+    """ fill zztheta with batched neighbour queries """
+    theta_nbins, z_nbins, z_width = zztheta.shape[1:]
+    halves = lhistogram.halves(zztheta)
+    z_band = z_width // 2
+    iz_pair = (z_nbins * (pair_catalog[:, 2]-z_min)/(z_max - z_min)).astype(int)
+    iz_tree = _full_index(tree_catalog[:, 2], z_min, z_max, z_nbins)
+    pair_w = pair_catalog[:, 3]
+    tree_w = tree_catalog[:, 3]
+    for offset, owner, index, theta in _query_chunks(
+            tree, pair_catalog, start, end, theta_max, chunk_size, checkpoint):
+        if same:
+            owner, index, theta = _upper_pairs(offset, owner, index, theta)
+        itheta, keep = _theta_index(theta, theta_max, theta_nbins, tree)
+        i = offset + owner[keep]
+        j = index[keep]
+        flat, valid = _band_flat(itheta, iz_tree[j], iz_pair[i], z_nbins,
+                                 z_band)
+        i, j = i[valid], j[valid]
+
+        # fill weighted and unweighted histogram
+        lhistogram.add_at(halves[0].reshape(-1), flat, pair_w[i] * tree_w[j])
+        lhistogram.add_at(halves[1].reshape(-1), flat, 1.)
+
+def _zztheta_cumulative(zztheta, pair_catalog, tree_catalog, tree, start,
+                        end, z_min, z_max, theta_max, same=False):
+    """ fill the unweighted half of zztheta with cumulative dual-tree counts
+    of each pair of z bins. The counts within the theta bin edges are
+    differenced into shells, so neighbour lists are never built. Tie-breaking
+    at a bin edge differs from _theta_index, pairs exactly on an edge fall
+    into the lower bin. The weighted half is set to NaN. """
+    theta_nbins, z_nbins, z_width = zztheta.shape[1:]
+    z_band = z_width // 2
+    chord = is_chord(tree)
+    r = np.linspace(0., theta_max, theta_nbins + 1)[1:]
+    if chord:
+        r = theta2chord(r)
+
+    def split(catalog, iz):
+        """ coordinates of the points of each z bin """
+        points = to_unit(catalog) if chord else catalog[:, :2]
+        order = np.argsort(iz, kind='stable')
+        bounds = np.searchsorted(iz[order], np.arange(z_nbins + 1))
+        return [points[order[bounds[k]:bounds[k + 1]]]
+                for k in range(z_nbins)]
+
+    iz_pair = (z_nbins * (pair_catalog[start:end, 2]-z_min)
+               / (z_max - z_min)).astype(int)
+    iz_tree = _full_index(tree_catalog[:, 2], z_min, z_max, z_nbins)
+    pair_bins = split(pair_catalog[start:end], iz_pair)
+    halves = lhistogram.halves(zztheta)
+    halves[0][...] = np.nan
     if same:
-        zztheta = zztheta / 2.
-    return zztheta
+        # pairs with a point above the range, then pairs within the range
+        tree_bins = split(tree_catalog[end:], iz_tree[end:])
+        _count_cells(halves[1], pair_bins, tree_bins, r, z_band, chord)
+        _count_cells(halves[1], pair_bins, pair_bins, r, z_band, chord,
+                     upper=True)
+    else:
+        tree_bins = split(tree_catalog, iz_tree)
+        _count_cells(halves[1], pair_bins, tree_bins, r, z_band, chord)
+
+def _count_cells(hist, pair_bins, tree_bins, r, z_band, chord, upper=False):
+    """ add the pairs of pair z bin a and tree z bin b within z_band of each
+    other to hist[:, b, a - b + z_band]. If upper, pair_bins and tree_bins
+    hold the same points, and each unordered pair is counted once, in the
+    cell of its lower z bin. """
+    z_nbins = len(pair_bins)
+    record = lmetrics.current()
+    trees = [None] * z_nbins
+    for a in range(z_nbins):
+        if record is not None:
+            record.progress(a, z_nbins)
+        elif a % max(z_nbins // 10, 1) == 0:
+            print('- z bin: %d/%d' % (a, z_nbins))
+        n = len(pair_bins[a])
+        if n == 0:
+            continue
+        for b in range(a if upper else max(a - z_band, 0),
+                       min(a + z_band + 1, z_nbins)):
+            if len(tree_bins[b]) == 0:
+                continue
+            query_start = time.perf_counter()
+            if trees[b] is None:
+                # each tree z bin is built once
+                if chord:
+                    trees[b] = KDTree(tree_bins[b], leaf_size=40)
+                else:
+                    trees[b] = BallTree(tree_bins[b], leaf_size=40,
+                                        metric='haversine')
+            # a dual-tree walk only prunes if the pair bin spans several
+            # leaves
+            counts = trees[b].two_point_correlation(pair_bins[a], r=r,
+                                                    dualtree=(n > 40))
+            counts[1:] -= counts[:-1].copy()
+            if upper and b == a:
+                # both orders and the self-pairs at zero separation
+                counts[0] -= n
+                counts //= 2
+            lhistogram.add(hist[:, b, a - b + z_band], counts)
+            if record is not None:
+                record.add('queries', n)
+                record.add('pairs', int(counts.sum()))
+                record.add('query_time', time.perf_counter() - query_start)
+    if record is not None:
+        record.progress(z_nbins, z_nbins)
+
+def _band_flat(itheta, iz_tree, iz_pair, z_nbins, z_band):
+    """ flat index into a banded zztheta of shape
+    (theta_nbins, z_nbins, 2*z_band+1).
+
+    Returns:
+    --------
+    flat: array of int
+        flat index of each valid pair
+    valid: array of bool
+        True if both z bins are in range and within z_band of each other """
+
+    d = z_band + iz_pair - iz_tree
+    valid = ((iz_pair >= 0) & (iz_pair < z_nbins) & (iz_tree >= 0) &
+             (d >= 0) & (d <= 2*z_band))
+    flat = (itheta[valid] * z_nbins + iz_tree[valid]) * (2*z_band + 1)
+    return flat + d[valid], valid
+
+def _cell_list(catalog, theta_max):
+    """ bucket catalog into HEALPix pixels. healpy is only required here. """
+    from KITCAT.healpix import CellList
+    return CellList(catalog, theta_max)
+
+def _ftheta_dualtree(ftheta, pair_catalog, tree_catalog, tree,
+                     theta_max, theta_nbins):
+    """ fill f(theta) with a dual-tree walk """
+    walker = DualTree(pair_catalog, tree, theta_max, theta_nbins)
+    pair_w = pair_catalog[:, 2]
+    tree_w = tree_catalog[:, 2]
+    pair_sum = walker.node_sums(pair_w, side='pair')
+    tree_sum = walker.node_sums(tree_w, side='tree')
+
+    for kind, i, j, x in walker.walk():
+        if kind == 'nodes':
+            # all pairs of the node pair share the same theta bin
+            w = pair_sum[i] * tree_sum[j]
+            itheta = x
+        else:
+            itheta, keep = _bin_index(x, 0., theta_max, theta_nbins)
+            w = (pair_w[i] * tree_w[j])[keep]
+        ftheta += np.bincount(itheta, weights=w, minlength=theta_nbins)
+
+def _ztheta_dualtree(ztheta, pair_catalog, tree_catalog, tree, iz,
+                     theta_max, theta_nbins):
+    """ fill ztheta with a dual-tree walk """
+    z_nbins = ztheta.shape[2]
+    halves = lhistogram.halves(ztheta)
+    walker = DualTree(pair_catalog, tree, theta_max, theta_nbins)
+    pair_w = pair_catalog[:, 3]
+    tree_w = tree_catalog[:, 2]
+    ones = np.ones(pair_catalog.shape[0])
+    tree_sum = walker.node_sums(tree_w, side='tree')
+
+    for kind, i, j, x in walker.walk():
+        if kind == 'nodes':
+            # z histogram of the pair node times the weight of the tree node
+            w = tree_sum[j][:, None]
+            _add_rows(halves[1], x,
+                      walker.node_hist(i, iz, ones, z_nbins, side='pair') * w)
+            _add_rows(halves[0], x,
+                      walker.node_hist(i, iz, pair_w, z_nbins, side='pair') * w)
+            continue
+
+        itheta, keep = _bin_index(x, 0., theta_max, theta_nbins)
+        i, j = i[keep], j[keep]
+        valid = (iz[i] >= 0) & (iz[i] < z_nbins)
+        i, j, itheta = i[valid], j[valid], itheta[valid]
+        flat = itheta * z_nbins + iz[i]
+        size = theta_nbins * z_nbins
+
+        # fill unweighted histogram
+        w = tree_w[j]
+        lhistogram.add(halves[1], np.bincount(flat, weights=w, minlength=size)
+                       .reshape(theta_nbins, z_nbins))
+
+        # fill weighted histogram
+        w *= pair_w[i]
+        lhistogram.add(halves[0], np.bincount(flat, weights=w, minlength=size)
+                       .reshape(theta_nbins, z_nbins))
+
+def _zztheta_dualtree(zztheta, pair_catalog, tree_catalog, tree, iz_pair,
+                      iz_tree, theta_max, theta_nbins):
+    """ fill zztheta with a dual-tree walk """
+    z_nbins, z_width = zztheta.shape[2:]
+    halves = lhistogram.halves(zztheta)
+    z_band = z_width // 2
+    walker = DualTree(pair_catalog, tree, theta_max, theta_nbins)
+    pair_w = pair_catalog[:, 3]
+    tree_w = tree_catalog[:, 3]
+    pair_ones = np.ones(pair_catalog.shape[0])
+    tree_ones = np.ones(tree_catalog.shape[0])
+
+    # cells (l, d) of the band and the pair z bin m of each cell
+    l, d = np.indices((z_nbins, z_width)).reshape(2, -1)
+    m = l + d - z_band
+    inside = (m >= 0) & (m < z_nbins)
+    l, d, m = l[inside], d[inside], m[inside]
+    cells = l * z_width + d
+
+    for kind, i, j, x in walker.walk():
+        if kind == 'nodes':
+            # outer product of the z histograms of the two nodes
+            for itheta in np.unique(x):
+                sel = (x == itheta)
+                for k, (w1, w2) in enumerate([(pair_w, tree_w),
+                                              (pair_ones, tree_ones)]):
+                    hist_pair = walker.node_hist(i[sel], iz_pair, w1, z_nbins,
+                                                 side='pair')
+                    hist_tree = walker.node_hist(j[sel], iz_tree, w2, z_nbins,
+                                                 side='tree')
+                    zz = np.dot(hist_tree.T, hist_pair)
+                    lhistogram.add_at(halves[k][itheta].reshape(-1), cells,
+                                      zz[l, m])
+            continue
+
+        itheta, keep = _bin_index(x, 0., theta_max, theta_nbins)
+        i, j = i[keep], j[keep]
+        flat, valid = _band_flat(itheta, iz_tree[j], iz_pair[i], z_nbins,
+                                 z_band)
+        i, j = i[valid], j[valid]
+
+        # fill weighted and unweighted histogram
+        lhistogram.add_at(halves[0].reshape(-1), flat, pair_w[i] * tree_w[j])
+        lhistogram.add_at(halves[1].reshape(-1), flat, 1.)
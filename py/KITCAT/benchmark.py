@@ -0,0 +1,566 @@
+""" Module to benchmark the pair counting backends and the stages of the
+pipeline on synthetic survey catalogs """
+
+# Standard Python modules
+import io
+import os
+import json
+import time
+import contextlib
+import configparser
+
+# Python modules
+import numpy as np
+from astropy.table import Table
+
+from KITCAT import io as lio
+from KITCAT import analysis as lanalysis
+from KITCAT import bins as lbins
+from KITCAT import catalog as lcatalog
+from KITCAT import correlation as lcorrelation
+from KITCAT import cosmology as lcosmology
+from KITCAT import helper as lhelper
+
+# default footprint of the synthetic catalogs, in degrees and redshift
+FOOTPRINT = {'ra': (150., 190.), 'dec': (5., 25.), 'z': (0.43, 0.6)}
+
+# default binning of the synthetic catalogs
+NBINS = {'ra': 60, 'dec': 30, 'theta': 40, 'z': 60, 's': 20}
+
+# default relative drop of throughput reported as a regression
+THRESHOLD = 0.2
+
+# default relative tolerance of the histograms against a baseline
+RTOL = 1e-8
+
+# stages faster than this in seconds are too noisy for the throughput check
+MIN_SECONDS = 0.05
+
+# stages timed by the suite
+STAGES = ('catalog', 'to_rand', 'build_tree', 'ftheta', 'ztheta',
+          'zztheta', 'get_rr', 'get_dr', 'get_dd', 'pickle')
+
+def run_stage(stage, params, bins, backend, npoints=None, **kwargs):
+    """ run one combinatorial stage on the first npoints of the pair catalog
+
+    Parameters:
+    -----------
+    stage: str
+        'rr', 'dd', 'd1r2' or 'd2r1'
+    params: dict
+        stage entry of the preprocess output, with keys 'pair_catalog',
+        'tree_catalog' and 'tree'
+    bins: bins.Bins
+    backend: str
+    npoints: int (default=None)
+        number of pair catalog points. If None, use the full catalog.
+
+    Returns:
+    --------
+    hist: array
+        f(theta), ztheta or zztheta of the stage """
+
+    pair_catalog = params['pair_catalog'][:npoints]
+    args = dict(pair_catalog = pair_catalog,
+                tree_catalog = params['tree_catalog'],
+                tree         = params['tree'],
+                theta_max    = bins.max('theta'),
+                theta_nbins  = bins.num_bins('theta'),
+                backend      = backend)
+    args.update(kwargs)
+    if stage == 'rr':
+        return lanalysis.get_ftheta(**args)
+
+    args.update(z_min   = bins.min('z'),
+                z_max   = bins.max('z'),
+                z_nbins = bins.num_bins('z'))
+    if stage == 'dd':
+        return lanalysis.get_zztheta(z_band=bins.band, **args)
+    return lanalysis.get_ztheta(**args)
+
+def compare_backends(stage, params, bins, backends, npoints=None, repeat=1):
+    """ time a combinatorial stage with each backend and compare the results
+    to the first backend
+
+    Returns:
+    --------
+    results: list of dict
+        backend, best wall time, throughput in pair catalog points per
+        second, and maximum difference relative to the first backend """
+
+    n = params['pair_catalog'][:npoints].shape[0]
+    results = []
+    reference = None
+    for backend in backends:
+        best = np.inf
+        for _ in range(repeat):
+            start_time = time.time()
+            with contextlib.redirect_stdout(io.StringIO()):
+                hist = run_stage(stage, params, bins, backend, npoints)
+            best = min(best, time.time() - start_time)
+        hist = np.asarray(hist)
+        if reference is None:
+            reference = hist
+        scale = max(np.abs(reference).max(), 1e-300)
+        results.append({'backend': backend,
+                        'seconds': best,
+                        'points_per_sec': n / best,
+                        'max_rel_diff': np.abs(hist - reference).max() / scale})
+    return results
+
+def footprint_volume(footprint, cosmo):
+    """ return the comoving volume of a footprint in (Mpc/h)^3 """
+    r_min, r_max = cosmo.z2r(np.array(footprint['z']))
+    ra_min, ra_max = np.deg2rad(footprint['ra'])
+    dec_min, dec_max = np.deg2rad(footprint['dec'])
+    return ((r_max**3 - r_min**3) / 3. * (ra_max - ra_min) *
+            (np.sin(dec_max) - np.sin(dec_min)))
+
+def uniform_points(n, footprint, cosmo, rng):
+    """ return ra, dec (in degrees) and z of n points uniform in the
+    comoving volume of a footprint """
+    r_min, r_max = cosmo.z2r(np.array(footprint['z']))
+    sin_dec = np.sin(np.deg2rad(footprint['dec']))
+    ra = rng.uniform(footprint['ra'][0], footprint['ra'][1], n)
+    dec = np.rad2deg(np.arcsin(rng.uniform(sin_dec[0], sin_dec[1], n)))
+    r = np.cbrt(rng.uniform(r_min**3, r_max**3, n))
+    return ra, dec, cosmo.r2z(r)
+
+def thomas_points(n, footprint, cosmo, rng, n_children=10., sigma=5.):
+    """ return ra, dec (in degrees) and z of about n points of a Thomas
+    process. Parents are uniform in the comoving volume of the footprint
+    widened by 4 sigma, each has a Poisson number of children with a
+    Gaussian offset of sigma in each axis, and children outside the
+    footprint are dropped. The correlation function is thomas_xi.
+
+    Parameters:
+    -----------
+    n: int
+        expected number of points in the footprint
+    footprint: dict
+        (min, max) of 'ra', 'dec' in degrees and 'z'
+    cosmo: cosmology.Cosmology
+    rng: numpy.random.RandomState
+    n_children: float (default=10.)
+        mean number of children per parent
+    sigma: float (default=5.)
+        offset of the children in Mpc/h
+
+    Returns:
+    --------
+    ra, dec, z: array
+    density: float
+        number density of parents in (Mpc/h)^-3 """
+
+    # widen the footprint so that the process is stationary inside it
+    r_min, r_max = cosmo.z2r(np.array(footprint['z']))
+    margin = np.rad2deg(4. * sigma / r_min)
+    wide = {'ra': (footprint['ra'][0] - margin, footprint['ra'][1] + margin),
+            'dec': (max(footprint['dec'][0] - margin, -90.),
+                    min(footprint['dec'][1] + margin, 90.)),
+            'z': tuple(cosmo.r2z(np.array([max(r_min - 4. * sigma, 1.),
+                                           r_max + 4. * sigma])))}
+    density = n / n_children / footprint_volume(footprint, cosmo)
+    n_parents = rng.poisson(density * footprint_volume(wide, cosmo))
+
+    # parents and children in Cartesian coordinates
+    ra, dec, z = uniform_points(n_parents, wide, cosmo, rng)
+    ra, dec, r = np.deg2rad(ra), np.deg2rad(dec), cosmo.z2r(z)
+    parents = np.array([r * np.cos(dec) * np.cos(ra),
+                        r * np.cos(dec) * np.sin(ra),
+                        r * np.sin(dec)]).T
+    counts = rng.poisson(n_children, n_parents)
+    points = np.repeat(parents, counts, axis=0)
+    points += rng.normal(0., sigma, points.shape)
+
+    r = np.sqrt(np.sum(points**2, axis=1))
+    ra = np.rad2deg(np.arctan2(points[:, 1], points[:, 0])) % 360.
+    dec = np.rad2deg(np.arcsin(points[:, 2] / r))
+    keep = ((footprint['ra'][0] <= ra) & (ra <= footprint['ra'][1]) &
+            (footprint['dec'][0] <= dec) & (dec <= footprint['dec'][1]) &
+            (r_min <= r) & (r <= r_max))
+    return ra[keep], dec[keep], cosmo.r2z(r[keep]), density
+
+def thomas_xi(s, density, sigma=5.):
+    """ return the correlation function of a Thomas process averaged over
+    the volume of each separation bin
+
+    Parameters:
+    -----------
+    s: array of shape (n+1,)
+        separation bin edges in Mpc/h
+    density: float
+        number density of parents in (Mpc/h)^-3
+    sigma: float (default=5.)
+        offset of the children in Mpc/h
+
+    Returns:
+    --------
+    xi: array of shape (n,) """
+    r = np.linspace(s[:-1], s[1:], 65, axis=-1)
+    r = 0.5 * (r[:, 1:] + r[:, :-1])
+    xi = np.exp(-r**2 / (4. * sigma**2)) / (density *
+                                             (4. * np.pi * sigma**2)**1.5)
+    return np.sum(xi * r**2, axis=-1) / np.sum(r**2, axis=-1)
+
+def make_mock(dirname, n_galaxies, n_randoms, footprint=FOOTPRINT,
+              nbins=NBINS, s_max=100., clustered=False, n_children=10.,
+              sigma=5., seed=0):
+    """ write synthetic galaxy and random FITS catalogs and a config file
+    for an auto-correlation into dirname. Randoms are uniform in comoving
+    volume, galaxies are uniform too or a Thomas process (see
+    thomas_points). Weights are uniform in [0.8, 1.2] and do not depend on
+    position.
+
+    Parameters:
+    -----------
+    dirname: str
+    n_galaxies, n_randoms: int
+    footprint: dict (default=FOOTPRINT)
+        (min, max) of 'ra', 'dec' in degrees and 'z'
+    nbins: dict (default=NBINS)
+        number of bins of 'ra', 'dec', 'theta', 'z' and 's'
+    s_max: float (default=100.)
+        maximum separation in Mpc/h
+    clustered: bool (default=False)
+        if True, galaxies are a Thomas process
+    n_children, sigma: float
+        parameters of the Thomas process
+    seed: int (default=0)
+
+    Returns:
+    --------
+    config: str
+        path of the config file
+    truth: dict or None
+        'density' and 'sigma' of the Thomas process, None if not clustered
+    """
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    rng = np.random.RandomState(seed)
+    cosmo = lcosmology.Cosmology()
+
+    truth = None
+    if clustered:
+        ra, dec, z, density = thomas_points(n_galaxies, footprint, cosmo, rng,
+                                            n_children, sigma)
+        truth = {'density': density, 'sigma': sigma}
+    else:
+        ra, dec, z = uniform_points(n_galaxies, footprint, cosmo, rng)
+    paths = {}
+    for key, points in [('galaxy', (ra, dec, z)),
+                        ('random', uniform_points(n_randoms, footprint,
+                                                  cosmo, rng))]:
+        paths[key] = os.path.join(dirname, '%s.fits' % key)
+        Table({'ra': points[0], 'dec': points[1], 'z': points[2],
+               'weight': rng.uniform(0.8, 1.2, len(points[0]))}).write(
+                   paths[key], overwrite=True)
+
+    parser = configparser.RawConfigParser()
+    parser['GENERAL'] = {'x_correlation': 'False'}
+    for section, key in [('GALAXY_1', 'galaxy'), ('GALAXY_2', 'galaxy'),
+                         ('RANDOM_1', 'random'), ('RANDOM_2', 'random')]:
+        parser[section] = {'path': paths[key], 'weight': 'weight'}
+    parser['NBINS'] = dict({key: str(value) for key, value in nbins.items()},
+                           auto='False')
+    parser['LIMIT'] = {'unit': 'deg', 's_max': str(s_max),
+                       'ra_min': str(footprint['ra'][0]),
+                       'ra_max': str(footprint['ra'][1]),
+                       'dec_min': str(footprint['dec'][0]),
+                       'dec_max': str(footprint['dec'][1]),
+                       'z_min': str(footprint['z'][0]),
+                       'z_max': str(footprint['z'][1])}
+    parser['COSMOLOGY'] = {key: str(value)
+                           for key, value in cosmo.params.items()}
+    config = os.path.join(dirname, 'config.ini')
+    with open(config, 'w') as f:
+        parser.write(f)
+    return config, truth
+
+def _best_time(func, repeat):
+    """ return the result of func and its best wall time of repeat runs """
+    best = np.inf
+    for _ in range(repeat):
+        start_time = time.time()
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = func()
+        best = min(best, time.time() - start_time)
+    return result, best
+
+def time_pipeline(config, backend='balltree', repeat=1):
+    """ run every stage of an auto-correlation on a config and time it.
+    get_rr includes building the projection operators, which get_dr and
+    get_dd reuse.
+
+    Parameters:
+    -----------
+    config: str
+        path of the config file, e.g. from make_mock
+    backend: str (default='balltree')
+        pair counting backend
+    repeat: int (default=1)
+        number of repetitions per stage, the best time is kept
+
+    Returns:
+    --------
+    results: list of dict
+        stage, size and unit of the work, best wall time and throughput
+        in units per second, in the order of STAGES
+    output: dict of array
+        histograms, separation bin edges s, and xi and xi_err of shape
+        (2, n_s) of the first cosmology model """
+
+    limit_params = lio.parse_config(config, 'LIMIT')
+    nbins_params = lio.parse_config(config, 'NBINS')
+    cosmos_params = lio.parse_config(config, 'COSMOLOGY')
+    cosmos_list = [lcosmology.Cosmology(hubble0   = cosmos_params['hubble0'][i],
+                                        omega_m0  = cosmos_params['omega_m0'][i],
+                                        omega_de0 = cosmos_params['omega_de0'][i])
+                   for i in range(cosmos_params['n_cosmos'])]
+    with contextlib.redirect_stdout(io.StringIO()):
+        bins = lbins.Bins(limit_params = limit_params,
+                          nbins_params = nbins_params,
+                          min_cosmo    = lcosmology.min_cosmo(cosmos_list),
+                          max_cosmo    = lcosmology.max_cosmo(cosmos_list))
+
+    results = []
+    def add(stage, size, unit, seconds):
+        results.append({'stage': stage, 'size': size, 'unit': unit,
+                        'seconds': seconds, 'rate': size / seconds})
+
+    # catalogs
+    d_params = lio.parse_config(config, 'GALAXY_1')
+    r_params = lio.parse_config(config, 'RANDOM_1')
+    (d, r), seconds = _best_time(
+        lambda: (lcatalog.GalaxyCatalog(d_params, bins.limit),
+                 lcatalog.GalaxyCatalog(r_params, bins.limit)), repeat)
+    add('catalog', d.ngals + r.ngals, 'rows', seconds)
+
+    rand_kwargs = dict(
+        z_min       = bins.min('z'),
+        z_max       = bins.max('z'),
+        z_nbins     = bins.num_bins('z'),
+        ra_min      = bins.min('ra'),
+        ra_max      = bins.max('ra'),
+        ra_nbins    = bins.num_bins('ra'),
+        dec_min     = bins.min('dec'),
+        dec_max     = bins.max('dec'),
+        dec_nbins   = bins.num_bins('dec'))
+    rand, seconds = _best_time(lambda: r.to_rand(**rand_kwargs), repeat)
+    add('to_rand', r.ngals, 'rows', seconds)
+
+    (rand_tree, d_tree), seconds = _best_time(
+        lambda: (rand.build_tree(), d.build_tree(metric='haversine')), repeat)
+    add('build_tree', rand.ngals + d.ngals, 'points', seconds)
+
+    # combinatorial
+    stages = [('ftheta', 'rr', rand.get_catalog(), rand.get_catalog(),
+               rand_tree, {'same': True}),
+              ('ztheta', 'd1r2', d.get_catalog(), rand.get_catalog(),
+               rand_tree, {}),
+              ('zztheta', 'dd', d.get_catalog(), d.get_catalog(),
+               d_tree, {'same': True})]
+    output = {}
+    for name, stage, pair_catalog, tree_catalog, tree, kwargs in stages:
+        params = {'pair_catalog': pair_catalog,
+                  'tree_catalog': tree_catalog,
+                  'tree': tree}
+        output[name], seconds = _best_time(
+            lambda: run_stage(stage, params, bins, backend, **kwargs),
+            repeat)
+        add(name, len(pair_catalog), 'points', seconds)
+
+    # integration
+    helper = lhelper.CorrelationHelper()
+    helper.z1_distr = rand.z_distr
+    helper.z2_distr = rand.z_distr
+    helper.norm_dd = np.array(lcatalog.get_norm(d, d, same=True))
+    helper.norm_rr = np.array(lcatalog.get_norm(r, r, same=True))
+    helper.norm_d1r2 = np.array(lcatalog.get_norm(d, r, same=False))
+    helper.norm_d2r1 = helper.norm_d1r2
+    helper.ftheta = output['ftheta']
+    helper.ztheta_d1r2 = output['ztheta']
+    helper.zztheta = output['zztheta']
+    helper.bins = bins
+    helper.cosmos_list = cosmos_list
+
+    def get_rr():
+        helper._projections = {}
+        return helper.get_rr()
+    n_models = len(cosmos_list)
+    (rr, _), seconds = _best_time(get_rr, repeat)
+    add('get_rr', n_models, 'models', seconds)
+    (dr, _), seconds = _best_time(helper.get_dr, repeat)
+    add('get_dr', n_models, 'models', seconds)
+    (dd, _), seconds = _best_time(helper.get_dd, repeat)
+    add('get_dd', n_models, 'models', seconds)
+
+    xi, xi_err = lcorrelation.tpcf(
+        rr          = rr[0].copy(),
+        dd          = dd[0].copy(),
+        d1r2        = dr[0].copy(),
+        d2r1        = dr[0].copy(),
+        norm_rr     = helper.norm_rr,
+        norm_dd     = helper.norm_dd,
+        norm_d1r2   = helper.norm_d1r2,
+        norm_d2r1   = helper.norm_d2r1)
+    output['s'] = bins.bins('s')
+    output['xi'] = xi[..., 0]
+    output['xi_err'] = xi_err[..., 0]
+
+    # pickle I/O of the combine output
+    fname = os.path.join(os.path.dirname(config), 'helper.pkl')
+    def save_load():
+        lio.save(fname, helper)
+        return lio.load(fname)
+    _, seconds = _best_time(save_load, repeat)
+    add('pickle', os.path.getsize(fname) / 1024.**2, 'MB', seconds)
+    os.remove(fname)
+
+    return results, output
+
+def run_suite(dirname, sizes, theta_nbins=(NBINS['theta'],),
+              z_nbins=(NBINS['z'],), random_factor=10, clustered=False,
+              backend='balltree', repeat=1):
+    """ time the pipeline on synthetic catalogs of each size and binning
+
+    Parameters:
+    -----------
+    dirname: str
+        directory of the synthetic catalogs
+    sizes: list of int
+        number of galaxies
+    theta_nbins, z_nbins: list of int
+        number of theta and z bins
+    random_factor: int (default=10)
+        number of randoms per galaxy
+    clustered: bool (default=False)
+        if True, galaxies are a Thomas process
+    backend: str (default='balltree')
+    repeat: int (default=1)
+
+    Returns:
+    --------
+    rows: list of dict
+        results of time_pipeline with the case, number of galaxies and
+        bins of each row
+    outputs: dict
+        output of time_pipeline of each case
+    truths: dict
+        truth of make_mock of each case """
+
+    rows = []
+    outputs = {}
+    truths = {}
+    for n_galaxies in sizes:
+        for n_theta in theta_nbins:
+            for n_z in z_nbins:
+                case = 'n%d_theta%d_z%d' % (n_galaxies, n_theta, n_z)
+                if clustered:
+                    case += '_thomas'
+                print('- case: %s' % case, flush=True)
+                nbins = dict(NBINS, theta=n_theta, z=n_z)
+                config, truths[case] = make_mock(
+                    os.path.join(dirname, 'n%d' % n_galaxies), n_galaxies,
+                    random_factor * n_galaxies, nbins=nbins,
+                    clustered=clustered)
+                results, outputs[case] = time_pipeline(config, backend,
+                                                       repeat)
+                for result in results:
+                    rows.append(dict(result, case=case,
+                                     n_galaxies=n_galaxies,
+                                     theta_nbins=n_theta, z_nbins=n_z))
+    return rows, outputs, truths
+
+def save_baseline(fname, rows, outputs):
+    """ save the throughput and outputs of run_suite as a JSON baseline """
+    with open(fname, 'w') as f:
+        json.dump({'rows': rows,
+                   'outputs': {case: {key: np.asarray(value).tolist()
+                                      for key, value in output.items()}
+                               for case, output in outputs.items()}},
+                  f, indent=1)
+
+def check_baseline(rows, outputs, fname, threshold=THRESHOLD, rtol=RTOL,
+                   min_seconds=MIN_SECONDS):
+    """ compare the results of run_suite to a baseline saved by
+    save_baseline. Cases and stages missing from the baseline are skipped.
+
+    Parameters:
+    -----------
+    rows, outputs:
+        results of run_suite
+    fname: str
+        baseline file
+    threshold: float (default=THRESHOLD)
+        relative drop of throughput reported as a regression
+    rtol: float (default=RTOL)
+        tolerance of the outputs relative to the maximum of each array
+    min_seconds: float (default=MIN_SECONDS)
+        throughput of stages faster than min_seconds in the baseline is
+        not checked
+
+    Returns:
+    --------
+    failures: list of str """
+
+    with open(fname) as f:
+        baseline = json.load(f)
+    rates = {(row['case'], row['stage']): row['rate']
+             for row in baseline['rows'] if row['seconds'] >= min_seconds}
+
+    failures = []
+    for row in rows:
+        key = (row['case'], row['stage'])
+        if key not in rates:
+            continue
+        if row['rate'] < (1. - threshold) * rates[key]:
+            failures.append('%s %s: %.4g %s/s, baseline %.4g %s/s' %
+                            (row['case'], row['stage'], row['rate'],
+                             row['unit'], rates[key], row['unit']))
+
+    for case, output in outputs.items():
+        for key, value in output.items():
+            if key not in baseline['outputs'].get(case, {}):
+                continue
+            reference = np.array(baseline['outputs'][case][key])
+            value = np.asarray(value, dtype=float)
+            if value.shape != reference.shape:
+                failures.append('%s %s: shape %s, baseline %s' %
+                                (case, key, value.shape, reference.shape))
+                continue
+            scale = max(np.abs(reference).max(), 1e-300)
+            diff = np.abs(value - reference).max() / scale
+            if diff > rtol:
+                failures.append('%s %s: max rel diff %.3e' %
+                                (case, key, diff))
+    return failures
+
+def check_truth(output, truth, tolerance=0.5):
+    """ compare the unweighted xi of a clustered mock to thomas_xi. The
+    theta and z binning moves pairs between neighbouring s bins, so the
+    volume integral of xi over s < 5 sigma is compared rather than each bin.
+
+    Parameters:
+    -----------
+    output: dict
+        output of time_pipeline
+    truth: dict
+        truth of make_mock
+    tolerance: float (default=0.5)
+        largest relative difference of the integrals that passes
+
+    Returns:
+    --------
+    expected: array of shape (n_s,)
+        thomas_xi of each bin
+    ratio: float
+        integral of xi over the integral of thomas_xi
+    passed: bool """
+    s = output['s']
+    expected = thomas_xi(s, truth['density'], truth['sigma'])
+    volume = np.diff(s**3)
+    inner = s[1:] <= 5. * truth['sigma']
+    ratio = (np.sum(output['xi'][1][inner] * volume[inner]) /
+             np.sum(expected[inner] * volume[inner]))
+    return expected, ratio, bool(abs(ratio - 1.) <= tolerance)
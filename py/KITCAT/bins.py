@@ -56,6 +56,9 @@ class Bins(object):
             self.nbins['s'] = nbins_params['s']
             self._set_auto_nbins(min_cosmo)
 
+        # set up number of z bins off the diagonal for zztheta
+        self.band = self._find_band([min_cosmo, max_cosmo])
+
         # Print out number of bins
         self.print_info()
 
@@ -67,7 +70,14 @@ class Bins(object):
         for key, val in self.nbins.items():
             if val != other.nbins[key]:
                 return False
-        return True
+        return self.band == getattr(other, 'band', None)
+
+    def __setstate__(self, state):
+        """ Restore a pickled bins. Bins pickled before zztheta was banded
+        have no band, their zztheta holds every z bin. """
+        self.__dict__.update(state)
+        if 'band' not in state:
+            self.band = self.nbins['z'] - 1
 
     def _set_auto_nbins(self, cosmo):
         """ Set number of bins based on binwidths """
@@ -97,6 +107,16 @@ class Bins(object):
 
         return nbins, binw
 
+    def _find_band(self, cosmos):
+        """ Return the number of z bins on each side of the diagonal that can
+        hold pairs with sigma, pi or s below s_max """
+
+        # pi = cos(theta/2) |r1 - r2|, so |r1 - r2| can exceed s_max slightly
+        dels = self.max('s') / np.cos(self.max('theta') / 2.)
+        delz = max(cosmo.dels_to_delz(dels, self.max('z')) for cosmo in cosmos)
+        band = int(np.ceil(delz / self.binw('z'))) + 1
+        return min(band, self.num_bins('z') - 1)
+
     def find_zslice(self, index, total, model):
         """ Find zslice """
         diff = (self.max('z') - self.min('z')) / total
@@ -142,3 +162,4 @@ class Bins(object):
         print('- nbins:')
         for key in sorted(self.nbins.keys()):
             print(' + %6s: %4d' % (key, self.num_bins(key)))
+        print('- z band: %d' % self.band)
@@ -0,0 +1,152 @@
+""" Module for a content-addressed on-disk cache of integration geometry.
+Entries are directories of .npy files named by a hash of the parameters
+they were built from. The cache can be shared by several prefixes and
+users: entries are published by an atomic rename and evicted in least
+recently used order once the cache grows over its size limit. """
+
+# Standard Python modules
+import os
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+
+# version of the entry layout, part of every key
+CACHE_VERSION = 1
+
+# default location and size limit, overridden by KITCAT_CACHE_DIR and
+# KITCAT_CACHE_MAX_GB
+DEFAULT_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'KITCAT')
+DEFAULT_MAX_GB = 10.
+
+# name of the file whose mtime records the last use of an entry
+STAMP = 'last_used'
+
+def _jsonable(value):
+    """ convert tuples and numpy scalars into JSON types """
+    if isinstance(value, dict):
+        return {str(key): _jsonable(val) for key, val in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_jsonable(val) for val in value]
+    if hasattr(value, 'item'):
+        return value.item()
+    return value
+
+def get_key(**params):
+    """ return the hash of params, which must be made of dicts, lists,
+    tuples, strings and numbers """
+    params = _jsonable(dict(params, version=CACHE_VERSION))
+    text = json.dumps(params, sort_keys=True)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+def projection_key(bins, cosmo):
+    """ return the cache key of the projection operators of a cosmology """
+    return get_key(kind     = 'projection',
+                   limit    = bins.limit,
+                   nbins    = bins.nbins,
+                   cosmo    = {key: float(value)
+                               for key, value in cosmo.params.items()})
+
+
+class Cache(object):
+    """ Class to store and look up cache entries """
+
+    def __init__(self, root=None, max_gb=None):
+        """ constructor
+
+        Parameters:
+        -----------
+        root: str (default=None)
+            cache directory. If None, use KITCAT_CACHE_DIR or
+            ~/.cache/KITCAT.
+        max_gb: float (default=None)
+            size limit in GB. If None, use KITCAT_CACHE_MAX_GB or 10. """
+
+        if root is None:
+            root = os.environ.get('KITCAT_CACHE_DIR', DEFAULT_DIR)
+        if max_gb is None:
+            max_gb = float(os.environ.get('KITCAT_CACHE_MAX_GB',
+                                          DEFAULT_MAX_GB))
+        self.root = root
+        self.max_bytes = int(max_gb * 1024**3)
+        if not os.path.isdir(root):
+            os.makedirs(root, exist_ok=True)
+            try:
+                # group members share the cache
+                os.chmod(root, 0o2775)
+            except OSError:
+                pass
+
+    def get(self, key):
+        """ return the directory of entry key and mark it as used, or None
+        if it is not cached """
+        path = os.path.join(self.root, key)
+        if not os.path.isdir(path):
+            return None
+        try:
+            os.utime(os.path.join(path, STAMP))
+        except OSError:
+            # entry is being evicted
+            return None
+        return path
+
+    def put(self, key, writer):
+        """ create entry key with writer(dirname), which writes the files of
+        the entry into dirname, then evict old entries. Return the directory
+        of the entry. If another process published the entry first, keep
+        theirs. """
+        tmp_dir = tempfile.mkdtemp(prefix='.%s.' % key, dir=self.root)
+        try:
+            writer(tmp_dir)
+            open(os.path.join(tmp_dir, STAMP), 'w').close()
+            for dirpath, _, fnames in os.walk(tmp_dir):
+                os.chmod(dirpath, 0o775)
+                for fname in fnames:
+                    os.chmod(os.path.join(dirpath, fname), 0o664)
+            os.rename(tmp_dir, os.path.join(self.root, key))
+        except OSError:
+            if not os.path.isdir(os.path.join(self.root, key)):
+                raise
+        finally:
+            if os.path.isdir(tmp_dir):
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+        self.evict(keep=key)
+        return os.path.join(self.root, key)
+
+    def entries(self):
+        """ return (last used time, size in bytes, key) of every entry """
+        entries = []
+        for key in os.listdir(self.root):
+            path = os.path.join(self.root, key)
+            if key.startswith('.') or not os.path.isdir(path):
+                continue
+            try:
+                used = os.path.getmtime(os.path.join(path, STAMP))
+                size = sum(os.path.getsize(os.path.join(path, fname))
+                           for fname in os.listdir(path))
+            except OSError:
+                continue
+            entries.append((used, size, key))
+        return entries
+
+    def evict(self, keep=None):
+        """ remove least recently used entries, except keep, until the cache
+        fits in its size limit """
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, key in entries:
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            # rename first so that readers never see a partial entry.
+            # Memory-mapped files stay valid for processes using them.
+            trash = os.path.join(self.root, '.%s.evicted.%d.%d' %
+                                 (key, os.getpid(), int(time.time())))
+            try:
+                os.rename(os.path.join(self.root, key), trash)
+            except OSError:
+                continue
+            shutil.rmtree(trash, ignore_errors=True)
+            total -= size
@@ -2,9 +2,37 @@
 
 # Python modules
 import numpy as np
+from astropy.io import fits
 from astropy.table import Table
 from sklearn.neighbors import BallTree, KDTree
 
+# extensions of the files read through memory-mapped FITS access
+FITS_EXTENSIONS = ('.fits', '.fit', '.fts')
+
+# number of rows converted and cut at a time
+CHUNK_SIZE = 1000000
+
+def read_columns(path, names):
+    """ return the columns names of the table in path. Columns of FITS files
+    are memory-mapped, so rows are only read when they are accessed. Other
+    formats are read with astropy.table.Table.
+
+    Returns:
+    --------
+    hdul: astropy.io.fits.HDUList or None
+        open FITS file, to be closed once the columns are no longer used
+    columns: dict of array """
+    if not path.lower().endswith(FITS_EXTENSIONS):
+        table = Table.read(path)
+        return None, {name: np.asarray(table[name]) for name in names}
+
+    hdul = fits.open(path, memmap=True)
+    for hdu in hdul:
+        if isinstance(hdu, (fits.BinTableHDU, fits.TableHDU)):
+            return hdul, {name: hdu.data.field(name) for name in names}
+    hdul.close()
+    raise ValueError('no table found in %s' % path)
+
 def hist2point(hist, bins_x, bins_y, exclude_zeros=True):
     """ convert 2D histogram into a set of weighted data points.
         use bincenter as coordinate.
@@ -43,6 +71,56 @@ def hist2point(hist, bins_x, bins_y, exclude_zeros=True):
         return catalog[np.logical_not(zeros)]
     return catalog
 
+def to_unit(catalog):
+    """ convert (dec, ra) in the first two columns into unit vectors
+
+    Returns:
+    --------
+    unit: array of shape (n, 3) """
+    cos_dec = np.cos(catalog[:, 0])
+    return np.array([cos_dec * np.cos(catalog[:, 1]),
+                     cos_dec * np.sin(catalog[:, 1]),
+                     np.sin(catalog[:, 0])]).T
+
+def to_cartesian(catalog, cosmo):
+    """ convert (dec, ra, z, w) into comoving (x, y, z, w)
+
+    Parameters:
+    -----------
+    catalog: array of shape (n, 4)
+    cosmo: cosmology.Cosmology
+        Cosmology model to convert redshift to comoving distance
+
+    Returns:
+    --------
+    catalog: array of shape (n, 4) """
+    dec, ra, z, w = catalog.T
+    r = cosmo.z2r(z)
+    return np.array([r * np.cos(dec) * np.cos(ra),
+                     r * np.cos(dec) * np.sin(ra),
+                     r * np.sin(dec),
+                     w]).T
+
+def theta2chord(theta):
+    """ chord length between two points on the unit sphere separated by the
+    angle theta """
+    return 2. * np.sin(0.5 * theta)
+
+def is_chord(tree):
+    """ return True if tree is an angular tree on unit vectors, see
+    GalaxyCatalog.build_tree(metric='chord'), and False for a haversine tree
+    on (dec, ra) """
+    return np.asarray(tree.data).shape[1] == 3
+
+def angular_query(tree, catalog, theta, **kwargs):
+    """ query_radius of the (dec, ra) in the first two columns of catalog
+    within the angle theta, on a haversine or a chord tree. Distances are
+    returned in the units of the tree: angles or chord lengths. """
+    if is_chord(tree):
+        return tree.query_radius(to_unit(catalog), r=theta2chord(theta),
+                                 **kwargs)
+    return tree.query_radius(catalog[:, :2], r=theta, **kwargs)
+
 def get_norm(catalog1, catalog2, same=False):
     """ get normalization constant """
     n1 = catalog1.ngals
@@ -51,73 +129,133 @@ def get_norm(catalog1, catalog2, same=False):
     w2 = catalog2.get_catalog()[:, 3]
 
     u_norm = n1 * n2
-    w_norm = np.sum(w1) * np.sum(w2)
+    w_norm = np.sum(w1, dtype=np.float64) * np.sum(w2, dtype=np.float64)
 
     if same:
         u_norm = 0.5 * (u_norm - n1)
-        w_norm = 0.5 * (w_norm - np.sum(w1**2))
+        w_norm = 0.5 * (w_norm - np.sum(np.square(w1, dtype=np.float64)))
 
     return w_norm, u_norm
 
 class GalaxyCatalog(object):
     """ Class to handle galaxy catalogs. """
 
-    def __init__(self, catalog_params, limit_params):
-        """ initialize galaxy catalog
+    def __init__(self, catalog_params, limit_params, dtype=np.float64,
+                 chunk_size=CHUNK_SIZE, sort_z=False):
+        """ initialize galaxy catalog. Only the configured columns are read,
+        chunk_size rows at a time.
 
         Parameters:
         -----------
         catalog_params: dict
             path and parameters of .fits
-        limit_params: dict """
+        limit_params: dict
+        dtype: numpy dtype (default=np.float64)
+            dtype of the stored catalog, e.g. np.float32 to halve memory
+        chunk_size: int (default=CHUNK_SIZE)
+            number of rows converted and cut at a time
+        sort_z: bool (default=False)
+            if True, sort the rows by z so that z ranges can be cut with
+            z_slice """
 
         # import catalog from .fits file
         print('- import catalog from %s' %catalog_params['path'])
 
-        table = Table.read(catalog_params['path'])
-        dec = np.deg2rad(table[catalog_params['dec']])
-        ra = np.deg2rad(table[catalog_params['ra']])
-        z = table[catalog_params['z']]
-        try:
-            w = table[catalog_params['weight']]
-        except KeyError:
-            w_fkp = table[catalog_params['weight_fkp']]
-            w_noz = table[catalog_params['weight_noz']]
-            w_cp = table[catalog_params['weight_cp']]
-            w_sdc = table[catalog_params['weight_sdc']]
-            w = w_sdc*w_fkp*(w_noz+w_cp-1)
-        self.catalog = np.array([dec, ra, z, w]).T
+        if 'weight' in catalog_params:
+            weights = [catalog_params['weight']]
+        else:
+            weights = [catalog_params['weight_fkp'],
+                       catalog_params['weight_noz'],
+                       catalog_params['weight_cp'],
+                       catalog_params['weight_sdc']]
+        names = [catalog_params['dec'], catalog_params['ra'],
+                 catalog_params['z']] + weights
+        hdul, columns = read_columns(catalog_params['path'], names)
+
+        def get_chunk(start):
+            """ return dec, ra, z and w of rows start to start+chunk_size """
+            rows = slice(start, start + chunk_size)
+            dec = np.deg2rad(columns[names[0]][rows])
+            ra = np.deg2rad(columns[names[1]][rows])
+            z = columns[names[2]][rows]
+            if len(weights) == 1:
+                w = columns[weights[0]][rows]
+            else:
+                w_fkp, w_noz, w_cp, w_sdc = [columns[name][rows]
+                                             for name in weights]
+                w = w_sdc*w_fkp*(w_noz+w_cp-1)
+            return dec, ra, z, w
 
         # apply limit cut
         min_dec, max_dec = limit_params['dec']
         min_ra, max_ra = limit_params['ra']
         min_z, max_z = limit_params['z']
 
-        # Set boundaries
-        mask = ((min_dec <= dec) & (dec <= max_dec) &
-                (min_ra <= ra) & (ra <= max_ra) &
-                (min_z <= z) & (z <= max_z))
-
-        self.catalog = self.catalog[mask]
-        self.ngals = self.catalog.shape[0]
+        try:
+            # first pass: count the galaxies within the boundaries
+            n_rows = len(columns[names[0]])
+            mask = np.empty(n_rows, dtype=bool)
+            for start in range(0, n_rows, chunk_size):
+                dec, ra, z, _ = get_chunk(start)
+                mask[start:start + chunk_size] = (
+                    (min_dec <= dec) & (dec <= max_dec) &
+                    (min_ra <= ra) & (ra <= max_ra) &
+                    (min_z <= z) & (z <= max_z))
+            self.ngals = int(np.count_nonzero(mask))
+
+            # second pass: fill the columns of the catalog
+            self.catalog = np.empty((self.ngals, 4), dtype=dtype, order='F')
+            z = np.empty(self.ngals) if sort_z else None
+            index = 0
+            for start in range(0, n_rows, chunk_size):
+                keep = mask[start:start + chunk_size]
+                n_keep = np.count_nonzero(keep)
+                for i, column in enumerate(get_chunk(start)):
+                    self.catalog[index:index + n_keep, i] = column[keep]
+                    if i == 2 and sort_z:
+                        z[index:index + n_keep] = column[keep]
+                index += n_keep
+        finally:
+            del columns
+            if hdul is not None:
+                hdul.close()
+
+        # z is sorted in the precision of the file, so that z_slice cuts
+        # the same rows as the limits
+        self.z_sorted = None
+        if sort_z:
+            order = np.argsort(z, kind='stable')
+            self.catalog[...] = self.catalog[order]
+            self.z_sorted = z[order]
+
+        # handed out as read-only views
+        self.catalog.setflags(write=False)
+
+    def z_slice(self, z_min, z_max):
+        """ return the galaxies with z_min <= z <= z_max as a GalaxyCatalog
+        sharing the rows of this catalog, which must be sorted by z """
+        if getattr(self, 'z_sorted', None) is None:
+            raise ValueError('catalog is not sorted by z')
+        start = np.searchsorted(self.z_sorted, z_min, side='left')
+        end = np.searchsorted(self.z_sorted, z_max, side='right')
+        catalog = GalaxyCatalog.__new__(GalaxyCatalog)
+        catalog.catalog = self.catalog[start:end]
+        catalog.z_sorted = self.z_sorted[start:end]
+        catalog.ngals = end - start
+        return catalog
 
     def get_catalog(self, cosmo=None):
-        """ return catalog. convert z to d if cosmology is given """
-        catalog = np.copy(self.catalog)
-        if cosmo is not None:
-            catalog[:, 2] = cosmo.z2r(catalog[:, 2])
+        """ return catalog. convert z to d if cosmology is given. Without
+        cosmology, the catalog is a read-only view, not a copy. """
+        if cosmo is None:
+            return self.catalog
+        catalog = np.array(self.catalog)
+        catalog[:, 2] = cosmo.z2r(catalog[:, 2])
         return catalog
 
     def to_cartesian(self, cosmo):
         """ return galaxy catalog in Cartesian coordinates"""
-
-        dec, ra, z, w = np.copy(self.catalog).T
-        r = cosmo.z2r(z)
-        catalog = np.array([r * np.cos(dec) * np.cos(ra),
-                            r * np.cos(dec) * np.sin(ra),
-                            r * np.sin(dec),
-                            w]).T
-        return catalog
+        return to_cartesian(self.catalog, cosmo)
 
     def to_rand(
         self,
@@ -130,6 +268,7 @@ class GalaxyCatalog(object):
         dec_min     = None,
         dec_max     = None,
         dec_nbins   = None,
+        nside       = None,
         ):
 
         """ convert into RandomCatalog
@@ -138,6 +277,10 @@ class GalaxyCatalog(object):
         -----------
         z_min, z_max, ra_min, ra_max, dec_min, dec_max: float
         z_nbins, ra_nbins, dec_nbins: int
+        nside: int (default=None)
+            if given, count the angular distribution in equal-area NESTED
+            HEALPix pixels of this resolution instead of the dec x ra grid.
+            Only non-empty pixels are kept. Requires healpy.
 
         Returns:
         --------
@@ -158,25 +301,34 @@ class GalaxyCatalog(object):
             normed      = True)
 
         # calculate angular distribution
-        angular_distr, bins_dec, bins_ra = self.angular_distr(
-            ra_min      = ra_min,
-            ra_max      = ra_max,
-            ra_nbins    = ra_nbins,
-            dec_min     = dec_min,
-            dec_max     = dec_max,
-            dec_nbins   = dec_nbins,
-            weighted    = False,
-            normed      = False)
+        if nside is not None:
+            # healpy is only required here
+            from KITCAT.healpix import pixel_distr
+            points = pixel_distr(self.catalog, nside)
+            bins_dec = bins_ra = None
+        else:
+            angular_distr, bins_dec, bins_ra = self.angular_distr(
+                ra_min      = ra_min,
+                ra_max      = ra_max,
+                ra_nbins    = ra_nbins,
+                dec_min     = dec_min,
+                dec_max     = dec_max,
+                dec_nbins   = dec_nbins,
+                weighted    = False,
+                normed      = False)
+            points = hist2point(angular_distr, bins_dec, bins_ra)
 
         # Set up DistrCatalog attributes
         w = self.catalog[:, 3]
 
         rand = RandomCatalog()
         rand.z_distr = np.array([z_distr_w, z_distr_uw])
-        rand.angular_distr = hist2point(angular_distr, bins_dec, bins_ra)
+        rand.angular_distr = points
+        rand.angular_distr.setflags(write=False)
         rand.bins_z = bins_z
         rand.bins_dec = bins_dec
         rand.bins_ra = bins_ra
+        rand.nside = nside
         rand.ngals = rand.angular_distr.shape[0]
 
         return rand
@@ -209,14 +361,14 @@ class GalaxyCatalog(object):
             binsedge of distribution """
 
         w = self.catalog[:, 3] if weighted else None
-        z = np.copy(self.catalog[:, 2])
+        z = self.catalog[:, 2]
         norm = 1.*self.ngals if normed else 1.
 
         # convert z to d
         if cosmo is not None:
             z_max = cosmo.z2r(z_max)
             z_min = cosmo.z2r(z_min)
-            z = model.z2r(z)
+            z = cosmo.z2r(z)
 
         z_distr, bins_z = np.histogram(z,
                                        bins     = z_nbins,
@@ -255,7 +407,7 @@ class GalaxyCatalog(object):
         bins_dec: array of shape (ra_nbins, )
             binsedge of distribution """
 
-        dec, ra, _, w = np.copy(self.catalog).T
+        dec, ra, _, w = self.catalog.T
         w = w if weighted else None
         norm = 1.*self.ngals if normed else 1.
 
@@ -274,8 +426,11 @@ class GalaxyCatalog(object):
         Parameters:
         ----------
         metric: str
-            Metric must be either 'haversine' or 'euclidean'.
+            Metric must be 'haversine', 'chord' or 'euclidean'.
             If metric is 'haversine', build a tree from dec and ra.
+            If metric is 'chord', build a Euclidean KD-tree from the unit
+            vectors of dec and ra. Angular separations are then compared
+            as chord lengths, without trigonometry per distance.
             If metric is 'euclidean', build a tree from x, y, z.
         cosmo: cosmology.Cosmology (default=None)
             Cosmology model to convert redshift to comoving.
@@ -294,8 +449,13 @@ class GalaxyCatalog(object):
             catalog = self.catalog[:, :2]
             tree = BallTree(catalog, leaf_size=leaf, metric=metric)
 
+        elif metric == 'chord':
+            catalog = to_unit(self.catalog)
+            tree = KDTree(catalog, leaf_size=leaf, metric='euclidean')
+
         else:
-            raise ValueError('metric must be "haversin" or "euclidean".')
+            raise ValueError('metric must be "haversine", "chord" or '
+                             '"euclidean".')
         print("- building tree: %s " % metric)
 
         # return KD-tree and the catalog
@@ -317,12 +477,13 @@ class RandomCatalog(object):
         self.bins_z = None
         self.bins_ra = None
         self.bins_dec = None
+        self.nside = None
 
     def get_catalog(self, cosmo=None):
-        """ return angular distribution """
-        return np.copy(self.angular_distr)
+        """ return angular distribution. It is read-only, not a copy. """
+        return self.angular_distr
 
-    def build_tree(self, leaf=40):
+    def build_tree(self, leaf=40, metric='haversine'):
         """ build a balltree from angular distributions using haversine.
 
         Parameters:
@@ -332,12 +493,20 @@ class RandomCatalog(object):
             node is guaranteed to satisfy leaf_size <= n_points <= 2*leaf_size,
             except in the case that n_samples < leaf_size.
             More details can be found at sklearn.neightbors.BallTree.
+        metric: str (default='haversine')
+            'haversine' for a balltree of dec and ra, 'chord' for a
+            Euclidean KD-tree of the unit vectors
 
         Returns:
         --------
         balltree """
 
-        print("- building tree: haversine")
+        print("- building tree: %s" % metric)
+        if metric == 'chord':
+            return KDTree(to_unit(self.angular_distr), leaf_size=leaf,
+                          metric='euclidean')
+        if metric != 'haversine':
+            raise ValueError('metric must be "haversine" or "chord".')
         balltree = BallTree(self.angular_distr[:, :2],
                             leaf_size=leaf,
                             metric='haversine')
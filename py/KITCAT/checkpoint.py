@@ -0,0 +1,222 @@
+""" Module to checkpoint and resume the combinatorial step """
+
+# Standard Python modules
+import os
+import time
+
+# Python modules
+import numpy as np
+
+from KITCAT import io as lio
+from KITCAT import metrics as lmetrics
+from KITCAT import parallel as lparallel
+from KITCAT.helper import JobHelper, balance_ranges
+
+class Checkpoint(object):
+    """ Class to hold the partial histograms of a job and save them at a
+    fixed wall time interval """
+
+    def __init__(self, fname, interval, job_helper, bins, backend,
+                 weighted=True, balance=False, rr_backend=None,
+                 dtypes=('float64', 'float64')):
+        """ constructor
+
+        Parameters:
+        -----------
+        fname: str
+            checkpoint file
+        interval: float
+            minimum wall time in seconds between two checkpoints
+        job_helper: helper.JobHelper
+        bins: bins.Bins
+        backend: str
+        weighted: bool (default=True)
+            False if only the unweighted DD pairs are counted
+        balance: bool (default=False)
+            True if job ranges and segments are balanced by estimated cost
+        rr_backend: str (default=None)
+            backend of f(theta), if not backend
+        dtypes: tuple of str (default=('float64', 'float64'))
+            dtypes of the weighted and unweighted histograms """
+
+        self.fname = fname
+        self.interval = interval
+        self.last_save = time.time()
+        self.state = {
+            'job': (job_helper.current_job, job_helper.total_jobs),
+            'bins': bins,
+            'backend': backend,
+            'weighted': weighted,
+            'balance': balance,
+            'rr_backend': rr_backend,
+            'dtypes': tuple(dtypes),
+            'ranges': {},
+            'stage': None,
+            'index': None,
+            'hist': None,
+            'done': {},
+            'time': {},
+            }
+
+    def load(self):
+        """ load the checkpoint file if it exists. Return True if loaded.
+        Raise ValueError if it was written by a different job, or if it does
+        not record the index ranges of its stages. """
+        if not os.path.exists(self.fname):
+            return False
+        state = lio.load(self.fname)
+        # checkpoints without 'weighted' were written by weighted runs, and
+        # without 'dtypes' by float64 runs
+        state.setdefault('weighted', True)
+        state.setdefault('dtypes', ('float64', 'float64'))
+        for key in ('job', 'bins', 'backend', 'weighted', 'balance',
+                    'rr_backend', 'dtypes', 'ranges'):
+            if key not in state:
+                raise ValueError('checkpoint %s does not record %s, rerun '
+                                 'without --resume' % (self.fname, key))
+            if key != 'ranges' and not state[key] == self.state[key]:
+                raise ValueError('checkpoint %s does not match %s' %
+                                 (self.fname, key))
+        self.state = state
+        return True
+
+    def check_range(self, stage, start, end):
+        """ record the index range [start, end) of stage. Raise ValueError if
+        the checkpoint holds the stage for another range. """
+        saved = self.state['ranges'].setdefault(stage, (int(start), int(end)))
+        if saved != (start, end):
+            raise ValueError('checkpoint %s holds %s for the index range '
+                             '[%d, %d), this job has [%d, %d)' %
+                             ((self.fname, stage) + saved + (start, end)))
+
+    def update(self, stage, index, hist, elapsed, force=False):
+        """ record that stage is done up to index (exclusive) and save if the
+        interval has passed since the last save """
+        self.state['stage'] = stage
+        self.state['index'] = index
+        self.state['hist'] = hist
+        self.state['time'][stage] = elapsed
+        if force or time.time() - self.last_save >= self.interval:
+            self.save()
+
+    def finish(self, stage, hist, elapsed):
+        """ record a completed stage and save """
+        self.state['done'][stage] = hist
+        self.update(stage, None, None, elapsed, force=True)
+
+    def save(self):
+        """ write the checkpoint atomically """
+        lio.save(self.fname, self.state)
+        self.last_save = time.time()
+        print('- checkpoint: %s at index %s' % (self.state['stage'],
+                                                self.state['index']))
+
+    def remove(self):
+        """ remove the checkpoint file """
+        if os.path.exists(self.fname):
+            os.remove(self.fname)
+
+def run_checkpointed(preprocess_params, bins, checkpoint, job_helper=None,
+                     nsegments=100, chunk_size=1000, backend='balltree',
+                     costs=None, metrics=None, rr_backend=None,
+                     weighted=True):
+    """ calculate f(theta), ztheta and zztheta in segments, updating the
+    checkpoint after each segment. Stages and segments already in the
+    checkpoint are skipped. ztheta and zztheta are accumulated in the dtypes
+    of the checkpoint.
+
+    Parameters:
+    -----------
+    preprocess_params: dict
+        preprocess output
+    bins: bins.Bins
+    checkpoint: Checkpoint
+    job_helper: helper.JobHelper (default=None)
+    nsegments: int (default=100)
+        number of segments each stage is split into
+    chunk_size: int
+    backend: str
+    costs: dict (default=None)
+        per-point cost of the pair catalog of each stage. If given, job
+        ranges and segments hold equal predicted cost.
+    metrics: metrics.Metrics (default=None)
+        if given, record the stages calculated by this run
+    rr_backend: str (default=None)
+        backend of f(theta). If None, use backend.
+    weighted: bool (default=True)
+        if False, only count the unweighted DD pairs
+
+    Returns:
+    --------
+    results: dict
+        'rr', 'd1r2', 'd2r1' and 'dd' histograms (None if the stage is not
+        used) and 'time', the wall time of each stage """
+
+    if job_helper is None:
+        job_helper = JobHelper(1)
+        job_helper.set_current_job(0, verbose=False)
+    if costs is None:
+        costs = {}
+    same = (preprocess_params['d2r1'] is None)
+    state = checkpoint.state
+
+    results = {'time': state['time']}
+    for key in lparallel.STAGES:
+        params = preprocess_params[key]
+        if params is None:
+            results[key] = None
+            continue
+
+        # index range of the job, which must match the checkpointed one
+        size = params['pair_catalog'].shape[0]
+        cost = costs.get(key)
+        job_helper.set_cost(cost)
+        start, end = job_helper.get_index_range(size)
+        checkpoint.check_range(key, start, end)
+        if key in state['done']:
+            print('')
+            print('%s loaded from checkpoint' % key)
+            results[key] = state['done'][key]
+            continue
+
+        # split the index range of the job into segments
+        if cost is None:
+            cost = np.ones(size)
+        edges = balance_ranges(cost, nsegments, start, end)
+
+        # resume from the last checkpointed index
+        hist = None
+        elapsed = 0.
+        if state['stage'] == key and state['index'] is not None:
+            hist = state['hist']
+            elapsed = state['time'][key]
+            edges = np.concatenate([[state['index']],
+                                    edges[edges > state['index']]])
+            print('')
+            print('resume %s from index %d' % (key, state['index']))
+        edges = np.unique(edges)
+
+        kwargs = lparallel.get_stage_kwargs(key, bins, same, chunk_size,
+                                            backend, rr_backend, weighted,
+                                            *state['dtypes'])
+        with lmetrics.stage(metrics, key):
+            for i in range(len(edges) - 1):
+                start_time = time.time()
+                segment = lparallel.run_range(key, params, edges[i],
+                                              edges[i + 1], **kwargs)
+                if hist is None:
+                    hist = segment
+                else:
+                    hist += segment
+                elapsed += time.time() - start_time
+                checkpoint.update(key, edges[i + 1], hist, elapsed)
+
+        # an empty range still needs an empty histogram
+        if hist is None:
+            hist = lparallel.get_stage_zeros(key, bins, kwargs)
+        checkpoint.finish(key, hist, elapsed)
+        results[key] = hist
+        print("--- %f seconds ---" % elapsed)
+    job_helper.set_cost(None)
+
+    return results
@@ -0,0 +1,219 @@
+""" Module to combine the outputs of the combinatorial jobs """
+
+# Standard Python modules
+import os
+import re
+import glob
+import queue
+import shutil
+import threading
+import multiprocessing as mp
+
+# Python modules
+import numpy as np
+
+from KITCAT import io as lio
+from KITCAT import histogram as lhistogram
+
+# histograms summed over the jobs
+FIELDS = ('ftheta', 'ztheta_d1r2', 'ztheta_d2r1', 'zztheta')
+
+def find_jobs(prefix, kind='divide'):
+    """ return the PREFIX_KIND_IJOB-NJOB.pkl files of prefix sorted by job
+    index. Raise ValueError if a job is missing or if the files were written
+    with different numbers of jobs. """
+
+    pattern = re.compile(r'_%s_(\d+)-(\d+)\.pkl$' % kind)
+    jobs = {}
+    for fname in glob.glob('%s_%s_*.pkl' % (prefix, kind)):
+        match = pattern.search(fname)
+        if match is None:
+            continue
+        ijob, njob = int(match.group(1)), int(match.group(2))
+        jobs.setdefault(njob, {})[ijob] = fname
+
+    if len(jobs) == 0:
+        raise ValueError('no %s files found for %s' % (kind, prefix))
+    if len(jobs) > 1:
+        raise ValueError('%s files of different total jobs: %s' %
+                         (kind, sorted(jobs.keys())))
+    njob, files = jobs.popitem()
+    missing = sorted(set(range(njob)) - set(files.keys()))
+    if missing:
+        raise ValueError('missing job index: %s' % missing)
+    return [files[i] for i in range(njob)]
+
+def prefetch(fnames, depth=2):
+    """ yield (fname, object) of the pickles in fnames. A background thread
+    loads up to depth files ahead of the consumer. """
+
+    loaded = queue.Queue(maxsize=depth)
+
+    def reader():
+        try:
+            for fname in fnames:
+                loaded.put((fname, lio.load(fname)))
+        except Exception as error:
+            loaded.put((None, error))
+            return
+        loaded.put(None)
+
+    thread = threading.Thread(target=reader, daemon=True)
+    thread.start()
+    while True:
+        item = loaded.get()
+        if item is None:
+            break
+        if item[0] is None:
+            raise item[1]
+        yield item
+    thread.join()
+
+def reduce_files(fnames, depth=2, out_dir=None):
+    """ sum the histograms of the helpers in fnames.
+
+    Parameters:
+    -----------
+    fnames: list of str
+    depth: int (default=2)
+        number of files loaded ahead in the background
+    out_dir: str (default=None)
+        if given, accumulate into memory-mapped .npy files in out_dir,
+        created from the shapes of the first file. Each file is added one
+        field at a time, and each field is released once it is added.
+
+    Returns:
+    --------
+    helper: helper.CorrelationHelper
+        helper of the first file holding the summed histograms. The bins
+        and cosmologies are taken from the first file that has them. """
+
+    helper = None
+    hists = None
+    for fname, other in prefetch(fnames, depth):
+        print('- %s' % fname)
+        if helper is None:
+            # the first helper holds the output
+            helper = other
+            if out_dir is None:
+                continue
+            hists = _open_memmaps(helper, out_dir)
+        else:
+            if helper.bins is None:
+                helper.bins = other.bins
+            elif other.bins is not None and not helper.bins == other.bins:
+                raise ValueError('bins of %s do not match' % fname)
+            if helper.cosmos_list is None:
+                helper.cosmos_list = other.cosmos_list
+            if hists is None:
+                helper.add(other)
+                continue
+        _add_fields(hists, other, fname)
+
+    if hists is not None:
+        for field, hist in hists.items():
+            setattr(helper, field, hist)
+    return helper
+
+def _memmap(fname, shape, dtype):
+    """ return a zero-filled memory-mapped .npy file """
+    return np.lib.format.open_memmap(fname, mode='w+', dtype=dtype,
+                                     shape=shape)
+
+def _open_memmaps(helper, out_dir):
+    """ return memory-mapped .npy files in out_dir with the shapes and dtypes
+    of the histograms of helper """
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    hists = {}
+    for field in FIELDS:
+        array = getattr(helper, field)
+        if array is None:
+            continue
+        fname = os.path.join(out_dir, '%s.npy' % field)
+        if isinstance(array, lhistogram.Histogram):
+            # one file per half, each with its own dtype
+            halves = [_memmap(fname.replace('.npy', '_%d.npy' % j),
+                              half.shape, half.dtype)
+                      for j, half in enumerate(array.halves)]
+            hists[field] = lhistogram.Histogram(halves[0], halves[1],
+                                                array.scale)
+        else:
+            hists[field] = _memmap(fname, array.shape, array.dtype)
+    return hists
+
+def _add_fields(hists, helper, fname):
+    """ add the histograms of helper into the memory-mapped hists one field
+    at a time. Each field of helper is released once it is added. """
+    for field, hist in hists.items():
+        array = getattr(helper, field)
+        if array is None or array.shape != hist.shape:
+            raise ValueError('%s of %s does not match' % (field, fname))
+        setattr(helper, field, None)
+        hist += array
+        del array
+        if isinstance(hist, lhistogram.Histogram):
+            for half in hist.halves:
+                half.flush()
+        else:
+            hist.flush()
+
+def _from_memmap(helper):
+    """ replace the memory-mapped histograms of helper by plain array views,
+    which are pickled as arrays """
+    for field in FIELDS:
+        array = getattr(helper, field)
+        if isinstance(array, lhistogram.Histogram):
+            for j in range(2):
+                array.halves[j] = array.halves[j].view(np.ndarray)
+        elif isinstance(array, np.memmap):
+            setattr(helper, field, array.view(np.ndarray))
+
+def _reduce_group(task):
+    """ reduce a group of files into a partial pickle """
+    fnames, fname, depth = task
+    lio.save(fname, reduce_files(fnames, depth))
+    return fname
+
+def combine(prefix, workers=1, depth=2, memmap=False):
+    """ combine the divide files of prefix and save the result to
+    PREFIX_combine.pkl.
+
+    Parameters:
+    -----------
+    prefix: str
+    workers: int (default=1)
+        number of processes. If more than 1, the jobs are split into groups
+        that are reduced in parallel, then the partial sums are reduced.
+    depth: int (default=2)
+        number of files loaded ahead in the background
+    memmap: bool (default=False)
+        if True, accumulate into memory-mapped files in PREFIX_combine_tmp
+        instead of memory """
+
+    fnames = find_jobs(prefix)
+    print('- number of jobs: %d' % len(fnames))
+    tmp_dir = '%s_combine_tmp' % prefix
+    out_dir = tmp_dir if memmap else None
+
+    try:
+        workers = min(workers, len(fnames))
+        if workers > 1:
+            # first level of the reduction tree, one group per process
+            os.makedirs(tmp_dir, exist_ok=True)
+            edges = np.floor(np.linspace(0, len(fnames), workers + 1))
+            edges = edges.astype(int)
+            tasks = [(fnames[edges[i]:edges[i + 1]],
+                      os.path.join(tmp_dir, 'partial_%03d.pkl' % i), depth)
+                     for i in range(workers)]
+            with mp.Pool(workers) as pool:
+                fnames = pool.map(_reduce_group, tasks, chunksize=1)
+        helper = reduce_files(fnames, depth, out_dir)
+
+        # save before the memory-mapped files are removed
+        _from_memmap(helper)
+        lio.save('%s_combine.pkl' % prefix, helper)
+        del helper
+    finally:
+        if os.path.isdir(tmp_dir):
+            shutil.rmtree(tmp_dir)
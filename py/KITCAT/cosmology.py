@@ -9,19 +9,92 @@ two changes:
 2) Allow for the possibile definition of nonzero curvature (not by default).
 """
 
+# Standard Python modules
+import os
+import functools
+
 # Python modules
 import numpy
 from astropy import cosmology
+from astropy import constants
 from scipy import interpolate
 
+from KITCAT import cache as lcache
+
+# redshift range and step of the comoving table
+Z_MAX = 3.0
+Z_STEP = 0.00005
+
+# speed of light in km/s
+C_KMS = constants.c.to('km/s').value
+
+# optional cache.Cache shared by the comoving tables
+_table_cache = None
+
+def set_cache(cache):
+    """ store the comoving tables in cache (a cache.Cache), or only in memory
+    if None """
+    global _table_cache
+    _table_cache = cache
+    _get_table.cache_clear()
+    _get_interpolators.cache_clear()
+
+def comoving_table(hubble0, omega_m0, omega_de0, z_max=Z_MAX, step=Z_STEP):
+    """ return the (z, r) table of a LambdaCDM model without radiation,
+    r = c/H0 int_0^z dz'/E(z'), by cumulative trapezoidal integration of
+    1/E(z) on the table grid. Agrees with astropy comoving_distance to about
+    1e-10 relative for the default step. """
+    n = int(numpy.ceil(z_max/step))
+    z = numpy.linspace(0., z_max, n)
+    zp1 = 1. + z
+    omega_k0 = 1. - omega_m0 - omega_de0
+    inv_e = 1. / numpy.sqrt(
+        (omega_m0 * zp1 + omega_k0) * zp1**2 + omega_de0)
+
+    r = numpy.empty(n)
+    r[0] = 0.
+    numpy.cumsum(0.5 * numpy.diff(z) * (inv_e[1:] + inv_e[:-1]), out=r[1:])
+    hubble_distance = C_KMS / hubble0
+    r *= hubble_distance
+    return numpy.array([z, r]).T
+
+@functools.lru_cache(maxsize=64)
+def _get_table(hubble0, omega_m0, omega_de0):
+    """ return the comoving table and its interpolators, read from or
+    written to the table cache if set """
+    table = None
+    if _table_cache is not None:
+        key = lcache.get_key(kind      = 'comoving',
+                             hubble0   = hubble0,
+                             omega_m0  = omega_m0,
+                             omega_de0 = omega_de0,
+                             z_range   = (Z_MAX, Z_STEP))
+        path = _table_cache.get(key)
+        if path is not None:
+            table = numpy.load(os.path.join(path, 'table.npy'))
+        else:
+            table = comoving_table(hubble0, omega_m0, omega_de0)
+            _table_cache.put(key, lambda dirname: numpy.save(
+                os.path.join(dirname, 'table.npy'), table))
+    if table is None:
+        table = comoving_table(hubble0, omega_m0, omega_de0)
+    table.setflags(write=False)
+    return table
+
+@functools.lru_cache(maxsize=64)
+def _get_interpolators(hubble0, omega_m0, omega_de0):
+    """ return the z to r and r to z interpolators of a comoving table """
+    table = _get_table(hubble0, omega_m0, omega_de0)
+    return interpolate.pchip(*table.T), interpolate.pchip(*table[:, ::-1].T)
+
 def min_cosmo(cosmo_list, return_index=False):
     """ Find cosmology with the minimum value of Omega_m0 """
     min_value = 100000 # sentinel value
     min_cosmo = None
     index = None
     for i, cosmo in enumerate(cosmo_list):
-        if cosmo.model.Om0 <= min_value:
-            min_value = cosmo.model.Om0
+        if cosmo.params['omega_m0'] <= min_value:
+            min_value = cosmo.params['omega_m0']
             min_cosmo = cosmo
             index = i
     if return_index:
@@ -34,8 +107,8 @@ def max_cosmo(cosmo_list, return_index=False):
     max_cosmo = None
     index = None
     for i, cosmo in enumerate(cosmo_list):
-        if cosmo.model.Om0 >= max_value:
-            max_value = cosmo.model.Om0
+        if cosmo.params['omega_m0'] >= max_value:
+            max_value = cosmo.params['omega_m0']
             max_cosmo = cosmo
             index = i
     if return_index:
@@ -54,33 +127,46 @@ class Cosmology():
         is used. For now the cosmological parameters measured by Planck
         (P.A.R. Ade et al., Paper XIII, A&A 594:A13, 2016) are used.
         """
-        self.model = None
         self.comoving_table = None
         self.params = {'hubble0': hubble0,
                        'omega_m0': omega_m0,
                        'omega_de0': omega_de0}
         self.set_model(**self.params)
-        self._z2r = interpolate.pchip(*self.comoving_table.T)
-        self._r2z = interpolate.pchip(*self.comoving_table[:, ::-1].T)
+
+    @property
+    def model(self):
+        """ astropy cosmology model, created on first use """
+        # objects pickled by older versions hold the model as 'model'
+        if self.__dict__.get('_model') is None:
+            self._model = cosmology.LambdaCDM(
+                H0=self.params['hubble0'], Om0=self.params['omega_m0'],
+                Ode0=self.params['omega_de0'],)
+        return self._model
+
+    def _key(self):
+        """ parameters of the shared tables """
+        return (float(self.params['hubble0']), float(self.params['omega_m0']),
+                float(self.params['omega_de0']))
 
     def _set_comoving_table(self):
-        """ create redshift-comoving table """
-        # default parameters
-        z_min = 0.
-        z_max = 3.0
-        step = 0.00005
-
-        # set table
-        n =  int(numpy.ceil((z_max-z_min)/step))
-        z = numpy.linspace(z_min, z_max, n)
-        r = self.model.comoving_distance(z)
-        self.comoving_table = numpy.array([z, r]).T
+        """ create redshift-comoving table. Tables and interpolators are
+        shared by models with the same parameters, the interpolators are
+        created on first use. """
+        self.comoving_table = _get_table(*self._key())
+        self._z2r = None
+        self._r2z = None
+
+    def _set_interpolators(self):
+        """ set the interpolators if not already set """
+        if self.__dict__.get('_z2r') is None:
+            self._z2r, self._r2z = _get_interpolators(*self._key())
 
     def set_model(self, hubble0, omega_m0, omega_de0):
         """ read cosmologies from configuration file and reset table """
-        # Set astropy cosmology model
-        self.model = cosmology.LambdaCDM(
-            H0=hubble0, Om0=omega_m0, Ode0=omega_de0,)
+        self.params = {'hubble0': hubble0,
+                       'omega_m0': omega_m0,
+                       'omega_de0': omega_de0}
+        self._model = None
 
         # Set up redshift-comoving table
         self._set_comoving_table()
@@ -102,6 +188,7 @@ class Cosmology():
         if numpy.all(z < 0) or numpy.all(z > 3.0):
             raise ValueError('Redshift must be between 0 and 3.0')
 
+        self._set_interpolators()
         r = self._z2r(z)
         if isinstance(z, numpy.ndarray):
             return r
@@ -127,6 +214,7 @@ class Cosmology():
         if numpy.all(r < r_min) or numpy.all(r > r_max):
             raise ValueError('Comoving distance exceeds limit of table.')
 
+        self._set_interpolators()
         z = self._r2z(r)
         if isinstance(r, (list, tuple, numpy.ndarray)):
             return z
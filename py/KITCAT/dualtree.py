@@ -0,0 +1,187 @@
+""" Module for dual-tree angular pair counting """
+
+import numpy as np
+from sklearn.neighbors import BallTree
+
+from KITCAT.catalog import to_unit
+
+# margin (in radian) applied to node distance bounds before bulk counting
+TOLERANCE = 1e-10
+
+def haversine(x1, x2):
+    """ angular separation between arrays of (dec, ra) points, using the same
+    formula as sklearn haversine metric """
+    sin_dec = np.sin(0.5 * (x1[:, 0] - x2[:, 0]))
+    sin_ra = np.sin(0.5 * (x1[:, 1] - x2[:, 1]))
+    a = sin_dec**2 + np.cos(x1[:, 0]) * np.cos(x2[:, 0]) * sin_ra**2
+    return 2 * np.arcsin(np.sqrt(a))
+
+def expand_ranges(start, size):
+    """ return the concatenation of range(start[i], start[i] + size[i]) and
+    the position in the input of each element """
+    owner = np.repeat(np.arange(len(size)), size)
+    offset = np.cumsum(size) - size
+    return start[owner] + np.arange(owner.size) - offset[owner], owner
+
+
+class DualTree(object):
+    """ Class to walk a tree built on the pair catalog against the tree of the
+    target catalog. Node pairs whose separation falls entirely into one theta
+    bin are reported in bulk, leaf pairs are resolved point by point. """
+
+    def __init__(self, pair_catalog, tree, theta_max, theta_nbins,
+                 leaf=40, batch=100000):
+        """ initialize dual-tree walker
+
+        Parameters:
+        -----------
+        pair_catalog: array of shape (n, >=2)
+            (dec, ra) of the pair points in the first two columns
+        tree: sklearn.neighbors.BallTree
+            haversine tree of the target catalog
+        theta_max: float
+        theta_nbins: int
+        leaf: int (default=40)
+            leaf size of the pair catalog tree
+        batch: int (default=100000)
+            maximum number of node pairs or point pairs processed at once """
+
+        if np.asarray(tree.data).shape[1] != 2:
+            raise ValueError('dualtree backend requires a haversine tree')
+        self.pair_tree = BallTree(pair_catalog[:, :2], leaf_size=leaf,
+                                  metric='haversine')
+        self.tree = tree
+        self.theta_max = theta_max
+        self.theta_nbins = theta_nbins
+        self.batch = batch
+
+        # unit vectors of both catalogs in tree order
+        data, idx_array, _, _ = self.pair_tree.get_arrays()
+        self._pair_unit = to_unit(np.asarray(data)[idx_array])
+        data, idx_array, _, _ = self.tree.get_arrays()
+        self._tree_unit = to_unit(np.asarray(data)[idx_array])
+
+    def walk(self):
+        """ walk both trees and yield the node pairs and point pairs within
+        theta_max.
+
+        Yields:
+        -------
+        kind: str
+            'nodes' or 'points'
+        i, j: array of int
+            node indices ('nodes') or point indices ('points') of the pair
+            catalog tree and of the target tree
+        x: array
+            theta bin index of the node pairs ('nodes') or
+            angular separation of the point pairs ('points') """
+
+        _, p_idx, p_node, p_bounds = self.pair_tree.get_arrays()
+        _, t_idx, t_node, t_bounds = self.tree.get_arrays()
+        p_size = p_node['idx_end'] - p_node['idx_start']
+        t_size = t_node['idx_end'] - t_node['idx_start']
+        binw = self.theta_max / self.theta_nbins
+
+        stack = [(np.zeros(1, dtype=int), np.zeros(1, dtype=int))]
+        while stack:
+            a, b = stack.pop()
+            if a.size > self.batch:
+                stack.append((a[self.batch:], b[self.batch:]))
+                a, b = a[:self.batch], b[:self.batch]
+
+            # bound the separation of every point pair in the node pair
+            dist = haversine(p_bounds[0][a], t_bounds[0][b])
+            radius = p_node['radius'][a] + t_node['radius'][b]
+            d_min = np.maximum(dist - radius - TOLERANCE, 0.)
+            d_max = dist + radius + TOLERANCE
+
+            inside = d_min <= self.theta_max
+            a, b, d_min, d_max = a[inside], b[inside], d_min[inside], d_max[inside]
+
+            # node pairs that fall into a single theta bin
+            lo = (d_min / binw).astype(int)
+            hi = (d_max / binw).astype(int)
+            bulk = (d_max <= self.theta_max) & (lo == hi)
+            if bulk.any():
+                yield 'nodes', a[bulk], b[bulk], lo[bulk]
+            a, b = a[~bulk], b[~bulk]
+
+            # leaf pairs are resolved point by point
+            leaf_a = p_node['is_leaf'][a].astype(bool)
+            leaf_b = t_node['is_leaf'][b].astype(bool)
+            brute = leaf_a & leaf_b
+            if brute.any():
+                for out in self._brute(a[brute], b[brute], p_idx, p_node,
+                                       t_idx, t_node):
+                    yield out
+            a, b = a[~brute], b[~brute]
+            leaf_a, leaf_b = leaf_a[~brute], leaf_b[~brute]
+
+            # split the larger node of the remaining pairs
+            split_a = ~leaf_a & (leaf_b | (p_size[a] >= t_size[b]))
+            split_b = ~split_a
+            if split_a.any():
+                sa, sb = a[split_a], b[split_a]
+                stack.append((np.concatenate([2*sa + 1, 2*sa + 2]),
+                              np.concatenate([sb, sb])))
+            if split_b.any():
+                sa, sb = a[split_b], b[split_b]
+                stack.append((np.concatenate([sa, sa]),
+                              np.concatenate([2*sb + 1, 2*sb + 2])))
+
+    def _brute(self, a, b, p_idx, p_node, t_idx, t_node):
+        """ compute all point pairs of leaf pairs in batches """
+        n_a = p_node['idx_end'][a] - p_node['idx_start'][a]
+        n_b = t_node['idx_end'][b] - t_node['idx_start'][b]
+        n_pairs = n_a * n_b
+        chord_max = 2 * np.sin(0.5 * self.theta_max)
+
+        # group leaf pairs into batches of about self.batch point pairs
+        splits = np.flatnonzero(np.diff(np.cumsum(n_pairs) // self.batch)) + 1
+        for sl in np.split(np.arange(len(a)), splits):
+
+            # enumerate every (point in a, point in b) of each leaf pair
+            k, owner = expand_ranges(np.zeros(len(sl), dtype=int), n_pairs[sl])
+            n_b_owner = n_b[sl][owner]
+            pos_a = p_node['idx_start'][a[sl]][owner] + k // n_b_owner
+            pos_b = t_node['idx_start'][b[sl]][owner] + k % n_b_owner
+
+            # chord length is accurate at small separation
+            diff = self._pair_unit[pos_a] - self._tree_unit[pos_b]
+            chord = np.sqrt(np.einsum('ij,ij->i', diff, diff))
+            keep = chord <= chord_max * (1 + TOLERANCE)
+            pos_a, pos_b = pos_a[keep], pos_b[keep]
+            theta = 2 * np.arcsin(0.5 * chord[keep])
+
+            keep = theta <= self.theta_max
+            yield 'points', p_idx[pos_a[keep]], t_idx[pos_b[keep]], theta[keep]
+
+    def node_sums(self, weights, side='pair'):
+        """ sum of weights over the points of every node of the pair catalog
+        tree (side='pair') or of the target tree (side='tree') """
+        tree = self.pair_tree if side == 'pair' else self.tree
+        _, idx_array, node_data, _ = tree.get_arrays()
+        cumsum = np.concatenate([[0.], np.cumsum(weights[idx_array])])
+        return cumsum[node_data['idx_end']] - cumsum[node_data['idx_start']]
+
+    def node_hist(self, nodes, index, weights, nbins, side='pair'):
+        """ histogram of index weighted by weights over the points of each
+        node. Index outside of [0, nbins) are ignored.
+
+        Returns:
+        --------
+        hist: array of shape (len(nodes), nbins) """
+
+        tree = self.pair_tree if side == 'pair' else self.tree
+        _, idx_array, node_data, _ = tree.get_arrays()
+        start = node_data['idx_start'][nodes]
+        size = node_data['idx_end'][nodes] - start
+        pos, owner = expand_ranges(start, size)
+        points = idx_array[pos]
+
+        index = index[points]
+        valid = (index >= 0) & (index < nbins)
+        hist = np.bincount(owner[valid] * nbins + index[valid],
+                           weights   = weights[points][valid],
+                           minlength = len(nodes) * nbins)
+        return hist.reshape(len(nodes), nbins)
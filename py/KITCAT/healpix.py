@@ -0,0 +1,156 @@
+""" Module for HEALPix cell-linked-list angular pair counting """
+
+import numpy as np
+import healpy as hp
+
+from KITCAT.catalog import to_unit
+from KITCAT.dualtree import TOLERANCE, expand_ranges
+
+def get_nside(theta_max):
+    """ Return the highest NESTED resolution whose pixel size is at least
+    theta_max """
+    nside = 1
+    while nside < 2**29 and hp.nside2resol(2 * nside) >= theta_max:
+        nside *= 2
+    return nside
+
+def cells2nside(catalog, n_cells):
+    """ Return the highest NESTED resolution at which the points of catalog
+    fall into at most n_cells non-empty pixels. The pixels are found once at
+    the finest resolution. The parent of NESTED pixel p is p >> 2, so the
+    non-empty pixels of each coarser resolution follow from the sorted
+    pixels of the finer one without another pass over the catalog. """
+    order = 29
+    pixels = np.sort(ang2pix(2**order, catalog))
+    while True:
+        pixels = pixels[np.concatenate([[True], pixels[1:] != pixels[:-1]])]
+        if order == 0 or len(pixels) <= n_cells:
+            return 2**order
+        pixels >>= 2
+        order -= 1
+
+def ang2pix(nside, catalog):
+    """ NESTED pixel index of (dec, ra) in the first two columns """
+    return hp.ang2pix(nside, 0.5*np.pi - catalog[:, 0], catalog[:, 1],
+                      nest=True)
+
+def pixel_distr(catalog, nside):
+    """ count the points of catalog in NESTED HEALPix pixels
+
+    Parameters:
+    -----------
+    catalog: array of shape (n, >=2)
+        (dec, ra) of the points in the first two columns
+    nside: int
+        HEALPix resolution
+
+    Returns:
+    --------
+    distr: array of shape (n_pixels, 3)
+        (dec, ra) of the center of each non-empty pixel and its number of
+        points, in pixel order """
+    pixels, counts = np.unique(ang2pix(nside, catalog), return_counts=True)
+    colatitude, ra = hp.pix2ang(nside, pixels, nest=True)
+    return np.array([0.5*np.pi - colatitude, ra, counts]).T
+
+
+class CellList(object):
+    """ Class to bucket a catalog into NESTED HEALPix pixels. Neighbours of a
+    point are searched only in the pixels around the pixel of the point. """
+
+    def __init__(self, catalog, theta_max, nside=None, batch=1000000):
+        """ initialize cell list
+
+        Parameters:
+        -----------
+        catalog: array of shape (n, >=2)
+            (dec, ra) of the points in the first two columns
+        theta_max: float
+            maximum angular separation of the neighbour queries
+        nside: int (default=None)
+            HEALPix resolution. If None, pixels are sized to a quarter of
+            theta_max, which keeps the searched area within about twice the
+            area of the query disc.
+        batch: int (default=1000000)
+            maximum number of candidate pairs processed at once """
+
+        if nside is None:
+            nside = get_nside(theta_max / 4.)
+        self.nside = nside
+        self.theta_max = theta_max
+        self.batch = batch
+
+        # sort points by pixel so that each pixel is a contiguous list
+        pixel = ang2pix(nside, catalog)
+        self.index = np.argsort(pixel, kind='stable')
+        self.unit = to_unit(catalog[self.index])
+        self.pixels, self.start, self.count = np.unique(
+            pixel[self.index], return_index=True, return_counts=True)
+
+        # neighbour pixels of each queried pixel
+        self._candidates = {}
+
+    def candidates(self, pixel):
+        """ return positions (in pixel order) of the points in the pixels
+        within theta_max of pixel """
+        if pixel not in self._candidates:
+            vec = hp.pix2vec(self.nside, pixel, nest=True)
+            radius = self.theta_max + hp.max_pixrad(self.nside)
+            disc = hp.query_disc(self.nside, vec, radius,
+                                 inclusive=True, nest=True)
+            k = np.minimum(np.searchsorted(self.pixels, disc),
+                           len(self.pixels) - 1)
+            k = k[self.pixels[k] == disc]
+            self._candidates[pixel] = expand_ranges(self.start[k],
+                                                    self.count[k])[0]
+        return self._candidates[pixel]
+
+    def query_flat(self, catalog, r):
+        """ find all points within r (r <= theta_max) of each query point
+
+        Returns:
+        --------
+        owner: array of int
+            position in catalog of the query point for each neighbour
+        index: array of int
+            index of each neighbour in the bucketed catalog
+        dist: array of float
+            angular separation to each neighbour """
+
+        chord_max = 2 * np.sin(0.5 * r) * (1 + TOLERANCE)
+        pixel = ang2pix(self.nside, catalog)
+        unit = to_unit(catalog)
+
+        # group query points by pixel
+        order = np.argsort(pixel, kind='stable')
+        uniq, first = np.unique(pixel[order], return_index=True)
+
+        owner, index, dist = [], [], []
+        for pix, points in zip(uniq, np.split(order, first[1:])):
+            cand = self.candidates(pix)
+            if cand.size == 0:
+                continue
+            cand_unit = self.unit[cand]
+
+            # split the query points to bound the candidate pairs in memory
+            step = max(1, self.batch // cand.size)
+            for k in range(0, points.size, step):
+                sub = points[k:k + step]
+                diff = unit[sub][:, None, :] - cand_unit[None, :, :]
+                chord = np.sqrt(np.einsum('ijk,ijk->ij', diff, diff))
+                i, j = np.nonzero(chord <= chord_max)
+                theta = 2 * np.arcsin(0.5 * chord[i, j])
+                keep = theta <= r
+                owner.append(sub[i[keep]])
+                index.append(self.index[cand[j[keep]]])
+                dist.append(theta[keep])
+
+        if not owner:
+            return (np.zeros(0, dtype=int), np.zeros(0, dtype=int),
+                    np.zeros(0))
+
+        # group neighbours by query point
+        owner = np.concatenate(owner)
+        order = np.argsort(owner, kind='stable')
+        return (owner[order], np.concatenate(index)[order],
+                np.concatenate(dist)[order])
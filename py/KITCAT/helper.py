@@ -2,6 +2,10 @@
 
 import numpy as np
 
+from KITCAT.catalog import angular_query
+from KITCAT.projection import Projection, band_partner, find_band, shift_band
+from KITCAT.cache import projection_key
+
 class JobHelper(object):
     """ class to handle multiprocess job """
 
@@ -11,6 +15,7 @@ class JobHelper(object):
             raise ValueError('total jobs must be at least 1')
         self.total_jobs = total_jobs
         self.current_job = 0
+        self.cost = None
 
     def increment(self, verbose=True):
         """ Increment current job index by 1 """
@@ -31,14 +36,93 @@ class JobHelper(object):
         if verbose:
             print("job %d/%d" % (self.current_job+1, self.total_jobs))
 
+    def set_cost(self, cost):
+        """ Set per-point cost used to balance job ranges. If None, jobs are
+        equal-sized index ranges """
+        self.cost = cost
+
     def get_index_range(self, size):
         """ calculate the start and end indices given job size """
-        job_index = np.floor(np.linspace(0, size, self.total_jobs + 1))
-        job_index = job_index.astype(int)
+        if self.cost is not None:
+            if len(self.cost) != size:
+                raise ValueError('cost has %d points, expected %d' %
+                                 (len(self.cost), size))
+            job_index = balance_ranges(self.cost, self.total_jobs)
+        else:
+            job_index = np.floor(np.linspace(0, size, self.total_jobs + 1))
+            job_index = job_index.astype(int)
         job_range = (job_index[self.current_job],
                      job_index[self.current_job + 1])
         return job_range
 
+def estimate_cost(catalog, tree, r, nsample=10000, overhead=1.):
+    """ estimate the per-point cost of pair counting from the number of
+    neighbours of a subsample of the catalog.
+
+    Parameters:
+    -----------
+    catalog: array
+        pair catalog with (dec, ra) in the first two columns
+    tree: sklearn.neighbors.BallTree or KDTree
+        haversine or chord tree
+    r: float
+        query radius
+    nsample: int (default=10000)
+        number of points to query. Each point stands for the points up to
+        the next sampled point.
+    overhead: float (default=1.)
+        cost of a point in units of one neighbour
+
+    Returns:
+    --------
+    cost: array of shape (len(catalog),) """
+
+    n = catalog.shape[0]
+    stride = max(1, n // nsample)
+    count = angular_query(tree, catalog[::stride], r, count_only=True)
+    return np.repeat(count + overhead, stride)[:n]
+
+def balance_ranges(cost, nparts, start=0, end=None):
+    """ split the index range [start, end) into nparts contiguous ranges of
+    about equal total cost
+
+    Returns:
+    --------
+    edges: array of int of shape (nparts + 1,) """
+
+    if end is None:
+        end = len(cost)
+    total = np.concatenate([[0.], np.cumsum(cost[start:end])])
+    edges = np.searchsorted(total, np.linspace(0, total[-1], nparts + 1))
+    edges = start + np.minimum(edges, end - start)
+    edges[0] = start
+    edges[-1] = end
+    return edges
+
+def get_projection(bins, cosmo, cache=None, verbose=True):
+    """ return the projection operators of a cosmology, with the band of z
+    bins it needs. If cache is given, they are read from or stored in the
+    on-disk cache.Cache. """
+    if cache is not None:
+        cache_key = projection_key(bins, cosmo)
+        path = cache.get(cache_key)
+        if path is not None:
+            if verbose:
+                print('- load projection from %s' % path)
+            return Projection.load(path)
+
+    theta = bins.bins('theta')
+    theta = 0.5*(theta[:-1] + theta[1:])
+    r = cosmo.z2r(bins.bins('z'))
+    r = 0.5 * (r[:-1] + r[1:])
+    band = find_band(r, bins.max('s'), bins.max('theta'))
+    projection = Projection(theta, r, bins.bins('s'), band)
+    if cache is not None:
+        path = cache.put(cache_key, projection.save)
+        if verbose:
+            print('- save projection to %s' % path)
+    return projection
+
 class CorrelationHelper(object):
     """ class to handle multiprocess correlation function calculation """
 
@@ -63,13 +147,35 @@ class CorrelationHelper(object):
         self.cosmos_list = None
         self.bins = None
 
+        # projection operators of each cosmology, and the optional on-disk
+        # cache.Cache they are stored in
+        self._projections = {}
+        self.cache = None
+
     def add(self, other):
+        """ add the histograms of other. The dtypes of the histograms of self
+        are kept (see histogram.add). """
+        if self.zztheta.shape != other.zztheta.shape:
+            raise ValueError('zztheta shapes %s and %s do not match' %
+                             (self.zztheta.shape, other.zztheta.shape))
         self.zztheta += other.zztheta
         self.ftheta  += other.ftheta
         self.ztheta_d1r2 += other.ztheta_d1r2
         if self.ztheta_d2r1 is not None:
             self.ztheta_d2r1 += other.ztheta_d2r1
 
+    def get_projection(self, cosmo):
+        """ return the projection operators of a cosmology. Operators are
+        kept for the lifetime of the helper and, if self.cache is set, read
+        from or stored in the on-disk cache. """
+        # helpers pickled by older versions have no operators
+        projections = self.__dict__.setdefault('_projections', {})
+        key = tuple(cosmo.params.values())
+        if key not in projections:
+            projections[key] = get_projection(self.bins, cosmo,
+                                              getattr(self, 'cache', None))
+        return projections[key]
+
     def get_rr(self):
 
         n_models = len(self.cosmos_list)
@@ -82,43 +188,19 @@ class CorrelationHelper(object):
         rr1d = np.zeros((n_models, 2, n_bins, 1))
         rr2d = np.zeros((n_models, 2, n_bins, n_bins))
 
-        # initialize bins
-        theta = self.bins.bins('theta')
-        theta = 0.5*(theta[:-1] + theta[1:])
-        sin_2 = np.sin(theta/2.)
-        cos_2 = np.cos(theta/2.)
-        s = self.bins.bins('s')
-
         # calculate rr
         # loop over cosmology models
         for i, cosmo in enumerate(self.cosmos_list):
             cosmo_params = list(cosmo.params.values())
             print('- h0, om0, ode0: %s' % cosmo_params)
-            r = cosmo.z2r(self.bins.bins('z'))
-            r = 0.5 * (r[:-1] + r[1:])
+            projection = self.get_projection(cosmo)
+            b, valid = band_partner(len(z1_distr[0]), projection.band)
 
             for j in range(2):
-
-                # calculate 2d weight matrix
-                w = ftheta[:, None]*z1_distr[j][None, :]
-
-                for k, pt_r in enumerate(r):
-
-                    # calculate RR1D
-                    dist = np.sqrt(pt_r**2 + r[None, :]**2 -
-                                   2*pt_r*r[None, :]*np.cos(theta[:, None]))
-                    hist, _ = np.histogram(dist,
-                                           bins=s,
-                                           weights=w*z2_distr[j][k])
-                    rr1d[i][j] += hist.reshape(-1, 1)
-
-                    # calculate RR2D
-                    sigma = sin_2[:, None]*(pt_r + r[None, :])
-                    pi = cos_2[:, None]*np.abs(pt_r - r[None, :])
-                    hist, _, _ = np.histogram2d(sigma.ravel(), pi.ravel(),
-                                                bins=(s, s),
-                                                weights=w.ravel()*z2_distr[j][k])
-                    rr2d[i][j] += hist
+                # w = f(theta) * n2(z_a) * n1(z_b)
+                w = z2_distr[j][:, None] * z1_distr[j][b] * valid
+                rr1d[i][j], rr2d[i][j] = projection.project(
+                    ftheta[:, None, None] * w[None, :, :])
 
         return rr1d, rr2d
 
@@ -136,42 +218,18 @@ class CorrelationHelper(object):
         dr1d = np.zeros((n_models, 2, n_bins, 1))
         dr2d = np.zeros((n_models, 2, n_bins, n_bins))
 
-        theta = self.bins.bins('theta')
-        theta = 0.5*(theta[:-1] + theta[1:])
-        sin_2 = np.sin(theta/2.)
-        cos_2 = np.cos(theta/2.)
-        s = self.bins.bins('s')
-
         # calculate dr
         # loop over cosmology models
         for i, cosmo in enumerate(self.cosmos_list):
             cosmo_params = list(cosmo.params.values())
             print('- h0, om0, ode0: %s' % cosmo_params)
-
-            r = cosmo.z2r(self.bins.bins('z'))
-            r = 0.5 * (r[:-1] + r[1:])
+            projection = self.get_projection(cosmo)
+            b, valid = band_partner(len(z_distr[0]), projection.band)
 
             for j in range(2):
-                w = ztheta[j]
-
-                # Calculate DR(s)
-                for k, pt_r in enumerate(r):
-
-                    # calculate DR1D
-                    dist = np.sqrt(pt_r**2 + r[None, :]**2 -
-                                   2*pt_r*r[None, :]*np.cos(theta[:, None]))
-                    hist, _ = np.histogram(dist,
-                                           bins    = s,
-                                           weights = z_distr[j][k]*w)
-                    dr1d[i][j] += hist.reshape(-1, 1)
-
-                    # calculate DR2D
-                    sigma = sin_2[:, None]*(pt_r + r[None, :])
-                    pi = cos_2[:, None]*np.abs(pt_r - r[None, :])
-                    hist, _, _ = np.histogram2d(sigma.ravel(), pi.ravel(),
-                                                bins=(s,s),
-                                                weights=w.ravel()*z_distr[j][k])
-                    dr2d[i][j] += hist
+                # w = n(z_a) * g(theta, z_b)
+                w = z_distr[j][None, :, None] * ztheta[j][:, b] * valid
+                dr1d[i][j], dr2d[i][j] = projection.project(w)
 
         return dr1d, dr2d
 
@@ -181,40 +239,26 @@ class CorrelationHelper(object):
         n_bins = self.bins.num_bins('s')
         dd1d = np.zeros((n_models, 2, n_bins, 1))
         dd2d = np.zeros((n_models, 2, n_bins, n_bins))
-
-        theta = self.bins.bins('theta')
-        theta = 0.5*(theta[:-1] + theta[1:])
-        s = self.bins.bins('s')
+        band = self.zztheta.shape[-1] // 2
 
         for i, cosmo in enumerate(self.cosmos_list):
             cosmo_params = list(cosmo.params.values())
             print('- h0, om0, ode0: %s' % cosmo_params)
-
-            # convert z to r
-            r = cosmo.z2r(self.bins.bins('z'))
-            r = 0.5 * (r[:-1] + r[1:])
-
-            # calculate weighted and unweighted
+            projection = self.get_projection(cosmo)
+
+            # pairs beyond the counted band are missing, DD(s) would be
+            # truncated while RR(s) and DR(s) are not
+            if projection.band > band:
+                raise ValueError(
+                    'cosmology %s needs a z band of %d, DD was counted within '
+                    '%d. Add it to the COSMOLOGY section of the preprocess '
+                    'configuration and rerun the pipeline' %
+                    (cosmo_params, projection.band, band))
+
+            # zztheta is banded: zztheta[:, :, l, d] pairs z bins l and
+            # l + d - band
             for j in range(2):
-                for k, pt_theta in enumerate(theta):
-                    sin_2 = np.sin(pt_theta/2.)
-                    cos_2 = np.cos(pt_theta/2.)
-                    for l, pt_r in enumerate(r):
-                        w = self.zztheta[j, k, l]
-
-                        # calculate DD 1D
-                        dist = np.sqrt(pt_r**2 + r**2 - 2*r*pt_r * np.cos(pt_theta))
-                        hist, _ = np.histogram(dist,
-                                               bins    = s,
-                                               weights = w)
-                        dd1d[i][j] += hist.reshape(-1, 1)
-
-                        # calculate DD 2D
-                        sigma = sin_2 * (pt_r + r)
-                        pi = cos_2 * np.abs(pt_r - r)
-                        hist, _, _ = np.histogram2d(sigma.ravel(), pi.ravel(),
-                                                    bins = (s, s),
-                                                    weights = w.ravel())
-                        dd2d[i][j] += hist
+                dd1d[i][j], dd2d[i][j] = projection.project(
+                    shift_band(self.zztheta[j], projection.band))
 
         return dd1d, dd2d
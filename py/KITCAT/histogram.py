@@ -0,0 +1,138 @@
+""" Module for pair-count histograms whose weighted and unweighted halves are
+stored with their own dtype. The analysis functions allocate the halves in
+their dtypes and fill them chunk by chunk: each chunk is counted in float64
+scratch arrays, and every addition is done in float64 or int64 before it is
+stored back. """
+
+# Python modules
+import numpy as np
+
+# dtypes of the weighted and unweighted halves
+WEIGHTED_DTYPES = ('float64', 'float32')
+UNWEIGHTED_DTYPES = ('float64', 'int64', 'uint32')
+
+class Histogram(object):
+    """ Class to hold the weighted [0] and unweighted [1] halves of a
+    histogram. It is indexed like an array of shape (2, ...): hist[0] and
+    hist[1] return the values of the halves. """
+
+    def __init__(self, weighted, unweighted, scale=1.):
+        """ constructor
+
+        Parameters:
+        -----------
+        weighted, unweighted: array
+            halves of the same shape
+        scale: float (default=1.)
+            value of one unweighted count, e.g. 0.5 for halved counts of
+            pairs counted in both orders """
+        if weighted.shape != unweighted.shape:
+            raise ValueError('halves of shape %s and %s do not match' %
+                             (weighted.shape, unweighted.shape))
+        self.halves = [weighted, unweighted]
+        self.scale = scale
+
+    @property
+    def shape(self):
+        """ shape of the equivalent (2, ...) array """
+        return (2,) + self.halves[0].shape
+
+    @property
+    def nbytes(self):
+        """ size of the halves in bytes """
+        return sum(half.nbytes for half in self.halves)
+
+    def __len__(self):
+        return 2
+
+    def __getitem__(self, index):
+        if index == 1 and self.scale != 1.:
+            return self.halves[1] * self.scale
+        return self.halves[index]
+
+    def __array__(self, dtype=None, copy=None):
+        """ return a float64 array of shape (2, ...) """
+        return np.array([self[0], self[1]],
+                        dtype=np.float64 if dtype is None else dtype)
+
+    def __iadd__(self, other):
+        """ add the halves of other, a Histogram or an array of shape
+        (2, ...) """
+        add(self.halves[0], other[0])
+        if isinstance(other, Histogram) and other.scale == self.scale:
+            add(self.halves[1], other.halves[1])
+        else:
+            add(self.halves[1], np.asarray(other[1]) / self.scale)
+        return self
+
+def add(target, values):
+    """ add values into target in place. Float32 targets are summed in
+    float64 and rounded once, integer targets are summed in int64.
+    Raise OverflowError if the sum does not fit the dtype of target. """
+    if target.dtype == np.float64:
+        target += values
+    elif target.dtype.kind == 'f':
+        target[...] = target.astype(np.float64) + values
+    else:
+        if np.asarray(values).dtype.kind == 'f':
+            values = np.rint(values)
+        total = target.astype(np.int64) + np.asarray(values, dtype=np.int64)
+        if total.size and (total.min() < np.iinfo(target.dtype).min or
+                           total.max() > np.iinfo(target.dtype).max):
+            raise OverflowError('counts do not fit in %s' % target.dtype)
+        target[...] = total
+
+def add_at(target, index, values):
+    """ add values at index of target in place, as np.add.at. Repeated
+    indices of a float64 target are accumulated in order. For other dtypes,
+    the values of each index are summed in float64 and added once, see
+    add. """
+    if target.dtype == np.float64:
+        np.add.at(target, index, values)
+        return
+    index, inverse = np.unique(index, return_inverse=True)
+    inverse = inverse.ravel()
+    sums = np.zeros((len(index),) + target.shape[1:])
+    np.add.at(sums, inverse, np.broadcast_to(values, inverse.shape +
+                                             target.shape[1:]))
+    part = target[index]
+    add(part, sums)
+    target[index] = part
+
+def halves(hist):
+    """ return the stored weighted and unweighted halves of hist, an array of
+    shape (2, ...) or a Histogram, to be filled in place """
+    if isinstance(hist, Histogram):
+        return hist.halves
+    return [hist[0], hist[1]]
+
+def zeros(shape, weighted='float64', unweighted='float64', scale=1.):
+    """ return an empty histogram of shape (2, ...) with the given dtypes of
+    its weighted and unweighted halves. Float64 for both returns a plain
+    array.
+
+    Parameters:
+    -----------
+    shape: tuple of int
+        shape of the equivalent (2, ...) array
+    weighted: str (default='float64')
+        one of WEIGHTED_DTYPES
+    unweighted: str (default='float64')
+        one of UNWEIGHTED_DTYPES
+    scale: float (default=1.)
+        value of one unweighted count, see Histogram. A plain array holds
+        the scaled counts.
+
+    Returns:
+    --------
+    hist: array or Histogram """
+    if weighted not in WEIGHTED_DTYPES:
+        raise ValueError('weighted dtype must be one of %s' %
+                         (WEIGHTED_DTYPES,))
+    if unweighted not in UNWEIGHTED_DTYPES:
+        raise ValueError('unweighted dtype must be one of %s' %
+                         (UNWEIGHTED_DTYPES,))
+    if weighted == 'float64' and unweighted == 'float64':
+        return np.zeros(shape)
+    return Histogram(np.zeros(shape[1:], dtype=weighted),
+                     np.zeros(shape[1:], dtype=unweighted), scale)
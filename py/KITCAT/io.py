@@ -1,9 +1,30 @@
 """ Modules for handling simple I/O functions"""
 
 import os
+import json
 import pickle
+import hashlib
 import configparser
 
+import numpy as np
+import sklearn
+from sklearn.neighbors import BallTree, KDTree
+try:
+    from sklearn.metrics import DistanceMetric
+except ImportError:
+    # scikit-learn < 1.0
+    from sklearn.neighbors import DistanceMetric
+
+# version of the preprocess directory layout
+PREPROCESS_VERSION = 1
+
+# combinatorial stages stored in the preprocess output
+PREPROCESS_STAGES = ('rr', 'dd', 'd1r2', 'd2r1')
+
+# tree classes and metrics that can be stored in the preprocess directory
+TREES = {'BallTree': BallTree, 'KDTree': KDTree}
+METRICS = ('haversine', 'euclidean')
+
 
 DEFAULTS = {
     'GENERAL': {'x_correlation': 'False'},
@@ -105,8 +126,184 @@ def load(fname):
 
 
 def save(fname, save_object):
-    """ save pickle """
-    with open(fname, 'wb') as f:
+    """ save pickle. The pickle is written to a temporary file first and
+    moved to fname, so fname is never left partially written. """
+    tmp_fname = '%s.tmp' % fname
+    with open(tmp_fname, 'wb') as f:
         pickle.dump(save_object, f, protocol=-1)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_fname, fname)
+
+
+
+
+def _metric_name(metric):
+    """ return the name of a sklearn DistanceMetric object """
+    for name in METRICS:
+        if type(DistanceMetric.get_metric(name)) is type(metric):
+            return name
+    raise ValueError('unsupported tree metric %s' % type(metric).__name__)
+
+def known_tree_state(state):
+    """ return True if state, the __getstate__ tuple of a sklearn BallTree
+    or KDTree, has the layout the node arrays are stored with: four node
+    arrays, seven ints and the distance metric, in the order of
+    scikit-learn >= 0.22. Other layouts are rebuilt from the tree data. """
+    return (len(state) == 13 and
+            all(isinstance(x, np.ndarray) for x in state[:4]) and
+            all(isinstance(x, (int, np.integer)) for x in state[4:11]) and
+            isinstance(state[11], DistanceMetric))
+
+def _tree_metric(state):
+    """ return the name of the distance metric in a tree state """
+    for x in state:
+        if isinstance(x, DistanceMetric):
+            return _metric_name(x)
+    raise ValueError('no distance metric found in the tree state')
+
+def save_preprocess(dirname, save_params, tree_arrays=True):
+    """ save preprocess output as a directory of .npy arrays, a pickle of the
+    small objects (bins, cosmologies, helper) and a JSON manifest.
+
+    Parameters:
+    -----------
+    dirname: str
+    save_params: dict
+        preprocess output with keys 'rr', 'dd', 'd1r2', 'd2r1',
+        'cosmos_list', 'bins' and 'helper'
+    tree_arrays: bool (default=True)
+        if True, store the node arrays of the trees so that they can be
+        memory-mapped. If False, store only the tree data and rebuild the
+        trees on load. """
+
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+
+    # the directory is incomplete until the new manifest is written
+    if os.path.exists(os.path.join(dirname, 'manifest.json')):
+        os.remove(os.path.join(dirname, 'manifest.json'))
+
+    # identical arrays are written once
+    files = {}
+    def save_array(array):
+        array = np.ascontiguousarray(array)
+        key = hashlib.sha1(array.tobytes()).hexdigest()
+        key = '%s-%s-%s' % (array.dtype.str, array.shape, key)
+        if key not in files:
+            files[key] = 'array_%03d.npy' % len(files)
+            np.save(os.path.join(dirname, files[key]), array)
+        return files[key]
+
+    manifest = {'version': PREPROCESS_VERSION, 'sklearn': sklearn.__version__,
+                'stages': {}}
+    for key in PREPROCESS_STAGES:
+        params = save_params[key]
+        if params is None:
+            manifest['stages'][key] = None
+            continue
+        tree = params['tree']
+        state = tree.__getstate__()
+        tree_dict = {'class': type(tree).__name__,
+                     'metric': _tree_metric(state),
+                     'state_length': len(state),
+                     'data': save_array(np.asarray(tree.data))}
+        if known_tree_state(state):
+            tree_dict['leaf_size'] = int(state[4])
+            if tree_arrays:
+                tree_dict['state'] = [int(x) for x in state[4:11]]
+                tree_dict['arrays'] = [save_array(np.asarray(x))
+                                       for x in state[:4]]
+        manifest['stages'][key] = {
+            'pair_catalog': save_array(params['pair_catalog']),
+            'tree_catalog': save_array(params['tree_catalog']),
+            'tree': tree_dict}
+
+    save(os.path.join(dirname, 'objects.pkl'),
+         {key: save_params[key] for key in ('cosmos_list', 'bins', 'helper')})
+
+    # the manifest is written last, it marks a complete directory
+    tmp_fname = os.path.join(dirname, 'manifest.json.tmp')
+    with open(tmp_fname, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_fname, os.path.join(dirname, 'manifest.json'))
+
+def _same_tree_layout(manifest, tree_dict):
+    """ return True if the node arrays of tree_dict were written by the
+    installed scikit-learn with the known state layout """
+    if manifest.get('sklearn') != sklearn.__version__:
+        return False
+    cls = TREES[tree_dict['class']]
+    state = cls(np.zeros((1, 2))).__getstate__()
+    return (known_tree_state(state) and
+            tree_dict.get('state_length') == len(state))
+
+def load_preprocess(prefix, mmap_mode='r'):
+    """ load preprocess output of prefix, from the directory PREFIX_preprocess
+    or from the pickle PREFIX_preprocess.pkl, whichever is the most recent.
+
+    Parameters:
+    -----------
+    prefix: str
+    mmap_mode: str (default='r')
+        memory-map mode of the arrays, None to read them into memory
+
+    Returns:
+    --------
+    save_params: dict
+        same as the pickled preprocess output """
+
+    fname = '%s_preprocess.pkl' % prefix
+    manifest_fname = os.path.join('%s_preprocess' % prefix, 'manifest.json')
+    if not os.path.exists(manifest_fname) or (
+            os.path.exists(fname) and
+            os.path.getmtime(fname) > os.path.getmtime(manifest_fname)):
+        return load(fname)
+    dirname = os.path.dirname(manifest_fname)
+
+    with open(manifest_fname) as f:
+        manifest = json.load(f)
+    if manifest['version'] != PREPROCESS_VERSION:
+        raise ValueError('unsupported preprocess version %s' %
+                         manifest['version'])
 
+    arrays = {}
+    def load_array(fname):
+        if fname not in arrays:
+            arrays[fname] = np.load(os.path.join(dirname, fname),
+                                    mmap_mode=mmap_mode)
+        return arrays[fname]
 
+    save_params = load(os.path.join(dirname, 'objects.pkl'))
+    for key in PREPROCESS_STAGES:
+        stage = manifest['stages'][key]
+        if stage is None:
+            save_params[key] = None
+            continue
+        tree_dict = stage['tree']
+        cls = TREES[tree_dict['class']]
+        if 'arrays' in tree_dict and _same_tree_layout(manifest, tree_dict):
+            # set the tree state on top of the mapped arrays
+            tree = cls.__new__(cls)
+            metric = DistanceMetric.get_metric(tree_dict['metric'])
+            tree.__setstate__(
+                tuple(load_array(fname) for fname in tree_dict['arrays'])
+                + tuple(tree_dict['state']) + (metric, None))
+        else:
+            # rebuild from the tree data. Directories of version 1 without
+            # 'data' or 'leaf_size' hold them in 'arrays' and 'state'.
+            if 'arrays' in tree_dict:
+                print('- rebuild %s tree: written by scikit-learn %s' %
+                      (key, manifest.get('sklearn', 'unknown')))
+                data = tree_dict.get('data', tree_dict['arrays'][0])
+            else:
+                data = tree_dict['data']
+            leaf_size = tree_dict.get('leaf_size',
+                                      tree_dict.get('state', [40])[0])
+            tree = cls(load_array(data),
+                       leaf_size = leaf_size,
+                       metric    = tree_dict['metric'])
+        save_params[key] = {'pair_catalog': load_array(stage['pair_catalog']),
+                            'tree_catalog': load_array(stage['tree_catalog']),
+                            'tree': tree}
+    return save_params
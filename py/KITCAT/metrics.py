@@ -0,0 +1,192 @@
+""" Module to record runtime metrics of the pipeline. Each stage records its
+wall and CPU time, the peak memory of the process and the counters reported
+by the pair counting loops while the stage is active. Metrics are saved as
+JSON and as CSV with one row per stage. """
+
+# Standard Python modules
+import os
+import csv
+import json
+import time
+import resource
+import contextlib
+
+# Python modules
+import numpy as np
+
+# number of log2 bins of the neighbours per query histogram: 0, 1, 2-3, ...
+NEIGHBOUR_BINS = 48
+
+# default minimum wall time in seconds between two progress lines
+PROGRESS_INTERVAL = 10.
+
+# record of the active stage of this process, None if not recording
+_current = None
+
+def _peak_rss_mb(who=resource.RUSAGE_SELF):
+    """ peak resident set size in MB """
+    return resource.getrusage(who).ru_maxrss / 1024.
+
+def neighbour_bins():
+    """ return the lower edge of each bin of the neighbours histogram """
+    return [0] + [2**i for i in range(NEIGHBOUR_BINS - 1)]
+
+class StageRecord(object):
+    """ Class to hold the counters of one stage """
+
+    def __init__(self, name, progress_interval=PROGRESS_INTERVAL):
+        """ constructor """
+        self.name = name
+        self.progress_interval = progress_interval
+        self.counters = {'queries': 0, 'pairs': 0, 'query_time': 0.,
+                         'histogram_time': 0.}
+        self.neighbours = np.zeros(NEIGHBOUR_BINS, dtype=np.int64)
+        self.values = {}
+        self._last_progress = time.time()
+        self._start = time.time()
+
+    def add_query(self, counts, seconds):
+        """ record a batched query with counts neighbours per point """
+        counts = np.asarray(counts)
+        self.counters['queries'] += len(counts)
+        self.counters['pairs'] += int(counts.sum())
+        self.counters['query_time'] += seconds
+        index = np.zeros(len(counts), dtype=int)
+        nonzero = counts > 0
+        index[nonzero] = np.minimum(
+            np.floor(np.log2(counts[nonzero])).astype(int) + 1,
+            NEIGHBOUR_BINS - 1)
+        self.neighbours += np.bincount(index, minlength=NEIGHBOUR_BINS)
+
+    def add(self, key, value):
+        """ add value to counter key """
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def progress(self, done, total):
+        """ print the progress at most once per progress interval """
+        now = time.time()
+        if now - self._last_progress < self.progress_interval and done < total:
+            return
+        self._last_progress = now
+        elapsed = now - self._start
+        rate = done / elapsed if elapsed > 0 else 0.
+        eta = (total - done) / rate if rate > 0 else float('nan')
+        print('- progress: %d/%d (%.1f%%), %.3g points/s, eta %.0f s' %
+              (done, total, 100. * done / max(total, 1), rate, eta),
+              flush=True)
+
+    def merge(self, summary):
+        """ add the counters of a summary returned by another process """
+        for key, value in summary['counters'].items():
+            self.add(key, value)
+        self.neighbours += np.asarray(summary['neighbours'], dtype=np.int64)
+        self.add('worker_cpu_time', summary.get('cpu_time', 0.))
+        self.values['worker_peak_rss_mb'] = max(
+            self.values.get('worker_peak_rss_mb', 0.),
+            summary.get('peak_rss_mb', 0.))
+
+    def summary(self):
+        """ return the counters and values as a dict of JSON types """
+        summary = {'counters': dict(self.counters),
+                   'neighbours': self.neighbours.tolist()}
+        summary.update(self.values)
+        return summary
+
+@contextlib.contextmanager
+def record(name, progress_interval=PROGRESS_INTERVAL):
+    """ make a new StageRecord the active record of this process while the
+    block runs and yield it. Used by worker processes, whose summary is
+    merged into the stage of the parent. """
+    global _current
+    previous = _current
+    _current = StageRecord(name, progress_interval)
+    start_cpu = time.process_time()
+    try:
+        yield _current
+    finally:
+        _current.values['cpu_time'] = time.process_time() - start_cpu
+        _current.values['peak_rss_mb'] = _peak_rss_mb()
+        _current = previous
+
+def current():
+    """ return the active StageRecord, or None if metrics are not recorded """
+    return _current
+
+class Metrics(object):
+    """ Class to collect the stages of a program run and save them """
+
+    def __init__(self, program, job=None, progress_interval=PROGRESS_INTERVAL):
+        """ constructor
+
+        Parameters:
+        -----------
+        program: str
+            name of the program, e.g. 'combinatorial'
+        job: tuple of int (default=None)
+            (job index, total jobs)
+        progress_interval: float (default=PROGRESS_INTERVAL)
+            minimum wall time in seconds between two progress lines """
+        self.program = program
+        self.job = job
+        self.progress_interval = progress_interval
+        self.stages = []
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """ record the block as stage name and yield its StageRecord """
+        global _current
+        previous = _current
+        stage = StageRecord(name, self.progress_interval)
+        _current = stage
+        start_wall = time.time()
+        start_cpu = time.process_time()
+        try:
+            yield stage
+        finally:
+            _current = previous
+            wall = time.time() - start_wall
+            cpu = time.process_time() - start_cpu
+            cpu += stage.counters.pop('worker_cpu_time', 0.)
+            entry = {'stage': name,
+                     'wall_time': wall,
+                     'cpu_time': cpu,
+                     'peak_rss_mb': _peak_rss_mb(),
+                     'children_peak_rss_mb': max(
+                         _peak_rss_mb(resource.RUSAGE_CHILDREN),
+                         stage.values.get('worker_peak_rss_mb', 0.))}
+            entry.update(stage.counters)
+            entry['pairs_per_second'] = stage.counters['pairs'] / wall \
+                if wall > 0 else 0.
+            entry['neighbours'] = stage.neighbours.tolist()
+            self.stages.append(entry)
+
+    def save(self, prefix):
+        """ write PREFIX.json and PREFIX.csv """
+        with open('%s.json' % prefix, 'w') as f:
+            json.dump({'program': self.program,
+                       'job': self.job,
+                       'host': os.uname()[1],
+                       'neighbour_bins': neighbour_bins(),
+                       'stages': self.stages}, f, indent=2)
+
+        # the neighbours histogram is only in the JSON file
+        keys = []
+        for entry in self.stages:
+            keys += [key for key in entry
+                     if key not in keys and key != 'neighbours']
+        with open('%s.csv' % prefix, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=keys, extrasaction='ignore')
+            writer.writeheader()
+            for entry in self.stages:
+                writer.writerow(entry)
+        print('- metrics saved to %s.json' % prefix)
+
+@contextlib.contextmanager
+def stage(metrics, name):
+    """ record the block as stage name of metrics, or do nothing if metrics
+    is None """
+    if metrics is None:
+        yield None
+        return
+    with metrics.stage(name) as stage_record:
+        yield stage_record
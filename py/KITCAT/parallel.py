@@ -0,0 +1,480 @@
+""" Module to run the combinatorial step on a pool of worker processes.
+Catalogs, trees and histogram accumulators live in shared memory, so that the
+workers attach to a single copy instead of unpickling their own. """
+
+# Standard Python modules
+import io
+import time
+import contextlib
+import multiprocessing as mp
+
+# Python modules
+import numpy as np
+
+from KITCAT import analysis as lanalysis
+from KITCAT import histogram as lhistogram
+from KITCAT import io as lio
+from KITCAT import metrics as lmetrics
+from KITCAT.helper import JobHelper, balance_ranges
+
+# combinatorial stages in the order they are calculated
+STAGES = ('rr', 'd1r2', 'd2r1', 'dd')
+
+# shared memory blocks attached by this process
+_blocks = []
+
+# stage parameters and accumulators of this worker
+_worker = {}
+
+class SharedStore(object):
+    """ Class to own the shared memory blocks created by the parent process """
+
+    def __init__(self):
+        """ constructor """
+        self.blocks = []
+        self._shared = {}
+        self._arrays = []
+
+    def put(self, array):
+        """ copy array into shared memory and return its descriptor.
+        An array shared more than once is only copied the first time. """
+        key = id(array)
+        if key not in self._shared:
+            self._arrays.append(array)
+            array = np.ascontiguousarray(array)
+            desc, view = self.empty(array.shape, array.dtype)
+            view[...] = array
+            self._shared[key] = desc
+        return self._shared[key]
+
+    def empty(self, shape, dtype=float):
+        """ allocate a zero-filled array in shared memory
+
+        Returns:
+        --------
+        desc: tuple
+            (name, shape, dtype) descriptor to attach the array
+        array: numpy.ndarray
+            view of the array in this process """
+        dtype = np.dtype(dtype)
+        size = max(int(np.prod(shape)) * dtype.itemsize, 1)
+        block = _shared_memory().SharedMemory(create=True, size=size)
+        self.blocks.append(block)
+        array = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+        array[...] = 0
+        return (block.name, tuple(shape), dtype), array
+
+    def put_tree(self, tree):
+        """ share the arrays of a sklearn BallTree or KDTree and return its
+        descriptor. The remaining tree state is small and is pickled. A
+        tree state of unknown layout is pickled whole, and each worker
+        unpickles its own copy. """
+        state = tree.__getstate__()
+        if not lio.known_tree_state(state):
+            return (type(tree), None, tree)
+        arrays = tuple(self.put(np.asarray(x)) for x in state[:4])
+        return (type(tree), arrays, state[4:])
+
+    def put_stage(self, params):
+        """ share the pair catalog, tree catalog and tree of a stage """
+        if params is None:
+            return None
+        return {'pair_catalog': self.put(params['pair_catalog']),
+                'tree_catalog': self.put(params['tree_catalog']),
+                'tree': self.put_tree(params['tree'])}
+
+    def close(self):
+        """ release and remove every block """
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
+        self._shared = {}
+        self._arrays = []
+
+def _shared_memory():
+    """ return multiprocessing.shared_memory. It needs Python >= 3.8 and is
+    only required when workers are used. """
+    try:
+        from multiprocessing import shared_memory
+    except ImportError:
+        raise RuntimeError('worker processes require Python >= 3.8')
+    return shared_memory
+
+def attach(desc):
+    """ return the shared array described by desc """
+    name, shape, dtype = desc
+    block = _shared_memory().SharedMemory(name=name)
+    _blocks.append(block)
+    return np.ndarray(shape, dtype=dtype, buffer=block.buf)
+
+def attach_tree(desc):
+    """ rebuild a tree on top of its shared arrays without copying them """
+    cls, arrays, state = desc
+    if arrays is None:
+        return state
+    tree = cls.__new__(cls)
+    tree.__setstate__(tuple(attach(x) for x in arrays) + tuple(state))
+    return tree
+
+def attach_stage(desc):
+    """ return the pair catalog, tree catalog and tree of a shared stage """
+    if desc is None:
+        return None
+    return {'pair_catalog': attach(desc['pair_catalog']),
+            'tree_catalog': attach(desc['tree_catalog']),
+            'tree': attach_tree(desc['tree'])}
+
+
+class RangeHelper(object):
+    """ Class with the interface of helper.JobHelper for a fixed index range """
+
+    def __init__(self, start, end):
+        """ constructor """
+        self.start = start
+        self.end = end
+
+    def get_index_range(self, size):
+        """ return the fixed start and end indices """
+        return (self.start, min(self.end, size))
+
+def run_range(stage, params, start, end, **kwargs):
+    """ run one combinatorial stage from index start to end of the pair
+    catalog.
+
+    Parameters:
+    -----------
+    stage: str
+        'rr', 'dd', 'd1r2' or 'd2r1'
+    params: dict
+        stage entry of the preprocess output
+    start, end: int
+    kwargs:
+        binning and backend arguments of the analysis function
+
+    Returns:
+    --------
+    hist: array
+        f(theta), ztheta or zztheta of the index range """
+
+    args = dict(pair_catalog = params['pair_catalog'],
+                tree_catalog = params['tree_catalog'],
+                tree         = params['tree'],
+                job_helper   = RangeHelper(start, end))
+    args.update(kwargs)
+    if stage == 'rr':
+        return lanalysis.get_ftheta(**args)
+    if stage == 'dd':
+        return lanalysis.get_zztheta(**args)
+    return lanalysis.get_ztheta(**args)
+
+def get_stage_kwargs(stage, bins, same, chunk_size=1000, backend='balltree',
+                     rr_backend=None, weighted=True, weighted_dtype='float64',
+                     unweighted_dtype='float64'):
+    """ return the keyword arguments of the analysis function of a stage.
+    rr_backend, if given, replaces backend for f(theta). If not weighted,
+    only the unweighted DD pairs are counted. weighted_dtype and
+    unweighted_dtype are the dtypes of the halves of ztheta and zztheta. """
+    kwargs = dict(theta_max   = bins.max('theta'),
+                  theta_nbins = bins.num_bins('theta'),
+                  chunk_size  = chunk_size,
+                  backend     = backend)
+    if stage == 'rr':
+        kwargs.update(same=same)
+        if rr_backend is not None:
+            kwargs.update(backend=rr_backend)
+        return kwargs
+    kwargs.update(z_min            = bins.min('z'),
+                  z_max            = bins.max('z'),
+                  z_nbins          = bins.num_bins('z'),
+                  weighted_dtype   = weighted_dtype,
+                  unweighted_dtype = unweighted_dtype)
+    if stage == 'dd':
+        kwargs.update(same=same, z_band=bins.band, weighted=weighted)
+    return kwargs
+
+def get_stage_shape(stage, bins):
+    """ return the shape of the histogram of a stage """
+    theta_nbins = bins.num_bins('theta')
+    z_nbins = bins.num_bins('z')
+    if stage == 'rr':
+        return (theta_nbins,)
+    if stage == 'dd':
+        return (2, theta_nbins, z_nbins, 2*bins.band + 1)
+    return (2, theta_nbins, z_nbins)
+
+def get_stage_zeros(stage, bins, kwargs):
+    """ return an empty histogram of a stage, with the dtypes of its keyword
+    arguments (see get_stage_kwargs) """
+    shape = get_stage_shape(stage, bins)
+    if stage == 'rr':
+        return np.zeros(shape)
+    scale = 1.
+    if stage == 'dd':
+        scale = lanalysis.get_zztheta_scale(kwargs['same'], kwargs['backend'],
+                                            kwargs['weighted'])
+    return lhistogram.zeros(shape, kwargs['weighted_dtype'],
+                            kwargs['unweighted_dtype'], scale)
+
+def _share_accumulators(store, workers, hist):
+    """ allocate one accumulator per worker in shared memory, with the shape
+    and dtypes of the empty histogram hist. Return its descriptor and the
+    accumulators of every worker. """
+    if not isinstance(hist, lhistogram.Histogram):
+        return store.empty((workers,) + hist.shape)
+    descs, halves = [], []
+    for half in hist.halves:
+        desc, array = store.empty((workers,) + half.shape, half.dtype)
+        descs.append(desc)
+        halves.append(array)
+    return ({'halves': descs, 'scale': hist.scale},
+            lhistogram.Histogram(halves[0], halves[1], hist.scale))
+
+def _attach_accumulators(desc):
+    """ return the accumulators described by desc """
+    if isinstance(desc, dict):
+        weighted, unweighted = [attach(half) for half in desc['halves']]
+        return lhistogram.Histogram(weighted, unweighted, desc['scale'])
+    return attach(desc)
+
+def _slot(acc, slot):
+    """ return the accumulator of a worker slot """
+    if isinstance(acc, lhistogram.Histogram):
+        return lhistogram.Histogram(acc.halves[0][slot], acc.halves[1][slot],
+                                    acc.scale)
+    return acc[slot]
+
+class ChunkQueue(object):
+    """ Class for per-worker chunk deques in shared memory. A worker pops
+    chunks from the front of its own deque. Once it is empty, the worker
+    steals from the back of the deque with the most chunks left. """
+
+    def __init__(self, edges, cost, workers, store):
+        """ initialize the deques with contiguous blocks of chunks
+
+        Parameters:
+        -----------
+        edges: array of int
+            chunk boundaries, chunk k is [edges[k], edges[k+1])
+        cost: array of float
+            predicted cost of each chunk
+        workers: int
+        store: SharedStore """
+
+        nchunks = len(edges) - 1
+        self.desc = {}
+        for key, shape, dtype in [('bounds', (nchunks, 2), int),
+                                  ('predicted', (nchunks,), float),
+                                  ('actual', (nchunks,), float),
+                                  ('worker', (nchunks,), int),
+                                  ('deque', (workers, 2), int)]:
+            self.desc[key], array = store.empty(shape, dtype)
+            setattr(self, key, array)
+        self.bounds[:, 0] = edges[:-1]
+        self.bounds[:, 1] = edges[1:]
+        self.predicted[:] = cost
+        self.worker[:] = -1
+        blocks = np.floor(np.linspace(0, nchunks, workers + 1)).astype(int)
+        self.deque[:, 0] = blocks[:-1]
+        self.deque[:, 1] = blocks[1:]
+
+    @classmethod
+    def attach(cls, desc):
+        """ return the queue described by desc in a worker """
+        queue = cls.__new__(cls)
+        queue.desc = desc
+        for key, value in desc.items():
+            setattr(queue, key, attach(value))
+        return queue
+
+    def pop(self, slot, lock):
+        """ return the index of the next chunk of worker slot, or None if
+        every deque is empty """
+        with lock:
+            head, tail = self.deque[slot]
+            if head < tail:
+                self.deque[slot, 0] += 1
+                return head
+            left = self.deque[:, 1] - self.deque[:, 0]
+            victim = np.argmax(left)
+            if left[victim] == 0:
+                return None
+            self.deque[victim, 1] -= 1
+            return self.deque[victim, 1]
+
+    def records(self):
+        """ return (start, end, predicted cost, wall time, worker) of each
+        chunk as a structured array """
+        records = np.zeros(len(self.predicted),
+                           dtype=[('start', int), ('end', int),
+                                  ('predicted', float), ('actual', float),
+                                  ('worker', int)])
+        records['start'] = self.bounds[:, 0]
+        records['end'] = self.bounds[:, 1]
+        records['predicted'] = self.predicted
+        records['actual'] = self.actual
+        records['worker'] = self.worker
+        return records
+
+def _init_worker(stages, accumulators, counter, lock):
+    """ attach a worker to the shared stages and claim an accumulator slot """
+    with counter.get_lock():
+        _worker['slot'] = counter.value
+        counter.value += 1
+    _worker['lock'] = lock
+    _worker['stages'] = {key: attach_stage(desc)
+                         for key, desc in stages.items()}
+    _worker['acc'] = {key: _slot(_attach_accumulators(desc), _worker['slot'])
+                      for key, desc in accumulators.items()}
+
+def _work_loop(task):
+    """ run chunks of a stage until every deque is empty and add them to the
+    worker accumulator. Return the metrics summary of the worker if metrics
+    are recorded, else None. """
+    stage, desc, kwargs, record_metrics = task
+    queue = ChunkQueue.attach(desc)
+    slot = _worker['slot']
+    context = contextlib.nullcontext()
+    if record_metrics:
+        # progress is reported per chunk by the parent
+        context = lmetrics.record(stage, progress_interval=float('inf'))
+    with context as record:
+        while True:
+            k = queue.pop(slot, _worker['lock'])
+            if k is None:
+                break
+            start, end = queue.bounds[k]
+            start_time = time.time()
+            with contextlib.redirect_stdout(io.StringIO()):
+                hist = run_range(stage, _worker['stages'][stage], start, end,
+                                 **kwargs)
+            _worker['acc'][stage] += hist
+            queue.actual[k] = time.time() - start_time
+            queue.worker[k] = slot
+            print('- chunk: %d-%d (worker %d)' % (start, end - 1, slot),
+                  flush=True)
+    return None if record is None else record.summary()
+
+def run_combinatorial(preprocess_params, bins, workers, job_helper=None,
+                      nchunks=None, chunk_size=1000, backend='balltree',
+                      costs=None, metrics=None, rr_backend=None,
+                      weighted=True, weighted_dtype='float64',
+                      unweighted_dtype='float64'):
+    """ calculate f(theta), ztheta and zztheta on a pool of workers.
+
+    Parameters:
+    -----------
+    preprocess_params: dict
+        preprocess output
+    bins: bins.Bins
+    workers: int
+        number of worker processes
+    job_helper: helper.JobHelper (default=None)
+        if given, only the index range of the current job is calculated
+    nchunks: int (default=None)
+        number of chunks each stage is split into. If None, use 4 chunks
+        per worker.
+    chunk_size: int
+    backend: str
+    costs: dict (default=None)
+        per-point cost of the pair catalog of each stage (see
+        helper.estimate_cost). If given, job ranges and chunks hold equal
+        predicted cost instead of equal number of points.
+    metrics: metrics.Metrics (default=None)
+        if given, record each stage with the counters of every worker
+    rr_backend: str (default=None)
+        backend of f(theta), see analysis.FTHETA_BACKENDS. If None, use
+        backend.
+    weighted: bool (default=True)
+        if False, only count the unweighted DD pairs (see
+        analysis.get_zztheta)
+    weighted_dtype, unweighted_dtype: str (default='float64')
+        dtypes of the halves of ztheta and zztheta, see histogram.zeros.
+        Each worker accumulates its chunks in these dtypes.
+
+    Returns:
+    --------
+    results: dict
+        'rr', 'd1r2', 'd2r1' and 'dd' histograms (None if the stage is not
+        used), 'time', the wall time of each stage, and 'schedule', the
+        chunk records of each stage (see ChunkQueue.records) """
+
+    if workers <= 0:
+        raise ValueError('workers must be at least 1')
+    if job_helper is None:
+        job_helper = JobHelper(1)
+        job_helper.set_current_job(0, verbose=False)
+    if nchunks is None:
+        nchunks = 4 * workers
+    if costs is None:
+        costs = {}
+    same = (preprocess_params['d2r1'] is None)
+    stages = [key for key in STAGES if preprocess_params[key] is not None]
+
+    store = SharedStore()
+    acc = {}
+    queue = None
+    try:
+        shared = {}
+        accumulators = {}
+        kwargs = {}
+        for key in stages:
+            kwargs[key] = get_stage_kwargs(key, bins, same, chunk_size,
+                                           backend, rr_backend, weighted,
+                                           weighted_dtype, unweighted_dtype)
+            shared[key] = store.put_stage(preprocess_params[key])
+            accumulators[key], acc[key] = _share_accumulators(
+                store, workers, get_stage_zeros(key, bins, kwargs[key]))
+
+        results = {'time': {}, 'schedule': {}}
+        counter = mp.Value('i', 0)
+        lock = mp.Lock()
+        with mp.Pool(workers, _init_worker,
+                     (shared, accumulators, counter, lock)) as pool:
+            for key in STAGES:
+                if key not in stages:
+                    results[key] = None
+                    continue
+                print('')
+                print('calculate %s with %d workers' % (key, workers))
+                start_time = time.time()
+
+                # split the index range of the job into chunks
+                size = preprocess_params[key]['pair_catalog'].shape[0]
+                cost = costs.get(key)
+                if cost is None:
+                    cost = np.ones(size)
+                job_helper.set_cost(costs.get(key))
+                start, end = job_helper.get_index_range(size)
+                edges = balance_ranges(cost, nchunks, start, end)
+                edges = np.unique(edges)
+                total = np.concatenate([[0.], np.cumsum(cost)])
+                queue = ChunkQueue(edges, total[edges[1:]] - total[edges[:-1]],
+                                   workers, store)
+
+                with lmetrics.stage(metrics, key) as record:
+                    task = (key, queue.desc, kwargs[key], record is not None)
+                    summaries = pool.map(_work_loop, [task] * workers,
+                                         chunksize=1)
+                    for summary in summaries:
+                        if summary is not None:
+                            record.merge(summary)
+
+                    # reduce the worker accumulators
+                    if isinstance(acc[key], lhistogram.Histogram):
+                        results[key] = get_stage_zeros(key, bins, kwargs[key])
+                        for slot in range(workers):
+                            results[key] += _slot(acc[key], slot)
+                    else:
+                        results[key] = acc[key].sum(axis=0)
+                results['schedule'][key] = queue.records()
+                results['time'][key] = time.time() - start_time
+                print("--- %f seconds ---" % results['time'][key])
+            job_helper.set_cost(None)
+    finally:
+        # views must be released before the blocks are closed
+        acc.clear()
+        queue = None
+        store.close()
+
+    return results
@@ -0,0 +1,456 @@
+""" Module to predict the runtime, memory and disk use of a run before it is
+submitted. Array sizes follow from the binning, catalog sizes from the FITS
+headers, and pair counts from the neighbours of a sample of the catalogs. """
+
+# Standard Python modules
+import io
+import json
+import contextlib
+
+import numpy as np
+from astropy.io import fits
+from astropy.table import Table
+from sklearn.neighbors import BallTree
+
+from KITCAT import io as lio
+from KITCAT import bins as lbins
+from KITCAT import catalog as lcatalog
+from KITCAT import cosmology as lcosmology
+
+# number of catalog rows sampled to estimate the neighbour counts
+NSAMPLE = 10000
+
+# pairs per second of one process in each stage, see KITCAT_combinatorial -t
+PAIRS_PER_SECOND = {'rr': 3e6, 'd1r2': 3e6, 'd2r1': 3e6, 'dd': 6e5}
+
+# cost of a query point in units of one pair
+OVERHEAD = 1.
+
+# memory of the interpreter and modules, and bytes per tree point and per
+# neighbour of a batched query
+BASE_BYTES = 200 * 1024**2
+TREE_BYTES = 40
+QUERY_BYTES = 48
+
+# largest number of z slices tried by recommend
+MAX_NSLICE = 64
+
+def count_rows(path):
+    """ return the number of rows of a catalog. Only the header is read for
+    FITS files. """
+    if path.lower().endswith(lcatalog.FITS_EXTENSIONS):
+        with fits.open(path, memmap=True) as hdul:
+            for hdu in hdul:
+                if isinstance(hdu, (fits.BinTableHDU, fits.TableHDU)):
+                    return int(hdu.header['NAXIS2'])
+        raise ValueError('no table found in %s' % path)
+    return len(Table.read(path))
+
+def sample_catalog(catalog_params, limit, nsample=NSAMPLE, seed=0):
+    """ return (dec, ra) of a random sample of the rows of a catalog within
+    the limits, and the fraction of the sampled rows within the limits
+
+    Parameters:
+    -----------
+    catalog_params: dict
+        GALAXY or RANDOM section of the config
+    limit: dict
+        bins.limit
+    nsample: int (default=NSAMPLE)
+        number of rows read
+    seed: int (default=0)
+
+    Returns:
+    --------
+    sample: array of shape (n, 2)
+    fraction: float """
+    names = [catalog_params['dec'], catalog_params['ra'],
+             catalog_params['z']]
+    hdul, columns = lcatalog.read_columns(catalog_params['path'], names)
+    try:
+        n_rows = len(columns[names[0]])
+        rng = np.random.RandomState(seed)
+        index = np.sort(rng.choice(n_rows, min(nsample, n_rows),
+                                   replace=False))
+        dec = np.deg2rad(np.asarray(columns[names[0]][index], dtype=float))
+        ra = np.deg2rad(np.asarray(columns[names[1]][index], dtype=float))
+        z = np.asarray(columns[names[2]][index], dtype=float)
+    finally:
+        del columns
+        if hdul is not None:
+            hdul.close()
+    keep = ((limit['dec'][0] <= dec) & (dec <= limit['dec'][1]) &
+            (limit['ra'][0] <= ra) & (ra <= limit['ra'][1]) &
+            (limit['z'][0] <= z) & (z <= limit['z'][1]))
+    return np.array([dec[keep], ra[keep]]).T, keep.mean() if len(keep) else 0.
+
+def grid_points(bins, sample, n_rows):
+    """ return (dec, ra) of the cells of the angular grid of RandomCatalog
+    that are likely to be occupied by n_rows randoms. The footprint is
+    judged from a sample of the randoms on a coarser grid with about 10
+    sampled rows per cell. """
+    dec_nbins = bins.num_bins('dec')
+    ra_nbins = bins.num_bins('ra')
+    factor = max(1, int(np.ceil(np.sqrt(10. * dec_nbins * ra_nbins /
+                                        max(len(sample), 1)))))
+    idec = np.minimum(((sample[:, 0] - bins.min('dec')) / bins.binw('dec'))
+                      .astype(int) // factor, dec_nbins - 1)
+    ira = np.minimum(((sample[:, 1] - bins.min('ra')) / bins.binw('ra'))
+                     .astype(int) // factor, ra_nbins - 1)
+    occupied = np.zeros((dec_nbins // factor + 1, ra_nbins // factor + 1),
+                        dtype=bool)
+    occupied[idec, ira] = True
+
+    dec = bins.bins('dec')
+    ra = bins.bins('ra')
+    grid_dec, grid_ra = np.meshgrid(0.5 * (dec[:-1] + dec[1:]),
+                                    0.5 * (ra[:-1] + ra[1:]), indexing='ij')
+    keep = occupied[np.arange(dec_nbins)[:, None] // factor,
+                    np.arange(ra_nbins)[None, :] // factor]
+    points = np.array([grid_dec[keep], grid_ra[keep]]).T
+
+    # expected number of cells hit by n_rows uniform randoms
+    n_cells = len(points)
+    n_hit = int(round(n_cells * -np.expm1(-n_rows / max(n_cells, 1))))
+    stride = n_cells / max(n_hit, 1)
+    return points[(np.arange(n_hit) * stride).astype(int)]
+
+def pixel_points(sample, n_rows, nside):
+    """ return (dec, ra) of the NESTED HEALPix pixels of RandomCatalog that
+    are likely to be occupied by n_rows randoms, see grid_points. The
+    footprint is judged from a sample of the randoms on coarser pixels with
+    about 10 sampled rows per pixel. Requires healpy. """
+    from KITCAT import healpix as lhealpix
+    if len(sample) == 0:
+        return np.zeros((0, 2))
+    coarse_nside = nside
+    coarse = np.unique(lhealpix.ang2pix(coarse_nside, sample))
+    while coarse_nside > 1 and len(coarse) > len(sample) / 10.:
+        coarse_nside //= 2
+        coarse = np.unique(lhealpix.ang2pix(coarse_nside, sample))
+
+    # the NESTED children of each occupied coarse pixel
+    factor = (nside // coarse_nside)**2
+    pixels = (coarse[:, None] * factor + np.arange(factor)).ravel()
+
+    # expected number of pixels hit by n_rows uniform randoms
+    n_cells = len(pixels)
+    n_hit = int(round(n_cells * -np.expm1(-n_rows / max(n_cells, 1))))
+    stride = n_cells / max(n_hit, 1)
+    pixels = pixels[(np.arange(n_hit) * stride).astype(int)]
+    colatitude, ra = lhealpix.hp.pix2ang(nside, pixels, nest=True)
+    return np.array([0.5 * np.pi - colatitude, ra]).T
+
+def plan_nside(bins, sample, n_rows):
+    """ return the default NSIDE of KITCAT_preprocess --healpix, the
+    highest resolution with at most as many pixels as grid cells, judged
+    with pixel_points and grid_points """
+    n_grid = len(grid_points(bins, sample, n_rows))
+    nside = 1
+    while nside < 2**29 and \
+            len(pixel_points(sample, n_rows, 2 * nside)) <= n_grid:
+        nside *= 2
+    return nside
+
+def mean_neighbours(points, tree_points, radius, scale=1., nsample=NSAMPLE):
+    """ return the mean number of tree_points within radius of at most
+    nsample of the points, times scale """
+    if len(points) == 0 or len(tree_points) == 0:
+        return 0.
+    tree = BallTree(tree_points, metric='haversine')
+    stride = max(1, len(points) // nsample)
+    count = tree.query_radius(points[::stride], r=radius, count_only=True)
+    return scale * float(np.mean(count))
+
+def config_stages(config, bins, same, nsample=NSAMPLE, nside=None):
+    """ return the sizes of the combinatorial stages of a config, from the
+    FITS headers and the neighbours of a sample of each catalog. If nside
+    is given, randoms are counted in HEALPix pixels as with
+    KITCAT_preprocess --healpix NSIDE, 0 for its default resolution.
+
+    Returns:
+    --------
+    stages: dict
+        'rr', 'd1r2', 'd2r1' and 'dd' (None if same) with the number of
+        pair catalog points 'pair', of tree catalog points 'tree' and the
+        mean neighbours per pair catalog point 'neighbours'
+    rows: dict
+        number of rows of 'd1', 'd2', 'r1' and 'r2' within the limits """
+    theta_max = bins.max('theta')
+    rows = {}
+    samples = {}
+    for key, section in [('d1', 'GALAXY_1'), ('d2', 'GALAXY_2'),
+                         ('r1', 'RANDOM_1'), ('r2', 'RANDOM_2')]:
+        params = lio.parse_config(config, section)
+        samples[key], fraction = sample_catalog(params, bins.limit, nsample)
+        rows[key] = int(round(count_rows(params['path']) * fraction))
+
+    if nside == 0:
+        nside = plan_nside(bins, samples['r1'], rows['r1'])
+    if nside is None:
+        grids = {key: grid_points(bins, samples[key], rows[key])
+                 for key in ('r1', 'r2')}
+    else:
+        grids = {key: pixel_points(samples[key], rows[key], nside)
+                 for key in ('r1', 'r2')}
+    scale_d2 = rows['d2'] / max(len(samples['d2']), 1)
+
+    # trees are built from the larger catalog, see KITCAT_preprocess
+    rr_pair, rr_tree = sorted([grids['r1'], grids['r2']], key=len)
+    stages = {
+        'rr': {'pair': len(rr_pair), 'tree': len(rr_tree),
+               'neighbours': mean_neighbours(rr_pair, rr_tree, theta_max)},
+        'd1r2': {'pair': rows['d1'], 'tree': len(grids['r2']),
+                 'neighbours': mean_neighbours(samples['d1'], grids['r2'],
+                                               theta_max)},
+        'd2r1': None,
+        'dd': {'pair': min(rows['d1'], rows['d2']),
+               'tree': max(rows['d1'], rows['d2']),
+               'neighbours': mean_neighbours(samples['d1'], samples['d2'],
+                                             theta_max, scale_d2)}}
+    if same:
+        # each sampled point finds itself once, not scale_d2 times
+        stages['dd']['neighbours'] += 1. - scale_d2
+    if not same:
+        stages['d2r1'] = {'pair': rows['d2'], 'tree': len(grids['r1']),
+                          'neighbours': mean_neighbours(
+                              samples['d2'], grids['r1'], theta_max)}
+    return stages, rows
+
+def preprocess_stages(preprocess_params, bins, nsample=NSAMPLE):
+    """ return the sizes of the combinatorial stages of a preprocess output,
+    see config_stages. Neighbours are counted with the stored trees. """
+    stages = {}
+    for key in ('rr', 'd1r2', 'd2r1', 'dd'):
+        params = preprocess_params[key]
+        if params is None:
+            stages[key] = None
+            continue
+        pair_catalog = params['pair_catalog']
+        stride = max(1, pair_catalog.shape[0] // nsample)
+        count = lcatalog.angular_query(
+            params['tree'], np.asarray(pair_catalog[::stride]),
+            bins.max('theta'), count_only=True)
+        stages[key] = {'pair': pair_catalog.shape[0],
+                       'tree': params['tree_catalog'].shape[0],
+                       'neighbours': float(np.mean(count)) if len(count)
+                                     else 0.}
+    return stages
+
+def histogram_bytes(bins, same, weighted_dtype='float64',
+                    unweighted_dtype='float64'):
+    """ return the bytes of each histogram of a job in the output dtypes """
+    n_theta = bins.num_bins('theta')
+    n_z = bins.num_bins('z')
+    cells = {'ftheta': n_theta,
+             'ztheta_d1r2': n_theta * n_z,
+             'ztheta_d2r1': 0 if same else n_theta * n_z,
+             'zztheta': n_theta * n_z * (2 * bins.band + 1)}
+    half = (np.dtype(weighted_dtype).itemsize +
+            np.dtype(unweighted_dtype).itemsize)
+    return {key: (value * 8 if key == 'ftheta' else value * half)
+            for key, value in cells.items()}
+
+def estimate(bins, stages, same, njob=1, workers=0, n_cosmos=1,
+             chunk_size=1000, itemsize=8, weighted_dtype='float64',
+             unweighted_dtype='float64', pairs_per_second=PAIRS_PER_SECOND):
+    """ predict pair counts, CPU time, memory and disk use of a run
+
+    Parameters:
+    -----------
+    bins: bins.Bins
+    stages: dict
+        output of config_stages or preprocess_stages
+    same: bool
+        True for an auto-correlation
+    njob: int (default=1)
+        number of combinatorial jobs
+    workers: int (default=0)
+        worker processes per job
+    n_cosmos: int (default=1)
+        number of cosmological models
+    chunk_size: int (default=1000)
+        points per batched query
+    itemsize: int (default=8)
+        bytes per catalog value, 4 for --dtype float32
+    weighted_dtype, unweighted_dtype: str
+        dtypes of the histograms in the output
+    pairs_per_second: dict (default=PAIRS_PER_SECOND)
+        pairs per second of one process in each stage
+
+    Returns:
+    --------
+    plan: dict
+        'stages' with the pairs and CPU seconds of each stage, 'arrays' with
+        the bytes of each histogram, 'memory' with the peak bytes of a job,
+        'disk' with the bytes of each output, and 'cpu_seconds' and
+        'wall_seconds' of a job """
+
+    plan = {'stages': {}, 'njob': njob, 'workers': workers}
+    cpu_seconds = 0.
+    catalog_bytes = 0
+    query_bytes = 0
+    tree_bytes = {}
+    for key, stage in stages.items():
+        if stage is None:
+            continue
+        pairs = stage['pair'] * stage['neighbours']
+        if same and key == 'dd':
+            # the neighbours include the point itself, and each unordered
+            # pair is visited once
+            pairs = 0.5 * (pairs - stage['pair'])
+        seconds = (pairs + OVERHEAD * stage['pair']) / pairs_per_second[key]
+        plan['stages'][key] = dict(stage, pairs=pairs, cpu_seconds=seconds)
+        cpu_seconds += seconds
+
+        # catalogs and trees of the largest stage are touched at once
+        catalog_bytes = max(catalog_bytes,
+                            (stage['pair'] + stage['tree']) * 4 * itemsize +
+                            stage['tree'] * TREE_BYTES)
+        query_bytes = max(query_bytes,
+                          chunk_size * stage['neighbours'] * QUERY_BYTES)
+        tree_bytes[(stage['tree'], key == 'dd')] = stage['tree'] * TREE_BYTES
+
+    plan['arrays'] = histogram_bytes(bins, same, weighted_dtype,
+                                     unweighted_dtype)
+    output = sum(plan['arrays'].values())
+
+    # histograms are allocated in the output dtypes: each worker holds its
+    # accumulator and the histogram of its current chunk, and the parent the
+    # reduced histogram
+    processes = max(workers, 1)
+    plan['memory'] = {
+        'base': BASE_BYTES,
+        'catalogs': catalog_bytes,
+        'histograms': output * (2*workers + 1),
+        'queries': query_bytes * processes}
+    plan['memory']['total'] = sum(plan['memory'].values())
+
+    # a pickled cosmology holds its comoving table and two interpolators,
+    # about six times the size of the table
+    n_s = bins.num_bins('s')
+    table_bytes = (int(lcosmology.Z_MAX / lcosmology.Z_STEP) + 1) * 2 * 8
+    cosmos_bytes = n_cosmos * 6 * table_bytes
+    catalogs = sum(stage['pair'] * 4 * itemsize
+                   for stage in stages.values() if stage is not None)
+    plan['disk'] = {
+        'preprocess': catalogs + sum(tree_bytes.values()) + cosmos_bytes,
+        'divide': output * njob + cosmos_bytes,
+        'combine': output + cosmos_bytes,
+        'output': 4 * n_cosmos * 2 * (n_s + n_s**2) * 8}
+
+    plan['cpu_seconds'] = cpu_seconds / njob
+    plan['wall_seconds'] = plan['cpu_seconds'] / processes
+    return plan
+
+def config_plan(config, islice=0, nslice=1, nsample=NSAMPLE, nside=None,
+                **kwargs):
+    """ return the bins, rows and estimate of z slice islice of a config.
+    nside is passed to config_stages and kwargs to estimate. """
+    general_params = lio.parse_config(config, 'GENERAL')
+    same = not general_params['x_correlation']
+    cosmos_params = lio.parse_config(config, 'COSMOLOGY')
+    cosmos_list = [lcosmology.Cosmology(
+        hubble0   = cosmos_params['hubble0'][i],
+        omega_m0  = cosmos_params['omega_m0'][i],
+        omega_de0 = cosmos_params['omega_de0'][i])
+                   for i in range(cosmos_params['n_cosmos'])]
+    with contextlib.redirect_stdout(io.StringIO()):
+        bins = lbins.Bins(
+            limit_params = lio.parse_config(config, 'LIMIT'),
+            nbins_params = lio.parse_config(config, 'NBINS'),
+            min_cosmo    = lcosmology.min_cosmo(cosmos_list),
+            max_cosmo    = lcosmology.max_cosmo(cosmos_list),
+            islice       = islice,
+            nslice       = nslice)
+    stages, rows = config_stages(config, bins, same, nsample, nside)
+    kwargs.setdefault('n_cosmos', len(cosmos_list))
+    return bins, rows, estimate(bins, stages, same, **kwargs)
+
+def recommend(config, memory_gb, hours, workers=0, nsample=NSAMPLE,
+              **kwargs):
+    """ return the smallest nslice whose jobs fit in memory_gb, and the
+    njob that brings the wall time of a job under hours. With manual
+    binning, every slice has the configured number of z bins, so slicing
+    only shrinks the catalogs; the search stops once the memory of a job no
+    longer decreases and returns the best nslice found.
+
+    Returns:
+    --------
+    nslice, njob: int
+    plan: dict
+        estimate of the first slice with njob jobs """
+    best = None
+    for nslice in range(1, MAX_NSLICE + 1):
+        _, _, plan = config_plan(config, 0, nslice, nsample, workers=workers,
+                                 **kwargs)
+        memory = plan['memory']['total']
+        if best is not None and memory >= best[1]['memory']['total']:
+            break
+        best = (nslice, plan)
+        if memory <= memory_gb * 1024**3:
+            break
+    nslice, plan = best
+    njob = recommend_njob(plan, hours)
+    _, _, plan = config_plan(config, 0, nslice, nsample, njob=njob,
+                             workers=workers, **kwargs)
+    return nslice, njob, plan
+
+def recommend_njob(plan, hours):
+    """ return the number of jobs that brings the wall time of a job of
+    plan under hours """
+    return max(1, int(np.ceil(plan['wall_seconds'] * plan['njob'] /
+                              (hours * 3600.))))
+
+def calibrate(fname):
+    """ return PAIRS_PER_SECOND updated with the pairs per CPU second of
+    the stages of a metrics file saved by KITCAT_combinatorial -t """
+    with open(fname) as f:
+        metrics = json.load(f)
+    rates = dict(PAIRS_PER_SECOND)
+    # an auto-correlation has no d2r1 stage
+    same = all(stage['stage'] != 'd2r1' for stage in metrics['stages'])
+    for stage in metrics['stages']:
+        if stage['stage'] in rates and stage['pairs'] > 0:
+            pairs = stage['pairs']
+            if same and stage['stage'] == 'dd':
+                # queries return both orders and the point itself, see
+                # estimate
+                pairs = 0.5 * (pairs - stage['queries'])
+            rates[stage['stage']] = pairs / stage['cpu_time']
+    return rates
+
+def _size(n_bytes):
+    """ format bytes """
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if n_bytes < 1024.:
+            return '%.1f %s' % (n_bytes, unit)
+        n_bytes /= 1024.
+    return '%.1f TB' % n_bytes
+
+def print_plan(bins, plan, rows=None):
+    """ print a plan returned by estimate """
+    bins.print_info()
+    if rows is not None:
+        print('- catalog rows within limits:')
+        for key, value in rows.items():
+            print(' + %10s: %12d' % (key, value))
+    print('- histograms per job:')
+    for key, value in plan['arrays'].items():
+        print(' + %12s: %12s' % (key, _size(value)))
+    print('- stages (all jobs):')
+    print(' + %6s %12s %12s %12s %14s %12s' %
+          ('stage', 'points', 'tree', 'neighbours', 'pairs', 'cpu hours'))
+    for key, stage in plan['stages'].items():
+        print(' + %6s %12d %12d %12.1f %14.4e %12.3f' %
+              (key, stage['pair'], stage['tree'], stage['neighbours'],
+               stage['pairs'], stage['cpu_seconds'] / 3600.))
+    print('- peak memory per job:')
+    for key, value in plan['memory'].items():
+        print(' + %12s: %12s' % (key, _size(value)))
+    print('- disk:')
+    for key, value in plan['disk'].items():
+        print(' + %12s: %12s' % (key, _size(value)))
+    print('- per job: %.3f cpu hours, %.3f wall hours (%d jobs, %d workers)'
+          % (plan['cpu_seconds'] / 3600., plan['wall_seconds'] / 3600.,
+             plan['njob'], plan['workers']))
@@ -0,0 +1,183 @@
+""" Module for sparse projection operators that map (theta, z1, z2) cells
+onto separation bins s and (sigma, pi) """
+
+# Standard Python modules
+import os
+
+# Python modules
+import numpy as np
+from scipy import sparse
+
+def bin_index(x, edges):
+    """ bin index of x with the same assignment as np.histogram and
+    np.histogram2d with array bins. Values outside the edges get -1. """
+    nbins = len(edges) - 1
+    index = np.searchsorted(edges, x, side='right') - 1
+    index[x == edges[-1]] = nbins - 1
+    index[(index < 0) | (index >= nbins)] = -1
+    return index
+
+def find_band(r, s_max, theta_max):
+    """ return the number of z bins on each side of the diagonal whose
+    comoving distance r can be separated by less than s_max in s, sigma or
+    pi, for angular separation up to theta_max """
+    dels = s_max / np.cos(theta_max / 2.)
+    upper = np.searchsorted(r, r + dels, side='right') - 1
+    lower = np.searchsorted(r, r - dels, side='left')
+    index = np.arange(len(r))
+    band = max(np.max(upper - index), np.max(index - lower), 0)
+    return int(min(band, len(r) - 1))
+
+def shift_band(values, band):
+    """ return values of shape (..., 2*b+1) banded around the diagonal with
+    half-width b re-banded with half-width band. Offsets beyond the new band
+    are dropped, new offsets are filled with zeros. """
+    old = values.shape[-1] // 2
+    if old == band:
+        return values
+    out = np.zeros(values.shape[:-1] + (2*band + 1,), dtype=values.dtype)
+    width = min(old, band)
+    out[..., band - width:band + width + 1] = \
+        values[..., old - width:old + width + 1]
+    return out
+
+def band_partner(nz, band):
+    """ return the z bin b = a + d - band paired with each (a, d) cell, and a
+    mask of the cells where b is a valid z bin
+
+    Returns:
+    --------
+    b: array of int of shape (nz, 2*band+1)
+    valid: array of bool of shape (nz, 2*band+1) """
+    a, d = np.indices((nz, 2*band + 1))
+    b = a + d - band
+    valid = (b >= 0) & (b < nz)
+    return np.where(valid, b, 0), valid
+
+
+class Projection(object):
+    """ Class to hold the operators of one cosmology. Cells are indexed by
+    (theta bin t, z bin a, band offset d), pairing comoving distances r[a] and
+    r[a + d - band] at angular separation theta[t]. Each operator is a sparse
+    matrix with one column per cell and one row per separation bin. """
+
+    def __init__(self, theta, r, s, band):
+        """ build the operators
+
+        Parameters:
+        -----------
+        theta: array of shape (theta_nbins,)
+            angular separation of the theta bin centres
+        r: array of shape (z_nbins,)
+            comoving distance of the z bin centres
+        s: array of shape (s_nbins+1,)
+            separation bin edges
+        band: int
+            number of z bins on each side of the diagonal """
+
+        self.band = band
+        self.shape = (len(theta), len(r), 2*band + 1)
+        n_s = len(s) - 1
+        n_cells_t = self.shape[1] * self.shape[2]
+        b, valid = band_partner(len(r), band)
+        pt_r = np.broadcast_to(r[:, None], b.shape)[valid]
+        other_r = r[b[valid]]
+        cells = np.flatnonzero(valid)
+
+        # one theta bin at a time to bound memory
+        sin_2 = np.sin(theta/2.)
+        cos_2 = np.cos(theta/2.)
+        cos = np.cos(theta)
+        rows_1d, cols_1d, rows_2d, cols_2d = [], [], [], []
+        for t in range(len(theta)):
+            dist = np.sqrt(pt_r**2 + other_r**2 - 2*other_r*pt_r * cos[t])
+            index = bin_index(dist, s)
+            keep = index >= 0
+            rows_1d.append(index[keep])
+            cols_1d.append(t*n_cells_t + cells[keep])
+
+            sigma = bin_index(sin_2[t] * (pt_r + other_r), s)
+            pi = bin_index(cos_2[t] * np.abs(pt_r - other_r), s)
+            keep = (sigma >= 0) & (pi >= 0)
+            rows_2d.append(sigma[keep] * n_s + pi[keep])
+            cols_2d.append(t*n_cells_t + cells[keep])
+
+        n_cells = int(np.prod(self.shape))
+        self.op_1d = self._operator(rows_1d, cols_1d, (n_s, n_cells))
+        self.op_2d = self._operator(rows_2d, cols_2d, (n_s*n_s, n_cells))
+        self.n_s = n_s
+
+    def save(self, dirname):
+        """ save the operators as .npy arrays in dirname """
+        np.save(os.path.join(dirname, 'shape.npy'),
+                np.array(self.shape + (self.n_s,)))
+        for name in ('op_1d', 'op_2d'):
+            op = getattr(self, name)
+            for key in ('data', 'indices', 'indptr'):
+                np.save(os.path.join(dirname, '%s_%s.npy' % (name, key)),
+                        getattr(op, key))
+
+    @classmethod
+    def load(cls, dirname, mmap_mode='r'):
+        """ load operators saved by Projection.save. The arrays are memory-
+        mapped, not copied. """
+        projection = cls.__new__(cls)
+        shape = np.load(os.path.join(dirname, 'shape.npy'))
+        projection.shape = tuple(int(x) for x in shape[:3])
+        projection.n_s = int(shape[3])
+        projection.band = projection.shape[2] // 2
+        n_cells = int(np.prod(projection.shape))
+        for name, n_rows in (('op_1d', projection.n_s),
+                             ('op_2d', projection.n_s**2)):
+            arrays = [np.load(os.path.join(dirname, '%s_%s.npy' % (name, key)),
+                              mmap_mode=mmap_mode)
+                      for key in ('data', 'indices', 'indptr')]
+            setattr(projection, name,
+                    sparse.csr_matrix(tuple(arrays), shape=(n_rows, n_cells),
+                                      copy=False))
+        return projection
+
+    def widen(self, band):
+        """ return op_1d and op_2d on cells banded with the half-width
+        band >= self.band, e.g. to stack the operators of several
+        cosmologies. Cells beyond self.band have no entries. """
+        if band < self.band:
+            raise ValueError('band %d is narrower than %d' % (band, self.band))
+        if band == self.band:
+            return self.op_1d, self.op_2d
+        n_theta, nz, width = self.shape
+        new_width = 2*band + 1
+        ops = []
+        for op in (self.op_1d, self.op_2d):
+            op = op.tocoo()
+            cell, d = np.divmod(op.col, width)
+            cols = cell * new_width + d + band - self.band
+            ops.append(sparse.csr_matrix((op.data, (op.row, cols)),
+                                         shape=(op.shape[0],
+                                                n_theta*nz*new_width)))
+        return ops[0], ops[1]
+
+    @staticmethod
+    def _operator(rows, cols, shape):
+        """ sparse matrix with ones at (rows, cols) """
+        rows = np.concatenate(rows)
+        cols = np.concatenate(cols)
+        return sparse.csr_matrix((np.ones(len(rows)), (rows, cols)),
+                                 shape=shape)
+
+    def project(self, values):
+        """ project cell values onto the separation bins
+
+        Parameters:
+        -----------
+        values: array of shape (theta_nbins, z_nbins, 2*band+1)
+
+        Returns:
+        --------
+        hist_1d: array of shape (s_nbins, 1)
+        hist_2d: array of shape (s_nbins, s_nbins)
+            histogram in (sigma, pi) """
+        values = np.ascontiguousarray(values).reshape(-1)
+        hist_1d = self.op_1d.dot(values).reshape(-1, 1)
+        hist_2d = self.op_2d.dot(values).reshape(self.n_s, self.n_s)
+        return hist_1d, hist_2d
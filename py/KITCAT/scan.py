@@ -0,0 +1,254 @@
+""" Module to integrate the cosmology-independent histograms of a combine
+output over many cosmological models. The models are evaluated in batches
+and the correlation functions are streamed to memory-mapped .npy files, so
+memory does not grow with the number of models. """
+
+# Standard Python modules
+import os
+import time
+import itertools
+import multiprocessing as mp
+
+# Python modules
+import numpy as np
+from scipy import sparse
+
+from KITCAT import correlation as lcorrelation
+from KITCAT import cosmology as lcosmology
+from KITCAT import parallel as lparallel
+from KITCAT.helper import get_projection
+from KITCAT.projection import band_partner, shift_band
+
+# columns of the cell values, weighted [0] and unweighted [1] of each count
+COLUMNS = ('rr', 'd1r2', 'd2r1', 'dd')
+
+# geometry and shared cell values of this worker
+_worker = {}
+
+def make_grid(hubble0, omega_m0, omega_de0, flat=False):
+    """ return the (H0, Om0, Ode0) samples of a grid
+
+    Parameters:
+    -----------
+    hubble0, omega_m0, omega_de0: list of float
+        values of each parameter. omega_de0 is ignored if flat.
+    flat: bool (default=False)
+        if True, Ode0 = 1 - Om0
+
+    Returns:
+    --------
+    samples: array of shape (n_models, 3) """
+    if flat:
+        samples = [(h, om, 1. - om)
+                   for h, om in itertools.product(hubble0, omega_m0)]
+    else:
+        samples = list(itertools.product(hubble0, omega_m0, omega_de0))
+    return np.array(samples, dtype=float).reshape(-1, 3)
+
+def read_samples(fname, columns=(0, 1, 2), flat=False):
+    """ return the (H0, Om0, Ode0) samples of a text file, e.g. an MCMC chain
+
+    Parameters:
+    -----------
+    fname: str
+        whitespace separated text file, lines starting with # are skipped
+    columns: tuple of int (default=(0, 1, 2))
+        columns of H0, Om0 and Ode0. The Ode0 column is ignored if flat.
+    flat: bool (default=False)
+        if True, Ode0 = 1 - Om0
+
+    Returns:
+    --------
+    samples: array of shape (n_models, 3) """
+    columns = list(columns[:2]) if flat else list(columns[:3])
+    samples = np.loadtxt(fname, usecols=columns, ndmin=2)
+    if flat:
+        samples = np.column_stack([samples, 1. - samples[:, 1]])
+    return samples
+
+def get_cell_values(helper, band):
+    """ return the cosmology-independent value of each (theta, z, band
+    offset) cell for RR, D1R2, D2R1 and DD
+
+    Returns:
+    --------
+    values: array of shape (theta_nbins * z_nbins * (2*band+1), 8)
+        columns are the weighted and unweighted counts of COLUMNS """
+    z1_distr = helper.z1_distr
+    z2_distr = helper.z2_distr if helper.z2_distr is not None else z1_distr
+    ztheta_d2r1 = helper.ztheta_d2r1
+    if ztheta_d2r1 is None:
+        ztheta_d2r1, z1_for_d2r1 = helper.ztheta_d1r2, z2_distr
+    else:
+        z1_for_d2r1 = z1_distr
+    b, valid = band_partner(len(z1_distr[0]), band)
+    zztheta = [shift_band(helper.zztheta[j], band) for j in range(2)]
+
+    shape = zztheta[0].shape
+    values = np.empty((int(np.prod(shape)), 2 * len(COLUMNS)))
+    for j in range(2):
+        # see CorrelationHelper.get_rr, get_dr and get_dd
+        w = z2_distr[j][:, None] * z1_distr[j][b] * valid
+        values[:, j] = (helper.ftheta[:, None, None] * w[None]).ravel()
+        values[:, 2 + j] = (z2_distr[j][None, :, None] *
+                            helper.ztheta_d1r2[j][:, b] * valid).ravel()
+        values[:, 4 + j] = (z1_for_d2r1[j][None, :, None] *
+                            ztheta_d2r1[j][:, b] * valid).ravel()
+        values[:, 6 + j] = zztheta[j].ravel()
+    return values
+
+def _init_worker(values, bins, band, cache):
+    """ attach a worker to the shared cell values """
+    _worker['values'] = lparallel.attach(values)
+    _worker['geometry'] = (bins, band, cache)
+
+def _project_batch(samples):
+    """ return the counts of a batch of models, of shape (n_models, 8, n_s)
+    and (n_models, 8, n_s, n_s), and a mask of the models that need a wider
+    band than the band of the histograms. Their counts are zero. """
+    bins, band, cache = _worker['geometry']
+    n_s = bins.num_bins('s')
+    n_cells = bins.num_bins('theta') * bins.num_bins('z') * (2*band + 1)
+    ops_1d, ops_2d = [], []
+    wide = np.zeros(len(samples), dtype=bool)
+    for k, (hubble0, omega_m0, omega_de0) in enumerate(samples):
+        cosmo = lcosmology.Cosmology(hubble0   = hubble0,
+                                     omega_m0  = omega_m0,
+                                     omega_de0 = omega_de0)
+        projection = get_projection(bins, cosmo, cache, verbose=False)
+        if projection.band > band:
+            # pairs beyond the counted band are missing from DD
+            wide[k] = True
+            ops_1d.append(sparse.csr_matrix((n_s, n_cells)))
+            ops_2d.append(sparse.csr_matrix((n_s*n_s, n_cells)))
+            continue
+        op_1d, op_2d = projection.widen(band)
+        ops_1d.append(op_1d)
+        ops_2d.append(op_2d)
+
+    # one product for every model and count of the batch
+    values = _worker['values']
+    counts_1d = sparse.vstack(ops_1d, format='csr').dot(values)
+    counts_2d = sparse.vstack(ops_2d, format='csr').dot(values)
+    n_models = len(samples)
+    counts_1d = counts_1d.reshape(n_models, n_s, -1).transpose(0, 2, 1)
+    counts_2d = counts_2d.reshape(n_models, n_s, n_s, -1).transpose(0, 3, 1, 2)
+    return counts_1d, counts_2d, wide
+
+def _open_outputs(out_dir, n_models, n_s):
+    """ create the memory-mapped output files """
+    outputs = {}
+    for key, shape in [('xi_1d', (n_models, 2, n_s, 1)),
+                       ('xi_err_1d', (n_models, 2, n_s, 1)),
+                       ('xi_2d', (n_models, 2, n_s, n_s)),
+                       ('xi_err_2d', (n_models, 2, n_s, n_s))]:
+        outputs[key] = np.lib.format.open_memmap(
+            os.path.join(out_dir, '%s.npy' % key), mode='w+', dtype=float,
+            shape=shape)
+    return outputs
+
+def scan(helper, samples, out_dir, batch_size=16, workers=1, cache=None):
+    """ calculate the two-point correlation function of each model and
+    write it to out_dir
+
+    Parameters:
+    -----------
+    helper: helper.CorrelationHelper
+        combine output
+    samples: array of shape (n_models, 3)
+        (H0, Om0, Ode0) of each model
+    out_dir: str
+        output directory. Holds params.npy (samples), s.npy (separation bin
+        edges), xi_1d.npy and xi_err_1d.npy of shape (n_models, 2, n_s, 1),
+        and xi_2d.npy and xi_err_2d.npy of shape (n_models, 2, n_s, n_s).
+        The second axis is weighted [0] and unweighted [1]. Models that
+        need a wider z band than the DD histogram are NaN, their indices
+        are in wide.npy.
+    batch_size: int (default=16)
+        number of models projected together. Memory grows with batch_size
+        and workers, not with the number of models.
+    workers: int (default=1)
+        number of processes
+    cache: cache.Cache (default=None)
+        if given, the projection operators of each model are read from or
+        stored in the on-disk cache """
+
+    samples = np.asarray(samples, dtype=float).reshape(-1, 3)
+    n_models = len(samples)
+    bins = helper.bins
+    s = bins.bins('s')
+    n_s = len(s) - 1
+    band = helper.zztheta.shape[-1] // 2
+
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    np.save(os.path.join(out_dir, 'params.npy'), samples)
+    np.save(os.path.join(out_dir, 's.npy'), s)
+    outputs = _open_outputs(out_dir, n_models, n_s)
+
+    print('- number of models: %d' % n_models)
+    print('- z band: %d' % band)
+    norms = {key: np.asarray(getattr(helper, 'norm_%s' % key), dtype=float)
+             for key in COLUMNS}
+    edges = list(range(0, n_models, batch_size)) + [n_models]
+    batches = [samples[edges[i]:edges[i + 1]] for i in range(len(edges) - 1)]
+
+    store = lparallel.SharedStore()
+    pool = None
+    wide = []
+    try:
+        values = get_cell_values(helper, band)
+        geometry = (bins, band, cache)
+        if workers > 1:
+            # a single copy in shared memory
+            desc, shared = store.empty(values.shape)
+            shared[...] = values
+            del shared
+            pool = mp.Pool(workers, _init_worker, (desc,) + geometry)
+            results = pool.imap(_project_batch, batches)
+        else:
+            _worker['values'] = values
+            _worker['geometry'] = geometry
+            results = map(_project_batch, batches)
+        del values
+
+        start_time = time.time()
+        for i, (counts_1d, counts_2d, batch_wide) in enumerate(results):
+            for k in range(len(counts_1d)):
+                index = edges[i] + k
+                if batch_wide[k]:
+                    wide.append(index)
+                    for key in outputs:
+                        outputs[key][index] = np.nan
+                    continue
+                for dim, counts in (('1d', counts_1d[k][..., None]),
+                                    ('2d', counts_2d[k])):
+                    hists = {key: counts[2*c:2*c + 2]
+                             for c, key in enumerate(COLUMNS)}
+                    xi, xi_err = lcorrelation.tpcf(
+                        rr          = hists['rr'],
+                        dd          = hists['dd'],
+                        d1r2        = hists['d1r2'],
+                        d2r1        = hists['d2r1'],
+                        norm_rr     = norms['rr'],
+                        norm_dd     = norms['dd'],
+                        norm_d1r2   = norms['d1r2'],
+                        norm_d2r1   = norms['d2r1'])
+                    outputs['xi_%s' % dim][index] = xi
+                    outputs['xi_err_%s' % dim][index] = xi_err
+            print('- models: %d/%d (%.1f seconds)' %
+                  (edges[i + 1], n_models, time.time() - start_time),
+                  flush=True)
+    finally:
+        if pool is not None:
+            pool.terminate()
+        _worker.clear()
+        store.close()
+
+    for output in outputs.values():
+        output.flush()
+    np.save(os.path.join(out_dir, 'wide.npy'), np.array(wide, dtype=int))
+    if len(wide) > 0:
+        print('- warning: %d models need a wider z band than %d, their '
+              'correlation functions are NaN, see wide.npy' %
+              (len(wide), band))
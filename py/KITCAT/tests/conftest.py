@@ -0,0 +1,63 @@
+""" Shared mock catalogs of the regression tests """
+
+import numpy as np
+import pytest
+from sklearn.neighbors import BallTree, KDTree
+
+from KITCAT.bins import Bins
+from KITCAT.catalog import hist2point, to_unit
+from KITCAT.cosmology import Cosmology, max_cosmo, min_cosmo
+
+LIMIT_PARAMS = {'unit': 'deg', 's_max': 20.,
+                'ra_min': 150., 'ra_max': 160.,
+                'dec_min': 5., 'dec_max': 15.,
+                'z_min': 0.43, 'z_max': 0.6}
+
+NBINS_PARAMS = {'auto': False, 's': 10, 'dec': 30, 'ra': 30, 'z': 30,
+                'theta': 12}
+
+N_GALAXIES = 2000
+
+def haversine_tree(catalog):
+    """ haversine tree of the (dec, ra) in the first two columns """
+    return BallTree(catalog[:, :2], leaf_size=40, metric='haversine')
+
+def chord_tree(catalog):
+    """ chord tree of the (dec, ra) in the first two columns """
+    return KDTree(to_unit(catalog), leaf_size=40)
+
+@pytest.fixture(scope='session')
+def cosmos():
+    """ two cosmologies of the mock """
+    return [Cosmology(100, 0.35, 0.65), Cosmology(100, 0.25, 0.75)]
+
+@pytest.fixture(scope='session')
+def bins(cosmos):
+    """ binning of the mock """
+    return Bins(LIMIT_PARAMS, NBINS_PARAMS, min_cosmo(cosmos),
+                max_cosmo(cosmos))
+
+@pytest.fixture(scope='session')
+def mock(bins):
+    """ 2k weighted galaxies (dec, ra, z, w) and gridded randoms (dec, ra, w)
+    inside the limits of bins """
+    rng = np.random.RandomState(2018)
+    dec = rng.uniform(*bins.limit['dec'], size=N_GALAXIES)
+    ra = rng.uniform(*bins.limit['ra'], size=N_GALAXIES)
+    z = rng.uniform(*bins.limit['z'], size=N_GALAXIES)
+    w = rng.uniform(0.5, 1.5, size=N_GALAXIES)
+    galaxies = np.array([dec, ra, z, w]).T
+
+    dec_edges = bins.bins('dec')
+    ra_edges = bins.bins('ra')
+    hist, _, _ = np.histogram2d(rng.uniform(*bins.limit['dec'], size=20000),
+                                rng.uniform(*bins.limit['ra'], size=20000),
+                                bins=(dec_edges, ra_edges))
+    grid = hist2point(hist, dec_edges, ra_edges)
+
+    return {'galaxies': galaxies,
+            'grid': grid,
+            'galaxy_tree': haversine_tree(galaxies),
+            'grid_tree': haversine_tree(grid),
+            'galaxy_chord': chord_tree(galaxies),
+            'grid_chord': chord_tree(grid)}
@@ -0,0 +1,240 @@
+""" Regression tests of the binning and the pair counting backends of
+KITCAT.analysis """
+
+import numpy as np
+import pytest
+
+from KITCAT import analysis
+from KITCAT import histogram as lhistogram
+from KITCAT.helper import JobHelper, estimate_cost
+from KITCAT.projection import band_partner, shift_band
+
+def z_kwargs(bins):
+    """ z and theta binning arguments of get_ztheta and get_zztheta """
+    return dict(z_min       = bins.min('z'),
+                z_max       = bins.max('z'),
+                z_nbins     = bins.num_bins('z'),
+                theta_max   = bins.max('theta'),
+                theta_nbins = bins.num_bins('theta'))
+
+def theta_kwargs(bins):
+    """ theta binning arguments of get_ftheta """
+    return dict(theta_max   = bins.max('theta'),
+                theta_nbins = bins.num_bins('theta'))
+
+def tree_of(mock, key, backend):
+    """ tree and backend argument of a backend, 'chord' is the balltree
+    backend on a chord tree """
+    if backend == 'chord':
+        return mock[key + '_chord'], 'balltree'
+    return mock[key + '_tree'], backend
+
+def unband(zztheta):
+    """ banded (..., T, Z, 2*band+1) into full (..., T, Z, Z) """
+    nz = zztheta.shape[-2]
+    b, valid = band_partner(nz, zztheta.shape[-1] // 2)
+    a = np.indices(b.shape)[0]
+    full = np.zeros(zztheta.shape[:-1] + (nz,))
+    full[..., a[valid], b[valid]] = zztheta[..., valid]
+    return full
+
+def symmetrize(full):
+    """ count each unordered pair of z bins once, whichever point is the
+    tree point """
+    upper = full + np.swapaxes(full, -1, -2)
+    diagonal = np.arange(full.shape[-1])
+    upper[..., diagonal, diagonal] = full[..., diagonal, diagonal]
+    return np.triu(upper)
+
+@pytest.mark.parametrize('x_min, x_max, nbins', [
+    (0., 0.0174, 12), (0.43, 0.6, 30), (-1.3, 2.7, 7)])
+def test_bin_index_matches_histogram(x_min, x_max, nbins):
+    rng = np.random.RandomState(1)
+    edges = np.linspace(x_min, x_max, nbins + 1)
+    width = x_max - x_min
+    x = np.concatenate([
+        rng.uniform(x_min - 0.1*width, x_max + 0.1*width, size=300),
+        edges,
+        np.nextafter(edges, -np.inf),
+        np.nextafter(edges, np.inf)])
+
+    expected = np.full(x.shape, -1)
+    for i, value in enumerate(x):
+        hist, _ = np.histogram([value], bins=nbins, range=(x_min, x_max))
+        if hist.any():
+            expected[i] = np.argmax(hist)
+
+    index, keep = analysis._bin_index(x, x_min, x_max, nbins)
+    np.testing.assert_array_equal(keep, expected >= 0)
+    np.testing.assert_array_equal(index, expected[keep])
+    np.testing.assert_array_equal(
+        np.bincount(index, minlength=nbins),
+        np.histogram(x, bins=nbins, range=(x_min, x_max))[0])
+
+@pytest.mark.parametrize('same', [True, False])
+@pytest.mark.parametrize('backend', ['dualtree', 'healpix', 'chord', 'fft'])
+def test_ftheta_backends(mock, bins, backend, same):
+    if backend == 'healpix':
+        pytest.importorskip('healpy')
+    grid = mock['grid']
+    if same or backend == 'fft':
+        pair_catalog = grid
+    else:
+        pair_catalog = mock['galaxies'][:, [0, 1, 3]]
+    expected = analysis.get_ftheta(pair_catalog, grid, mock['grid_tree'],
+                                   same=same, **theta_kwargs(bins))
+
+    tree, backend = tree_of(mock, 'grid', backend)
+    ftheta = analysis.get_ftheta(pair_catalog, grid, tree, same=same,
+                                 backend=backend, **theta_kwargs(bins))
+    np.testing.assert_allclose(ftheta, expected, rtol=1e-12)
+
+@pytest.mark.parametrize('backend', ['dualtree', 'healpix', 'chord'])
+def test_ztheta_backends(mock, bins, backend):
+    if backend == 'healpix':
+        pytest.importorskip('healpy')
+    galaxies = mock['galaxies']
+    grid = mock['grid']
+    expected = analysis.get_ztheta(galaxies, grid, mock['grid_tree'],
+                                   **z_kwargs(bins))
+
+    tree, backend = tree_of(mock, 'grid', backend)
+    ztheta = analysis.get_ztheta(galaxies, grid, tree, backend=backend,
+                                 **z_kwargs(bins))
+    np.testing.assert_allclose(ztheta, expected, rtol=1e-12)
+
+@pytest.mark.parametrize('backend', ['balltree', 'dualtree'])
+def test_ztheta_z_range(mock, bins, backend):
+    # galaxies outside of the z range are dropped, not put into an edge bin
+    galaxies = mock['galaxies'].copy()
+    galaxies[:100, 2] = bins.min('z') - 0.05
+    galaxies[100:200, 2] = bins.max('z') + 0.05
+    expected = analysis.get_ztheta(galaxies[200:], mock['grid'],
+                                   mock['grid_tree'], backend=backend,
+                                   **z_kwargs(bins))
+    ztheta = analysis.get_ztheta(galaxies, mock['grid'], mock['grid_tree'],
+                                 backend=backend, **z_kwargs(bins))
+    np.testing.assert_allclose(ztheta, expected, rtol=1e-12)
+
+@pytest.mark.parametrize('same', [True, False])
+@pytest.mark.parametrize('backend', ['dualtree', 'healpix', 'chord'])
+def test_zztheta_backends(mock, bins, backend, same):
+    if backend == 'healpix':
+        pytest.importorskip('healpy')
+    galaxies = mock['galaxies']
+    pair_catalog = galaxies if same else galaxies[::2]
+    expected = analysis.get_zztheta(pair_catalog, galaxies,
+                                    mock['galaxy_tree'], same=same,
+                                    z_band=bins.band, **z_kwargs(bins))
+
+    tree, backend = tree_of(mock, 'galaxy', backend)
+    zztheta = analysis.get_zztheta(pair_catalog, galaxies, tree, same=same,
+                                   backend=backend, z_band=bins.band,
+                                   **z_kwargs(bins))
+    if same and backend == 'dualtree':
+        # ordered pairs are halved into both z bin orders, and removing the
+        # self-pairs leaves rounding residues
+        zztheta = symmetrize(unband(zztheta))
+        expected = symmetrize(unband(expected))
+    np.testing.assert_allclose(zztheta, expected, rtol=1e-12, atol=1e-12)
+
+def test_zztheta_band(mock, bins):
+    galaxies = mock['galaxies']
+    full = analysis.get_zztheta(galaxies, galaxies, mock['galaxy_tree'],
+                                same=True, **z_kwargs(bins))
+    assert full.shape[-1] == 2*bins.num_bins('z') - 1
+    banded = analysis.get_zztheta(galaxies, galaxies, mock['galaxy_tree'],
+                                  same=True, z_band=bins.band,
+                                  **z_kwargs(bins))
+    np.testing.assert_array_equal(banded, shift_band(full, bins.band))
+
+    # zztheta[:, :, l, d] holds tree z bin l and pair z bin l + d - band
+    z = galaxies[:, 2]
+    edges = np.linspace(bins.min('z'), bins.max('z'), bins.num_bins('z') + 1)
+    i, j = np.triu_indices(len(galaxies), 1)
+    dec, ra = galaxies[:, 0], galaxies[:, 1]
+    theta = 2.*np.arcsin(np.sqrt(
+        np.sin(0.5*(dec[j] - dec[i]))**2 +
+        np.cos(dec[i])*np.cos(dec[j])*np.sin(0.5*(ra[j] - ra[i]))**2))
+    close = theta <= bins.max('theta')
+    hist, _ = np.histogramdd(
+        np.array([theta[close], z[j[close]], z[i[close]]]).T,
+        bins=(bins.bins('theta'), edges, edges))
+    np.testing.assert_allclose(unband(full[1]), hist, rtol=0., atol=1e-9)
+
+@pytest.mark.parametrize('same', [True, False])
+@pytest.mark.parametrize('chord', [False, True])
+def test_zztheta_unweighted(mock, bins, chord, same):
+    galaxies = mock['galaxies']
+    pair_catalog = galaxies if same else galaxies[::2]
+    expected = analysis.get_zztheta(pair_catalog, galaxies,
+                                    mock['galaxy_tree'], same=same,
+                                    z_band=bins.band, **z_kwargs(bins))
+
+    tree = mock['galaxy_chord' if chord else 'galaxy_tree']
+    zztheta = analysis.get_zztheta(pair_catalog, galaxies, tree, same=same,
+                                   z_band=bins.band, weighted=False,
+                                   **z_kwargs(bins))
+    assert np.isnan(zztheta[0]).all()
+    if same:
+        # an unordered pair may be assigned to the other z bin order
+        np.testing.assert_array_equal(symmetrize(unband(zztheta[1])),
+                                      symmetrize(unband(expected[1])))
+    else:
+        np.testing.assert_array_equal(zztheta[1], expected[1])
+
+@pytest.mark.parametrize('unweighted_dtype', ['int64', 'uint32'])
+@pytest.mark.parametrize('backend', ['balltree', 'dualtree'])
+def test_accumulator_dtypes(mock, bins, backend, unweighted_dtype):
+    galaxies = mock['galaxies']
+    grid = mock['grid']
+    dtypes = dict(weighted_dtype='float32', unweighted_dtype=unweighted_dtype)
+    calls = [
+        lambda **kwargs: analysis.get_ztheta(
+            galaxies, grid, mock['grid_tree'], backend=backend,
+            chunk_size=300, **dict(z_kwargs(bins), **kwargs)),
+        lambda **kwargs: analysis.get_zztheta(
+            galaxies, galaxies, mock['galaxy_tree'], same=True,
+            backend=backend, chunk_size=300, z_band=bins.band,
+            **dict(z_kwargs(bins), **kwargs)),
+        ]
+    for call in calls:
+        expected = call()
+        hist = call(**dtypes)
+        # the halves are filled in their own dtypes, the randoms and the
+        # unweighted pairs have integer weights. Removing the self-pairs of
+        # the dualtree backend leaves float32 residues.
+        assert isinstance(hist, lhistogram.Histogram)
+        assert hist.halves[0].dtype == np.float32
+        assert hist.halves[1].dtype == np.dtype(unweighted_dtype)
+        np.testing.assert_allclose(hist[0], expected[0], rtol=1e-6,
+                                   atol=1e-6 * np.abs(expected[0]).max())
+        np.testing.assert_array_equal(hist[1], expected[1])
+
+@pytest.mark.parametrize('balanced', [False, True])
+@pytest.mark.parametrize('backend', ['balltree', 'dualtree'])
+def test_job_split(mock, bins, backend, balanced):
+    galaxies = mock['galaxies']
+    grid = mock['grid']
+    calls = [
+        (grid, mock['grid_tree'], lambda job: analysis.get_ftheta(
+            grid, grid, mock['grid_tree'], job_helper=job, same=True,
+            backend=backend, **theta_kwargs(bins))),
+        (galaxies, mock['grid_tree'], lambda job: analysis.get_ztheta(
+            galaxies, grid, mock['grid_tree'], job_helper=job,
+            backend=backend, **z_kwargs(bins))),
+        (galaxies, mock['galaxy_tree'], lambda job: analysis.get_zztheta(
+            galaxies, galaxies, mock['galaxy_tree'], job_helper=job,
+            same=True, backend=backend, z_band=bins.band, **z_kwargs(bins))),
+        ]
+    for pair_catalog, tree, call in calls:
+        expected = call(None)
+        job_helper = JobHelper(3)
+        if balanced:
+            job_helper.set_cost(estimate_cost(pair_catalog, tree,
+                                              bins.max('theta'), nsample=100))
+        total = 0.
+        for job in range(3):
+            job_helper.set_current_job(job, verbose=False)
+            total = total + call(job_helper)
+        np.testing.assert_allclose(total, expected, rtol=1e-12, atol=1e-12)
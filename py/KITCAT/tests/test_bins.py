@@ -0,0 +1,18 @@
+""" Regression tests of KITCAT.bins """
+
+import pickle
+
+def test_bins_without_band(bins):
+    # bins pickled before zztheta was banded
+    state = dict(bins.__dict__)
+    del state['band']
+    old = bins.__class__.__new__(bins.__class__)
+    old.__dict__.update(state)
+    old = pickle.loads(pickle.dumps(old))
+    assert old.band == bins.num_bins('z') - 1
+    assert not bins == old
+    assert pickle.loads(pickle.dumps(bins)) == bins
+
+    # objects without a band are never equal
+    del old.band
+    assert not bins == old
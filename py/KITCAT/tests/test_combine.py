@@ -0,0 +1,59 @@
+""" Regression tests of the reduction of the combinatorial jobs in
+KITCAT.combine """
+
+import os
+
+import numpy as np
+import pytest
+
+from KITCAT import combine as lcombine
+from KITCAT import histogram as lhistogram
+from KITCAT import io as lio
+from KITCAT.helper import CorrelationHelper
+
+def write_jobs(prefix, bins, cosmos, njob, dtypes):
+    """ write njob divide files of random histograms and return their sum
+    as float64 arrays """
+    rng = np.random.RandomState(8)
+    theta_nbins = bins.num_bins('theta')
+    z_nbins = bins.num_bins('z')
+    shapes = {'ztheta_d1r2': (2, theta_nbins, z_nbins),
+              'zztheta': (2, theta_nbins, z_nbins, 2*bins.band + 1)}
+    total = {}
+    for job in range(njob):
+        helper = CorrelationHelper()
+        helper.bins = bins
+        if job == 0:
+            helper.cosmos_list = cosmos
+        helper.ftheta = rng.uniform(size=theta_nbins)
+        total['ftheta'] = total.get('ftheta', 0.) + helper.ftheta
+        for field, shape in shapes.items():
+            hist = lhistogram.zeros(shape, *dtypes)
+            halves = lhistogram.halves(hist)
+            lhistogram.add(halves[0], rng.uniform(size=shape[1:]))
+            lhistogram.add(halves[1], rng.randint(100, size=shape[1:]))
+            setattr(helper, field, hist)
+            total[field] = total.get(field, 0.) + np.asarray(hist)
+        lio.save('%s_divide_%03d-%03d.pkl' % (prefix, job, njob), helper)
+    return total
+
+@pytest.mark.parametrize('dtypes', [('float64', 'float64'),
+                                    ('float32', 'uint32')])
+@pytest.mark.parametrize('memmap', [False, True])
+def test_combine(bins, cosmos, tmpdir, dtypes, memmap):
+    prefix = os.path.join(str(tmpdir), 'run')
+    expected = write_jobs(prefix, bins, cosmos, 3, dtypes)
+    lcombine.combine(prefix, memmap=memmap)
+    assert not os.path.exists('%s_combine_tmp' % prefix)
+
+    helper = lio.load('%s_combine.pkl' % prefix)
+    assert helper.bins == bins
+    assert len(helper.cosmos_list) == len(cosmos)
+    assert helper.ztheta_d2r1 is None
+    for field, total in expected.items():
+        hist = getattr(helper, field)
+        assert not isinstance(hist, np.memmap)
+        if isinstance(hist, lhistogram.Histogram):
+            assert hist.halves[0].dtype == np.dtype(dtypes[0])
+            assert hist.halves[1].dtype == np.dtype(dtypes[1])
+        np.testing.assert_allclose(np.asarray(hist), total, rtol=1e-6)
@@ -0,0 +1,17 @@
+""" Regression tests of KITCAT.healpix """
+
+import numpy as np
+import pytest
+
+hp = pytest.importorskip('healpy')
+from KITCAT import healpix as lhealpix
+
+def test_cells2nside(mock):
+    grid = mock['grid']
+    for n_cells in (1, 5, 50, 400, len(grid) - 1, len(grid)):
+        # highest nside whose next resolution has more than n_cells pixels
+        nside = 1
+        while nside < 2**29 and len(np.unique(
+                lhealpix.ang2pix(2 * nside, grid))) <= n_cells:
+            nside *= 2
+        assert lhealpix.cells2nside(grid, n_cells) == nside
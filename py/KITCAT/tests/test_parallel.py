@@ -0,0 +1,163 @@
+""" Regression tests of the worker pool of KITCAT.parallel and the
+checkpointed runs of KITCAT.checkpoint against a single serial run """
+
+import os
+
+import numpy as np
+import pytest
+
+from KITCAT import checkpoint as lcheckpoint
+from KITCAT import parallel as lparallel
+from KITCAT.helper import JobHelper, estimate_cost
+
+@pytest.fixture(scope='module')
+def preprocess_params(mock):
+    """ auto-correlation stages of the mock """
+    galaxies = mock['galaxies']
+    grid = mock['grid']
+    return {
+        'rr': {'pair_catalog': grid, 'tree_catalog': grid,
+               'tree': mock['grid_tree']},
+        'd1r2': {'pair_catalog': galaxies, 'tree_catalog': grid,
+                 'tree': mock['grid_tree']},
+        'd2r1': None,
+        'dd': {'pair_catalog': galaxies, 'tree_catalog': galaxies,
+               'tree': mock['galaxy_tree']},
+        }
+
+@pytest.fixture(scope='module')
+def expected(preprocess_params, bins):
+    """ histograms of each stage from one serial run_range """
+    results = {}
+    for key in lparallel.STAGES:
+        params = preprocess_params[key]
+        if params is None:
+            continue
+        kwargs = lparallel.get_stage_kwargs(key, bins, True)
+        results[key] = lparallel.run_range(
+            key, params, 0, params['pair_catalog'].shape[0], **kwargs)
+    return results
+
+def get_costs(preprocess_params, bins):
+    """ estimated per-point cost of each stage """
+    return {key: estimate_cost(params['pair_catalog'], params['tree'],
+                               bins.max('theta'), nsample=100)
+            for key, params in preprocess_params.items()
+            if params is not None}
+
+def check_results(results, expected):
+    """ assert that each stage matches the serial histograms """
+    assert results['d2r1'] is None
+    for key in expected:
+        np.testing.assert_allclose(results[key], expected[key], rtol=1e-12,
+                                   atol=1e-12)
+
+@pytest.mark.parametrize('balanced', [False, True])
+def test_run_combinatorial(preprocess_params, bins, expected, balanced):
+    try:
+        from multiprocessing import shared_memory
+    except ImportError:
+        pytest.skip('worker processes require Python >= 3.8')
+    costs = get_costs(preprocess_params, bins) if balanced else None
+    results = lparallel.run_combinatorial(preprocess_params, bins, 2,
+                                          nchunks=7, costs=costs)
+    check_results(results, expected)
+
+def test_run_combinatorial_dtypes(preprocess_params, bins, expected):
+    try:
+        from multiprocessing import shared_memory
+    except ImportError:
+        pytest.skip('worker processes require Python >= 3.8')
+    results = lparallel.run_combinatorial(preprocess_params, bins, 2,
+                                          nchunks=7, weighted_dtype='float32',
+                                          unweighted_dtype='uint32')
+    for key in ('d1r2', 'dd'):
+        assert results[key].halves[0].dtype == np.float32
+        assert results[key].halves[1].dtype == np.uint32
+        np.testing.assert_allclose(results[key][0], expected[key][0],
+                                   rtol=1e-6)
+        np.testing.assert_array_equal(results[key][1], expected[key][1])
+    np.testing.assert_allclose(results['rr'], expected['rr'], rtol=1e-12)
+
+@pytest.mark.parametrize('balanced', [False, True])
+def test_checkpoint_job_split(preprocess_params, bins, expected, tmpdir, balanced):
+    costs = get_costs(preprocess_params, bins) if balanced else None
+    job_helper = JobHelper(3)
+    total = {}
+    for job in range(3):
+        job_helper.set_current_job(job, verbose=False)
+        checkpoint = lcheckpoint.Checkpoint(
+            os.path.join(str(tmpdir), 'job_%d.pkl' % job), 3600., job_helper,
+            bins, 'balltree')
+        results = lcheckpoint.run_checkpointed(
+            preprocess_params, bins, checkpoint, job_helper, nsegments=4,
+            costs=costs)
+        for key in expected:
+            total[key] = total.get(key, 0.) + results[key]
+    total['d2r1'] = None
+    check_results(total, expected)
+
+def test_checkpoint_resume(preprocess_params, bins, expected, tmpdir):
+    fname = os.path.join(str(tmpdir), 'checkpoint.pkl')
+    job_helper = JobHelper(1)
+    job_helper.set_current_job(0, verbose=False)
+
+    # interrupted in the middle of d1r2
+    checkpoint = lcheckpoint.Checkpoint(fname, 0., job_helper, bins,
+                                        'balltree')
+    checkpoint.state['done']['rr'] = expected['rr']
+    checkpoint.state['time']['rr'] = 0.
+    kwargs = lparallel.get_stage_kwargs('d1r2', bins, True)
+    checkpoint.update('d1r2', 700, lparallel.run_range(
+        'd1r2', preprocess_params['d1r2'], 0, 700, **kwargs), 0., force=True)
+
+    checkpoint = lcheckpoint.Checkpoint(fname, 0., job_helper, bins,
+                                        'balltree')
+    assert checkpoint.load()
+    results = lcheckpoint.run_checkpointed(preprocess_params, bins,
+                                           checkpoint, nsegments=5)
+    check_results(results, expected)
+
+    # a finished checkpoint is loaded, not recalculated
+    checkpoint = lcheckpoint.Checkpoint(fname, 0., job_helper, bins,
+                                        'balltree')
+    assert checkpoint.load()
+    assert sorted(checkpoint.state['done']) == ['d1r2', 'dd', 'rr']
+    results = lcheckpoint.run_checkpointed(preprocess_params, bins,
+                                           checkpoint)
+    check_results(results, expected)
+
+    # a checkpoint of another backend is rejected
+    checkpoint = lcheckpoint.Checkpoint(fname, 0., job_helper, bins,
+                                        'dualtree')
+    with pytest.raises(ValueError):
+        checkpoint.load()
+
+def test_checkpoint_mismatch(preprocess_params, bins, tmpdir):
+    fname = os.path.join(str(tmpdir), 'checkpoint.pkl')
+    job_helper = JobHelper(3)
+    job_helper.set_current_job(1, verbose=False)
+    checkpoint = lcheckpoint.Checkpoint(fname, 0., job_helper, bins,
+                                        'balltree')
+    start, end = job_helper.get_index_range(
+        preprocess_params['rr']['pair_catalog'].shape[0])
+    checkpoint.check_range('rr', start, end)
+    checkpoint.update('rr', start + 10, np.zeros(bins.num_bins('theta')), 0.,
+                      force=True)
+
+    # other settings of the balance, the f(theta) backend or the dtypes
+    for kwargs in ({'balance': True}, {'rr_backend': 'dualtree'},
+                   {'dtypes': ('float32', 'int64')}):
+        checkpoint = lcheckpoint.Checkpoint(fname, 0., job_helper, bins,
+                                            'balltree', **kwargs)
+        with pytest.raises(ValueError):
+            checkpoint.load()
+
+    # the range of a cost-balanced job differs from the saved one
+    checkpoint = lcheckpoint.Checkpoint(fname, 0., job_helper, bins,
+                                        'balltree')
+    assert checkpoint.load()
+    with pytest.raises(ValueError):
+        lcheckpoint.run_checkpointed(preprocess_params, bins, checkpoint,
+                                     job_helper,
+                                     costs=get_costs(preprocess_params, bins))
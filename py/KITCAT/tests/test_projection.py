@@ -0,0 +1,164 @@
+""" Regression tests of the projection operators of KITCAT.projection and
+KITCAT.helper against the histogram loops they replaced """
+
+import numpy as np
+import pytest
+
+from KITCAT.helper import CorrelationHelper
+from KITCAT.projection import Projection, band_partner, find_band, shift_band
+
+def centers(bins, key, cosmo=None):
+    """ bin centres of theta, or of the comoving distance of z """
+    edges = bins.bins(key)
+    if cosmo is not None:
+        edges = cosmo.z2r(edges)
+    return 0.5 * (edges[:-1] + edges[1:])
+
+def histogram_loop(theta, r, s, weights):
+    """ project weights of shape (theta_nbins, z_nbins, z_nbins), pairing
+    r[l] and r[m], with the per-cell histograms of the old helper loops """
+    hist_1d = np.zeros((len(s) - 1, 1))
+    hist_2d = np.zeros((len(s) - 1, len(s) - 1))
+    for k, pt_theta in enumerate(theta):
+        sin_2 = np.sin(pt_theta/2.)
+        cos_2 = np.cos(pt_theta/2.)
+        for l, pt_r in enumerate(r):
+            w = weights[k, l]
+            dist = np.sqrt(pt_r**2 + r**2 - 2*r*pt_r * np.cos(pt_theta))
+            hist, _ = np.histogram(dist, bins=s, weights=w)
+            hist_1d += hist.reshape(-1, 1)
+
+            sigma = sin_2 * (pt_r + r)
+            pi = cos_2 * np.abs(pt_r - r)
+            hist, _, _ = np.histogram2d(sigma, pi, bins=(s, s), weights=w)
+            hist_2d += hist
+    return hist_1d, hist_2d
+
+def to_band(full, band):
+    """ full (..., Z, Z) into banded (..., Z, 2*band+1) """
+    b, valid = band_partner(full.shape[-1], band)
+    a = np.indices(b.shape)[0]
+    return np.where(valid, full[..., a, b], 0.)
+
+@pytest.fixture(scope='module')
+def helper(bins, cosmos):
+    """ helper with random histograms of the mock binning """
+    rng = np.random.RandomState(3)
+    theta_nbins = bins.num_bins('theta')
+    z_nbins = bins.num_bins('z')
+    helper = CorrelationHelper()
+    helper.bins = bins
+    helper.cosmos_list = cosmos
+    helper.ftheta = rng.uniform(size=theta_nbins)
+    helper.z1_distr = rng.uniform(size=(2, z_nbins))
+    helper.z2_distr = rng.uniform(size=(2, z_nbins))
+    helper.ztheta_d1r2 = rng.uniform(size=(2, theta_nbins, z_nbins))
+    helper.full_zztheta = rng.uniform(size=(2, theta_nbins, z_nbins, z_nbins))
+    helper.zztheta = to_band(helper.full_zztheta, bins.band)
+    return helper
+
+def test_projection_full_band(bins, cosmos):
+    rng = np.random.RandomState(4)
+    theta = centers(bins, 'theta')
+    r = centers(bins, 'z', cosmos[0])
+    s = bins.bins('s')
+    weights = rng.uniform(size=(len(theta), len(r), len(r)))
+
+    projection = Projection(theta, r, s, len(r) - 1)
+    hist_1d, hist_2d = projection.project(to_band(weights, len(r) - 1))
+    expected_1d, expected_2d = histogram_loop(theta, r, s, weights)
+    np.testing.assert_allclose(hist_1d, expected_1d, rtol=1e-12)
+    np.testing.assert_allclose(hist_2d, expected_2d, rtol=1e-12)
+
+def test_projection_find_band(bins, cosmos, tmpdir):
+    rng = np.random.RandomState(5)
+    theta = centers(bins, 'theta')
+    s = bins.bins('s')
+    for cosmo in cosmos:
+        r = centers(bins, 'z', cosmo)
+        band = find_band(r, bins.max('s'), bins.max('theta'))
+        assert 0 < band <= bins.band < len(r) - 1
+        weights = rng.uniform(size=(len(theta), len(r), len(r)))
+
+        # pairs beyond the band are separated by more than s_max
+        projection = Projection(theta, r, s, band)
+        hist_1d, hist_2d = projection.project(to_band(weights, band))
+        expected_1d, expected_2d = histogram_loop(theta, r, s, weights)
+        np.testing.assert_allclose(hist_1d, expected_1d, rtol=1e-12)
+        np.testing.assert_allclose(hist_2d, expected_2d, rtol=1e-12)
+
+        # saved operators give the same projection
+        projection.save(str(tmpdir))
+        loaded = Projection.load(str(tmpdir))
+        assert loaded.band == band
+        np.testing.assert_array_equal(
+            loaded.project(to_band(weights, band))[1], hist_2d)
+
+def test_helper_rr(helper):
+    rr1d, rr2d = helper.get_rr()
+    theta = centers(helper.bins, 'theta')
+    s = helper.bins.bins('s')
+    for i, cosmo in enumerate(helper.cosmos_list):
+        r = centers(helper.bins, 'z', cosmo)
+        for j in range(2):
+            # w = f(theta) * n2(z_l) * n1(z_m)
+            weights = (helper.ftheta[:, None, None] *
+                       helper.z2_distr[j][None, :, None] *
+                       helper.z1_distr[j][None, None, :])
+            expected_1d, expected_2d = histogram_loop(theta, r, s, weights)
+            np.testing.assert_allclose(rr1d[i][j], expected_1d, rtol=1e-12)
+            np.testing.assert_allclose(rr2d[i][j], expected_2d, rtol=1e-12)
+
+def test_helper_dr(helper):
+    dr1d, dr2d = helper.get_dr()
+    theta = centers(helper.bins, 'theta')
+    s = helper.bins.bins('s')
+    for i, cosmo in enumerate(helper.cosmos_list):
+        r = centers(helper.bins, 'z', cosmo)
+        for j in range(2):
+            # w = n(z_l) * g(theta, z_m)
+            weights = (helper.z2_distr[j][None, :, None] *
+                       helper.ztheta_d1r2[j][:, None, :])
+            expected_1d, expected_2d = histogram_loop(theta, r, s, weights)
+            np.testing.assert_allclose(dr1d[i][j], expected_1d, rtol=1e-12)
+            np.testing.assert_allclose(dr2d[i][j], expected_2d, rtol=1e-12)
+
+def test_helper_dd(helper):
+    dd1d, dd2d = helper.get_dd()
+    theta = centers(helper.bins, 'theta')
+    s = helper.bins.bins('s')
+    for i, cosmo in enumerate(helper.cosmos_list):
+        r = centers(helper.bins, 'z', cosmo)
+        for j in range(2):
+            expected_1d, expected_2d = histogram_loop(
+                theta, r, s, helper.full_zztheta[j])
+            np.testing.assert_allclose(dd1d[i][j], expected_1d, rtol=1e-12)
+            np.testing.assert_allclose(dd2d[i][j], expected_2d, rtol=1e-12)
+
+def test_helper_dd_band(helper):
+    # a DD band narrower than a cosmology needs is rejected
+    narrow = CorrelationHelper()
+    narrow.bins = helper.bins
+    narrow.cosmos_list = helper.cosmos_list
+    narrow.zztheta = shift_band(helper.zztheta, 0)
+    with pytest.raises(ValueError):
+        narrow.get_dd()
+
+def test_projection_widen(bins, cosmos):
+    rng = np.random.RandomState(7)
+    theta = centers(bins, 'theta')
+    r = centers(bins, 'z', cosmos[0])
+    s = bins.bins('s')
+    band = find_band(r, bins.max('s'), bins.max('theta'))
+    weights = to_band(rng.uniform(size=(len(theta), len(r), len(r))),
+                      bins.band)
+
+    # cells beyond the band of the cosmology are separated by more than s_max
+    expected = Projection(theta, r, s, bins.band)
+    op_1d, op_2d = Projection(theta, r, s, band).widen(bins.band)
+    np.testing.assert_allclose(op_1d.dot(weights.ravel()),
+                               expected.op_1d.dot(weights.ravel()), rtol=1e-12)
+    np.testing.assert_allclose(op_2d.dot(weights.ravel()),
+                               expected.op_2d.dot(weights.ravel()), rtol=1e-12)
+    with pytest.raises(ValueError):
+        Projection(theta, r, s, band).widen(band - 1)
@@ -0,0 +1,70 @@
+""" Regression tests of KITCAT.scan against the integration of
+KITCAT.helper """
+
+import os
+
+import numpy as np
+import pytest
+
+from KITCAT import correlation as lcorrelation
+from KITCAT import scan as lscan
+from KITCAT.cache import Cache
+from KITCAT.helper import CorrelationHelper
+from KITCAT.projection import band_partner
+
+@pytest.fixture(scope='module')
+def helper(bins, cosmos):
+    """ helper with random histograms of the mock binning and a DD band of
+    1, wide enough for the mock cosmologies only """
+    rng = np.random.RandomState(6)
+    theta_nbins = bins.num_bins('theta')
+    z_nbins = bins.num_bins('z')
+    helper = CorrelationHelper()
+    helper.bins = bins
+    helper.cosmos_list = cosmos
+    helper.ftheta = rng.uniform(size=theta_nbins)
+    helper.z1_distr = rng.uniform(size=(2, z_nbins))
+    helper.z2_distr = rng.uniform(size=(2, z_nbins))
+    helper.ztheta_d1r2 = rng.uniform(size=(2, theta_nbins, z_nbins))
+    _, valid = band_partner(z_nbins, 1)
+    helper.zztheta = rng.uniform(size=(2, theta_nbins, z_nbins, 3)) * valid
+    helper.norm_rr = rng.uniform(1., 2., size=2)
+    helper.norm_dd = rng.uniform(1., 2., size=2)
+    helper.norm_d1r2 = rng.uniform(1., 2., size=2)
+    helper.norm_d2r1 = rng.uniform(1., 2., size=2)
+    return helper
+
+@pytest.mark.parametrize('use_cache', [False, True])
+def test_scan(helper, tmpdir, use_cache):
+    cache = Cache(str(tmpdir.join('cache'))) if use_cache else None
+    # the last model needs a z band of 2
+    samples = [list(cosmo.params.values()) for cosmo in helper.cosmos_list]
+    samples.append([100., 1., 0.])
+    out_dir = str(tmpdir.join('scan'))
+    lscan.scan(helper, samples, out_dir, batch_size=2, cache=cache)
+
+    xi = {dim: np.load(os.path.join(out_dir, 'xi_%s.npy' % dim))
+          for dim in ('1d', '2d')}
+    np.testing.assert_array_equal(np.load(os.path.join(out_dir, 'wide.npy')),
+                                  [2])
+    assert np.isnan(xi['1d'][2]).all() and np.isnan(xi['2d'][2]).all()
+
+    rr = helper.get_rr()
+    dr = helper.get_dr()
+    dd = helper.get_dd()
+    for i in range(len(helper.cosmos_list)):
+        for k, dim in enumerate(('1d', '2d')):
+            expected, _ = lcorrelation.tpcf(
+                rr          = rr[k][i].copy(),
+                dd          = dd[k][i].copy(),
+                d1r2        = dr[k][i].copy(),
+                d2r1        = dr[k][i].copy(),
+                norm_rr     = helper.norm_rr,
+                norm_dd     = helper.norm_dd,
+                norm_d1r2   = helper.norm_d1r2,
+                norm_d2r1   = helper.norm_d2r1)
+            np.testing.assert_allclose(xi[dim][i], expected, rtol=1e-10)
+
+    if use_cache:
+        # one entry per model
+        assert len(cache.entries()) == len(samples)